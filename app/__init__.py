@@ -1,4 +1,4 @@
-from flask import Flask, render_template
+from flask import Flask, render_template, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from datetime import datetime
@@ -13,12 +13,24 @@ def create_app():
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hms.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = 'dev-secret-change-this'
+    # Overrides from the environment, e.g. FLASK_SQLALCHEMY_DATABASE_URI or FLASK_ADMISSION_ENABLED=false
+    app.config.from_prefixed_env()
 
     db.init_app(app)
     login_manager.init_app(app)
 
+    from .tenancy import init_tenancy, current_tenant
+    init_tenancy(app)
+
+    # First before_request hook, so a profiled request includes the others
+    from .profiling import init_profiling
+    init_profiling(app)
+
     @login_manager.user_loader
     def load_user(user_id):
+        # A session cookie is only good for the clinic that issued it
+        if session.get('tenant') != current_tenant():
+            return None
         return User.query.get(int(user_id))
 
     @app.route('/')
@@ -29,9 +41,77 @@ def create_app():
     from .routes import init_routes
     init_routes(app)
 
+    from .events import init_events
+    init_events(app)
+
+    from .timeline import init_timeline
+    init_timeline(app)
+
+    from .search import init_search
+    init_search(app)
+
+    from .archive import init_archive
+    init_archive(app)
+
+    from .bulk import init_bulk
+    init_bulk(app)
+
+    from .admission import init_admission
+    init_admission(app)
+
+    from .api import init_api
+    init_api(app)
+
+    from .sync import init_sync
+    init_sync(app)
+
+    from .jobs import init_jobs
+    init_jobs(app)
+
+    from .agenda import init_agenda
+    init_agenda(app)
+
+    from .recommend import init_recommend
+    init_recommend(app)
+
+    from .finder import init_finder
+    init_finder(app)
+
+    from .noshow import init_noshow
+    init_noshow(app)
+
+    from .walkin import init_walkin
+    init_walkin(app)
+
+    from .maintenance import init_maintenance
+    init_maintenance(app)
+
+    from .audit import init_audit
+    init_audit(app)
+
+    from .reports import init_reports
+    init_reports(app)
+
     return app
 
 
 def setup_database(app):
     with app.app_context():
         init_db()
+
+
+def warm_up(app):
+    """
+    Do the one-off work a first request would otherwise pay for: compile every
+    template and configure the ORM mappers. Run in the master process before
+    workers are forked so they inherit the result.
+    """
+    from sqlalchemy.orm import configure_mappers
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    configure_mappers()
+
+    with app.app_context():
+        # Forked workers must open their own connections, never share these
+        db.engine.dispose()
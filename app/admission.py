@@ -0,0 +1,191 @@
+"""
+In-process admission control for expensive endpoints.
+
+Two layers run before a matching request reaches its view:
+
+  * token-bucket rate limits per client IP and per logged-in user
+    (exceeded -> 429 Too Many Requests)
+  * a concurrency cap per endpoint class ("pool") with a short wait queue
+    (full, or waited too long -> 503 Service Unavailable)
+
+Both answers are immediate and carry a Retry-After header, so a booking
+storm or a wave of logins (each one a PBKDF2 hash plus an SQLite write)
+is shed at the door instead of queueing behind the database lock and
+slowing every read-only page. Limits are per worker process.
+
+A request that still times out waiting for the SQLite write lock gets the
+same treatment (503 + Retry-After) instead of a 500 page.
+"""
+import math
+import threading
+import time as _time
+
+from flask import request, g, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy.exc import OperationalError
+
+from .models import db
+from .tenancy import current_tenant
+
+DEFAULT_RULES = {
+    # endpoint: methods it applies to, (rate per second, burst) per IP / per user, pool
+    'login': {'methods': ('POST',), 'per_ip': (0.2, 10), 'pool': 'auth'},
+    'register': {'methods': ('POST',), 'per_ip': (0.05, 3), 'pool': 'auth'},
+    'patient_appointments': {'methods': ('POST',), 'per_ip': (1.0, 10), 'per_user': (0.2, 3), 'pool': 'booking'},
+    'cancel_appointment': {'methods': ('GET',), 'per_user': (0.5, 5), 'pool': 'booking'},
+}
+
+DEFAULT_POOLS = {
+    # name: concurrent requests, requests allowed to wait, longest wait (seconds)
+    'auth': {'limit': 4, 'queue': 16, 'wait': 2.0},
+    'booking': {'limit': 2, 'queue': 16, 'wait': 3.0},
+}
+
+
+class TokenBuckets:
+    """Token buckets keyed by client; idle keys are dropped once the table grows large."""
+
+    MAX_KEYS = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Spend one token. Returns 0 on success, else seconds until a token is available."""
+        now = _time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.MAX_KEYS:
+                self._evict(now)
+            return (1 - tokens) / self.rate
+
+    def _evict(self, now):
+        # A bucket idle long enough to be full again carries no state
+        refill = self.burst / self.rate
+        self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < refill}
+
+
+class ConcurrencyPool:
+    """At most `limit` requests at once; up to `queue` more wait at most `wait` seconds."""
+
+    def __init__(self, limit, queue, wait):
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self._slots = threading.Semaphore(limit)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+
+    def acquire(self, stats):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue:
+                    return False
+                self.waiting += 1
+            stats['queued'] += 1
+            try:
+                if not self._slots.acquire(timeout=self.wait):
+                    return False
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        with self._lock:
+            self.active += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+
+def _reject(status, message, retry_after):
+    response = jsonify({'error': message}) if request.accept_mimetypes.best == 'application/json' \
+        else message
+    return response, status, {'Retry-After': str(max(1, math.ceil(retry_after)))}
+
+
+def init_admission(app):
+    app.config.setdefault('ADMISSION_ENABLED', True)
+    app.config.setdefault('ADMISSION_RULES', DEFAULT_RULES)
+    app.config.setdefault('ADMISSION_POOLS', DEFAULT_POOLS)
+
+    pools = {name: ConcurrencyPool(**cfg) for name, cfg in app.config['ADMISSION_POOLS'].items()}
+    rules = {}
+    stats = {}
+    for endpoint, rule in app.config['ADMISSION_RULES'].items():
+        rules[endpoint] = {
+            'methods': set(rule.get('methods', ('GET', 'POST'))),
+            'per_ip': TokenBuckets(*rule['per_ip']) if rule.get('per_ip') else None,
+            'per_user': TokenBuckets(*rule['per_user']) if rule.get('per_user') else None,
+            'pool': pools[rule['pool']] if rule.get('pool') else None,
+        }
+        stats[endpoint] = {'admitted': 0, 'rate_limited': 0, 'queued': 0, 'rejected_busy': 0}
+    database = {'lock_timeouts': 0}
+
+    @app.before_request
+    def admit_request():
+        if not app.config['ADMISSION_ENABLED']:
+            return None
+        rule = rules.get(request.endpoint)
+        if rule is None or request.method not in rule['methods']:
+            return None
+        counters = stats[request.endpoint]
+
+        # 1) Rate limits: cheapest check first, nothing is held on failure
+        wait = 0
+        if rule['per_ip']:
+            wait = rule['per_ip'].take(request.remote_addr)
+        if not wait and rule['per_user'] and current_user.is_authenticated:
+            wait = rule['per_user'].take((current_tenant(), current_user.id))
+        if wait:
+            counters['rate_limited'] += 1
+            return _reject(429, 'Too many requests, please try again shortly.', wait)
+
+        # 2) Concurrency cap for the endpoint class
+        pool = rule['pool']
+        if pool:
+            if not pool.acquire(counters):
+                counters['rejected_busy'] += 1
+                return _reject(503, 'The server is busy, please try again shortly.', pool.wait)
+            g.admission_pool = pool
+
+        counters['admitted'] += 1
+        return None
+
+    @app.teardown_request
+    def release_admission_slot(exc):
+        pool = g.pop('admission_pool', None)
+        if pool:
+            pool.release()
+
+    @app.errorhandler(OperationalError)
+    def database_busy(e):
+        if 'database is locked' not in str(e):
+            raise e
+        db.session.rollback()
+        database['lock_timeouts'] += 1
+        return _reject(503, 'The database is busy, please try again shortly.', 1)
+
+    @app.route('/admin/admission_stats')
+    @login_required
+    def admission_stats():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+        return jsonify({
+            'endpoints': stats,
+            'database': database,
+            'pools': {
+                name: {'limit': p.limit, 'active': p.active, 'waiting': p.waiting}
+                for name, p in pools.items()
+            }
+        })
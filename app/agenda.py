@@ -0,0 +1,212 @@
+"""
+Doctor calendar: day, week and month views of one doctor's schedule.
+
+Only the requested window is read: appointments through the
+(doctor_id, date, time) index with patient and treatment eager-loaded,
+plus that window's DoctorAvailability. Free time inside availability
+blocks is shown inline between bookings, so the cost of a page follows the
+size of the window, not the length of the doctor's history.
+"""
+from datetime import date, datetime, timedelta
+
+from flask import current_app, render_template, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload
+
+from .models import db, User, Appointment, ArchivedAppointment, DoctorAvailability
+from .api import ApiError, API_PREFIX
+
+VIEWS = ('day', 'week', 'month')
+
+# Statuses that take up the doctor's time
+OCCUPYING = ('Booked', 'Completed')
+
+
+def window(view, anchor):
+    """(first day, last day, previous anchor, next anchor) of the window containing `anchor`."""
+    if view == 'day':
+        return anchor, anchor, anchor - timedelta(days=1), anchor + timedelta(days=1)
+    if view == 'week':
+        start = anchor - timedelta(days=anchor.weekday())
+        return start, start + timedelta(days=6), start - timedelta(days=7), start + timedelta(days=7)
+    start = anchor.replace(day=1)
+    end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return start, end, (start - timedelta(days=1)).replace(day=1), end + timedelta(days=1)
+
+
+def _merge_blocks(slots):
+    """Availability blocks of one day, overlapping ones merged, as [start, end] pairs."""
+    blocks = []
+    for s in sorted(slots, key=lambda s: s.start_time):
+        if blocks and s.start_time <= blocks[-1][1]:
+            blocks[-1][1] = max(blocks[-1][1], s.end_time)
+        else:
+            blocks.append([s.start_time, s.end_time])
+    return blocks
+
+
+def _free_gaps(day, blocks, appointments, slot):
+    """Parts of the availability blocks not covered by an occupying appointment."""
+    busy = sorted(a.time for a in appointments if a.status in OCCUPYING)
+    gaps = []
+    for block_start, block_end in blocks:
+        cursor = datetime.combine(day, block_start)
+        end = datetime.combine(day, block_end)
+        for t in busy:
+            t = datetime.combine(day, t)
+            if t + slot <= cursor or t >= end:
+                continue
+            if t > cursor:
+                gaps.append((cursor.time(), t.time()))
+            cursor = max(cursor, t + slot)
+        if cursor < end:
+            gaps.append((cursor.time(), end.time()))
+    return gaps
+
+
+def doctor_agenda(doctor_id, start, end):
+    """Appointments, availability and free gaps for each day from `start` to `end`."""
+    slot = timedelta(minutes=current_app.config['CALENDAR_SLOT_MINUTES'])
+
+    appointments = []
+    models = (Appointment, ArchivedAppointment) if start < date.today() else (Appointment,)
+    for model in models:
+        appointments += (
+            model.query
+            .options(joinedload(model.patient), joinedload(model.treatment))
+            .filter(model.doctor_id == doctor_id, model.date >= start, model.date <= end)
+            .order_by(model.date, model.time)
+            .all()
+        )
+
+    slots = (
+        DoctorAvailability.query
+        .filter(DoctorAvailability.doctor_id == doctor_id,
+                DoctorAvailability.date >= start, DoctorAvailability.date <= end)
+        .all()
+    )
+
+    days = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        day_appts = [a for a in appointments if a.date == day]
+        blocks = _merge_blocks([s for s in slots if s.date == day])
+
+        items = [{'kind': 'appointment', 'start': a.time, 'appointment': a} for a in day_appts]
+        items += [
+            {'kind': 'free', 'start': gap_start, 'end': gap_end}
+            for gap_start, gap_end in _free_gaps(day, blocks, day_appts, slot)
+        ]
+        items.sort(key=lambda item: (item['start'], item['kind'] == 'appointment'))
+        days.append({'date': day, 'blocks': blocks, 'items': items})
+
+    totals = {status: 0 for status in ('Booked', 'Completed', 'Cancelled', 'Missed')}
+    for a in appointments:
+        totals[a.status] = totals.get(a.status, 0) + 1
+    free_minutes = sum(
+        (datetime.combine(d['date'], i['end']) - datetime.combine(d['date'], i['start'])).seconds // 60
+        for d in days for i in d['items'] if i['kind'] == 'free'
+    )
+    return {'days': days, 'totals': totals, 'free_minutes': free_minutes}
+
+
+def _serialize_item(item):
+    if item['kind'] == 'free':
+        return {'kind': 'free', 'start': item['start'].strftime('%H:%M'), 'end': item['end'].strftime('%H:%M')}
+    a = item['appointment']
+    return {
+        'kind': 'appointment',
+        'id': a.id,
+        'start': a.time.strftime('%H:%M'),
+        'status': a.status,
+        'patient': {'id': a.patient_id, 'name': a.patient.name if a.patient else None},
+        'treatment_id': a.treatment.id if a.treatment else None,
+        'archived': isinstance(a, ArchivedAppointment),
+    }
+
+
+def _parse_window(args):
+    """(view, anchor) from the query string; raises ValueError on bad input."""
+    view = args.get('view', 'week')
+    if view not in VIEWS:
+        raise ValueError(f"view must be one of {', '.join(VIEWS)}")
+    anchor = args.get('date')
+    try:
+        anchor = datetime.strptime(anchor, "%Y-%m-%d").date() if anchor else date.today()
+    except ValueError:
+        raise ValueError("date must be YYYY-MM-DD")
+    return view, anchor
+
+
+def init_agenda(app):
+    app.config.setdefault('CALENDAR_SLOT_MINUTES', 30)   # time one appointment occupies
+    app.config.setdefault('CALENDAR_RECENT_DAYS', 30)    # past days listed on /doctor/appointments
+
+    @app.route('/doctor/calendar')
+    @login_required
+    def doctor_calendar():
+        if current_user.role != 'doctor':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        try:
+            view, anchor = _parse_window(request.args)
+        except ValueError:
+            flash("Invalid calendar date or view.", "warning")
+            return redirect(url_for('doctor_calendar'))
+
+        start, end, prev_anchor, next_anchor = window(view, anchor)
+        agenda = doctor_agenda(current_user.id, start, end)
+
+        return render_template(
+            'doctor_calendar.html',
+            view=view,
+            views=VIEWS,
+            anchor=anchor,
+            start=start,
+            end=end,
+            prev_anchor=prev_anchor,
+            next_anchor=next_anchor,
+            today=date.today(),
+            agenda=agenda
+        )
+
+    @app.route(API_PREFIX + '/calendar')
+    def api_calendar():
+        # Authentication is enforced for /api/v1/* in app/api.py
+        if current_user.role == 'doctor':
+            doctor_id = current_user.id
+        elif current_user.role == 'admin':
+            doctor_id = request.args.get('doctor_id', type=int)
+            doctor = db.session.get(User, doctor_id) if doctor_id else None
+            if doctor is None or doctor.role != 'doctor':
+                raise ApiError(400, "doctor_id of a doctor is required")
+        else:
+            raise ApiError(403, "only doctors and admins can read calendars")
+
+        try:
+            view, anchor = _parse_window(request.args)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+
+        start, end, prev_anchor, next_anchor = window(view, anchor)
+        agenda = doctor_agenda(doctor_id, start, end)
+
+        return jsonify({
+            'doctor_id': doctor_id,
+            'view': view,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'prev': prev_anchor.isoformat(),
+            'next': next_anchor.isoformat(),
+            'totals': agenda['totals'],
+            'free_minutes': agenda['free_minutes'],
+            'days': [
+                {
+                    'date': d['date'].isoformat(),
+                    'availability': [[s.strftime('%H:%M'), e.strftime('%H:%M')] for s, e in d['blocks']],
+                    'items': [_serialize_item(i) for i in d['items']],
+                }
+                for d in agenda['days']
+            ]
+        })
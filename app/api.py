@@ -0,0 +1,311 @@
+"""
+Versioned JSON API (/api/v1) for kiosk and mobile clients.
+
+Every collection supports:
+    ?limit=N          page size (default 50, max 200)
+    ?cursor=C         opaque cursor from the previous page's `next_cursor`
+    ?fields=a,b       sparse field selection
+    ?include=x,y      related objects, eager-loaded in the same query
+
+POST /api/v1/batch runs several GETs in one round trip. Role checks mirror
+routes.py: admins see everything, doctors their own appointments and the
+patients they have seen, patients only their own records.
+"""
+from datetime import date, time, datetime
+from urllib.parse import urlsplit, parse_qsl
+
+from flask import request, jsonify
+from flask_login import current_user
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
+from werkzeug.datastructures import MultiDict
+
+from .models import db, User, Appointment, Treatment, DoctorAvailability, Department
+
+API_PREFIX = '/api/v1'
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+MAX_BATCH = 20
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise ApiError(400, f"invalid date '{value}', expected YYYY-MM-DD")
+
+
+# ---------------- ROLE SCOPES ---------------- #
+
+def _seen_patients():
+    return db.session.query(Appointment.patient_id).filter(Appointment.doctor_id == current_user.id)
+
+
+def _scope_users(query):
+    if current_user.role == 'admin':
+        return query
+    if current_user.role == 'doctor':
+        return query.filter(or_(User.id == current_user.id, User.id.in_(_seen_patients())))
+    return query.filter(User.id == current_user.id)
+
+
+def _scope_doctors(query):
+    query = query.filter(User.role == 'doctor')
+    if current_user.role == 'patient':
+        query = query.filter(User.is_active == True)  # noqa: E712
+    return query
+
+
+def _scope_availability(query):
+    if current_user.role == 'doctor':
+        return query.filter(DoctorAvailability.doctor_id == current_user.id)
+    return query
+
+
+def _scope_appointments(query):
+    if current_user.role == 'doctor':
+        return query.filter(Appointment.doctor_id == current_user.id)
+    if current_user.role == 'patient':
+        return query.filter(Appointment.patient_id == current_user.id)
+    return query
+
+
+def _scope_treatments(query):
+    if current_user.role == 'admin':
+        return query
+    own = db.session.query(Appointment.id)
+    if current_user.role == 'doctor':
+        own = own.filter(Appointment.doctor_id == current_user.id)
+    else:
+        own = own.filter(Appointment.patient_id == current_user.id)
+    return query.filter(Treatment.appointment_id.in_(own))
+
+
+# ---------------- RESOURCES ---------------- #
+# fields:   columns a client may select
+# default:  fields returned when ?fields is absent
+# include:  include name -> (relationship on the model, resource used to render it)
+# filters:  query-string parameter -> function(query, value)
+# hidden:   role -> fields that role may not select (optional)
+
+USER_FIELDS = ('id', 'name', 'email', 'phone', 'role', 'department_id', 'is_active', 'created_at')
+
+RESOURCES = {
+    'users': {
+        'model': User,
+        'fields': USER_FIELDS,
+        'default': ('id', 'name', 'role'),
+        'include': {'department': ('department', 'departments')},
+        'filters': {
+            'role': lambda q, v: q.filter(User.role == v),
+            'q': lambda q, v: q.filter(User.name.ilike(f'%{v}%')),
+        },
+        'scope': _scope_users,
+    },
+    'doctors': {
+        'model': User,
+        'fields': USER_FIELDS,
+        'default': ('id', 'name', 'department_id'),
+        'include': {'department': ('department', 'departments')},
+        'filters': {
+            'department_id': lambda q, v: q.filter(User.department_id == int(v)),
+            'q': lambda q, v: q.filter(User.name.ilike(f'%{v}%')),
+        },
+        'scope': _scope_doctors,
+        # Patients list every doctor; contact details stay with staff
+        'hidden': {'patient': ('email', 'phone')},
+    },
+    'departments': {
+        'model': Department,
+        'fields': ('id', 'name', 'description'),
+        'default': ('id', 'name', 'description'),
+        'include': {},
+        'filters': {},
+        'scope': lambda q: q,
+    },
+    'availability': {
+        'model': DoctorAvailability,
+        'fields': ('id', 'doctor_id', 'date', 'start_time', 'end_time'),
+        'default': ('id', 'doctor_id', 'date', 'start_time', 'end_time'),
+        'include': {'doctor': ('doctor', 'doctors')},
+        'filters': {
+            'doctor_id': lambda q, v: q.filter(DoctorAvailability.doctor_id == int(v)),
+            'date_from': lambda q, v: q.filter(DoctorAvailability.date >= _parse_date(v)),
+            'date_to': lambda q, v: q.filter(DoctorAvailability.date <= _parse_date(v)),
+        },
+        'scope': _scope_availability,
+    },
+    'appointments': {
+        'model': Appointment,
+        'fields': ('id', 'patient_id', 'doctor_id', 'date', 'time', 'status', 'created_at'),
+        'default': ('id', 'patient_id', 'doctor_id', 'date', 'time', 'status'),
+        'include': {
+            'doctor': ('doctor', 'doctors'),
+            'patient': ('patient', 'users'),
+            'treatment': ('treatment', 'treatments'),
+        },
+        'filters': {
+            'status': lambda q, v: q.filter(Appointment.status == v),
+            'doctor_id': lambda q, v: q.filter(Appointment.doctor_id == int(v)),
+            'patient_id': lambda q, v: q.filter(Appointment.patient_id == int(v)),
+            'date_from': lambda q, v: q.filter(Appointment.date >= _parse_date(v)),
+            'date_to': lambda q, v: q.filter(Appointment.date <= _parse_date(v)),
+        },
+        'scope': _scope_appointments,
+    },
+    'treatments': {
+        'model': Treatment,
+        'fields': ('id', 'appointment_id', 'diagnosis', 'prescription', 'notes', 'created_at'),
+        'default': ('id', 'appointment_id', 'diagnosis', 'prescription', 'notes'),
+        'include': {'appointment': ('appointment', 'appointments')},
+        'filters': {
+            'appointment_id': lambda q, v: q.filter(Treatment.appointment_id == int(v)),
+        },
+        'scope': _scope_treatments,
+    },
+}
+
+
+def _value(value):
+    if isinstance(value, (date, time, datetime)):
+        return value.isoformat()
+    return value
+
+
+def serialize(obj, resource, fields, includes=()):
+    spec = RESOURCES[resource]
+    data = {f: _value(getattr(obj, f)) for f in fields}
+    for name in includes:
+        relationship, target = spec['include'][name]
+        related = getattr(obj, relationship)
+        data[name] = serialize(related, target, RESOURCES[target]['default']) if related is not None else None
+    return data
+
+
+def _selection(spec, args):
+    fields = args.get('fields')
+    fields = tuple(f for f in fields.split(',') if f) if fields else spec['default']
+    hidden = spec.get('hidden', {}).get(current_user.role, ())
+    unknown = [f for f in fields if f not in spec['fields'] or f in hidden]
+    if unknown:
+        raise ApiError(400, f"unknown fields: {', '.join(unknown)}")
+    if 'id' not in fields:
+        fields = ('id',) + fields  # needed for cursors and client-side merging
+
+    includes = tuple(i for i in args.get('include', '').split(',') if i)
+    unknown = [i for i in includes if i not in spec['include']]
+    if unknown:
+        raise ApiError(400, f"unknown include: {', '.join(unknown)}")
+    return fields, includes
+
+
+def _base_query(spec, includes):
+    model = spec['model']
+    query = model.query
+    for name in includes:
+        query = query.options(joinedload(getattr(model, spec['include'][name][0])))
+    return spec['scope'](query)
+
+
+def list_resource(resource, args):
+    spec = RESOURCES.get(resource)
+    if spec is None:
+        raise ApiError(404, f"unknown resource '{resource}'")
+    model = spec['model']
+    fields, includes = _selection(spec, args)
+
+    query = _base_query(spec, includes)
+    for param, apply_filter in spec['filters'].items():
+        if args.get(param):
+            try:
+                query = apply_filter(query, args[param])
+            except ValueError:
+                raise ApiError(400, f"invalid value for '{param}'")
+
+    # Keyset paging on the primary key: stable and O(page) at any depth
+    cursor = args.get('cursor')
+    if cursor:
+        if not cursor.isdigit():
+            raise ApiError(400, "invalid cursor")
+        query = query.filter(model.id > int(cursor))
+
+    limit = max(1, min(args.get('limit', DEFAULT_LIMIT, type=int), MAX_LIMIT))
+    rows = query.order_by(model.id).limit(limit + 1).all()
+
+    next_cursor = str(rows[limit - 1].id) if len(rows) > limit else None
+    return {
+        'data': [serialize(r, resource, fields, includes) for r in rows[:limit]],
+        'next_cursor': next_cursor
+    }
+
+
+def get_resource(resource, item_id, args):
+    spec = RESOURCES.get(resource)
+    if spec is None:
+        raise ApiError(404, f"unknown resource '{resource}'")
+    fields, includes = _selection(spec, args)
+    obj = _base_query(spec, includes).filter(spec['model'].id == item_id).first()
+    if obj is None:
+        raise ApiError(404, "not found")
+    return {'data': serialize(obj, resource, fields, includes)}
+
+
+def dispatch(path, args):
+    """Resolve an /api/v1/<resource>[/<id>] path. Used by the batch endpoint."""
+    parts = [p for p in path[len(API_PREFIX):].split('/') if p] if path.startswith(API_PREFIX + '/') else []
+    if len(parts) == 1:
+        return list_resource(parts[0], args)
+    if len(parts) == 2 and parts[1].isdigit():
+        return get_resource(parts[0], int(parts[1]), args)
+    raise ApiError(404, f"unknown path '{path}'")
+
+
+def init_api(app):
+
+    @app.errorhandler(ApiError)
+    def handle_api_error(e):
+        return jsonify({'error': e.message}), e.status
+
+    @app.before_request
+    def api_require_login():
+        # JSON clients get 401 instead of the login page redirect
+        if request.path.startswith(API_PREFIX + '/') and not current_user.is_authenticated:
+            return jsonify({'error': 'Authentication required'}), 401
+        return None
+
+    @app.route(API_PREFIX + '/<resource>')
+    def api_list(resource):
+        return jsonify(list_resource(resource, request.args))
+
+    @app.route(API_PREFIX + '/<resource>/<int:item_id>')
+    def api_get(resource, item_id):
+        return jsonify(get_resource(resource, item_id, request.args))
+
+    @app.route(API_PREFIX + '/batch', methods=['POST'])
+    def api_batch():
+        payload = request.get_json(silent=True) or {}
+        requests_ = payload.get('requests')
+        if not isinstance(requests_, list) or not requests_:
+            raise ApiError(400, "body must be {'requests': [{'id': ..., 'path': ...}, ...]}")
+        if len(requests_) > MAX_BATCH:
+            raise ApiError(400, f"at most {MAX_BATCH} requests per batch")
+
+        responses = []
+        for item in requests_:
+            url = urlsplit(str(item.get('path', '')))
+            args = MultiDict(parse_qsl(url.query, keep_blank_values=True))
+            try:
+                body, status = dispatch(url.path, args), 200
+            except ApiError as e:
+                body, status = {'error': e.message}, e.status
+            responses.append({'id': item.get('id'), 'status': status, 'body': body})
+
+        return jsonify({'responses': responses})
+
@@ -0,0 +1,157 @@
+"""
+Hot/cold archival of closed appointments.
+
+Completed, Cancelled and Missed appointments older than ARCHIVE_AFTER_DAYS
+(and their treatments) are moved from `appointments`/`treatments` into
+`appointments_archive`/`treatments_archive`, ARCHIVE_BATCH_SIZE rows per
+transaction, so the write lock is held briefly and dashboards keep querying
+small hot tables. Moved rows leave sync tombstones, and the hot tables use
+AUTOINCREMENT so an archived id is never handed out again.
+
+History, reports, search and analytics read through the helpers below, which
+look in both places, so archived records stay visible there.
+"""
+import time as _time
+from datetime import date, datetime, timedelta
+
+import click
+from flask import current_app, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy import func, insert, select, delete
+
+from .models import (db, Appointment, Treatment, ArchivedAppointment, ArchivedTreatment,
+                     NoShowScore, WalkIn)
+from .sync import next_version, tombstone_where
+
+CLOSED_STATUSES = ('Completed', 'Cancelled', 'Missed')
+
+APPOINTMENT_COLUMNS = ('id', 'patient_id', 'doctor_id', 'date', 'time', 'status', 'created_at')
+TREATMENT_COLUMNS = ('id', 'appointment_id', 'diagnosis', 'prescription', 'notes', 'created_at')
+
+
+def _move_batch(ids, now):
+    """Copy one batch into the archive tables, then delete it from the hot ones."""
+    appt_cols = [getattr(Appointment, c) for c in APPOINTMENT_COLUMNS]
+    treat_cols = [getattr(Treatment, c) for c in TREATMENT_COLUMNS]
+
+    db.session.execute(
+        insert(ArchivedAppointment).from_select(
+            list(APPOINTMENT_COLUMNS) + ['archived_at'],
+            select(*appt_cols, db.literal(now)).where(Appointment.id.in_(ids))
+        )
+    )
+    db.session.execute(
+        insert(ArchivedTreatment).from_select(
+            list(TREATMENT_COLUMNS),
+            select(*treat_cols).where(Treatment.appointment_id.in_(ids))
+        )
+    )
+    # Synced clients drop their copies; the archive is not part of the sync feed
+    version = next_version()
+    tombstone_where(Treatment, [Treatment.appointment_id.in_(ids)], version)
+    tombstone_where(Appointment, [Appointment.id.in_(ids)], version)
+
+    # Treatments first: the FTS delete trigger skips rows already in the archive
+    db.session.execute(delete(Treatment).where(Treatment.appointment_id.in_(ids)))
+    db.session.execute(delete(Appointment).where(Appointment.id.in_(ids)))
+    # Rows keyed on the hot appointment: scores only matter for upcoming
+    # bookings, and assigned walk-ins are only shown on the day
+    db.session.execute(delete(NoShowScore).where(NoShowScore.appointment_id.in_(ids)))
+    db.session.execute(delete(WalkIn).where(WalkIn.appointment_id.in_(ids)))
+
+
+def archive_closed(older_than_days=None, batch_size=None, max_batches=None, pause=None):
+    """
+    Move closed appointments older than the cutoff into the archive.
+    Returns the number of appointments moved.
+    """
+    config = current_app.config
+    older_than_days = older_than_days if older_than_days is not None else config['ARCHIVE_AFTER_DAYS']
+    batch_size = batch_size or config['ARCHIVE_BATCH_SIZE']
+    pause = pause if pause is not None else config['ARCHIVE_BATCH_PAUSE']
+
+    cutoff = date.today() - timedelta(days=older_than_days)
+    moved = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        ids = [
+            row.id for row in
+            db.session.query(Appointment.id)
+            .filter(Appointment.status.in_(CLOSED_STATUSES), Appointment.date < cutoff)
+            .order_by(Appointment.id)
+            .limit(batch_size)
+        ]
+        if not ids:
+            break
+
+        try:
+            _move_batch(ids, datetime.utcnow())
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        moved += len(ids)
+        batches += 1
+        # Give waiting writers a turn at the database lock between batches
+        if pause:
+            _time.sleep(pause)
+
+    return moved
+
+
+# ---------------- READ HELPERS (hot + cold) ---------------- #
+
+def find_appointment(appointment_id):
+    return Appointment.query.get(appointment_id) or ArchivedAppointment.query.get(appointment_id)
+
+
+def find_treatment(treatment_id):
+    return Treatment.query.get(treatment_id) or ArchivedTreatment.query.get(treatment_id)
+
+
+def status_counts(doctor_id=None, patient_id=None):
+    """Appointment counts per status across hot and archived rows."""
+    totals = {}
+    for model in (Appointment, ArchivedAppointment):
+        query = db.session.query(model.status, func.count(model.id))
+        if doctor_id:
+            query = query.filter(model.doctor_id == doctor_id)
+        if patient_id:
+            query = query.filter(model.patient_id == patient_id)
+        for status, count in query.group_by(model.status):
+            totals[status] = totals.get(status, 0) + count
+    return totals
+
+
+def archive_stats():
+    return {
+        "hot_appointments": db.session.query(func.count(Appointment.id)).scalar(),
+        "archived_appointments": db.session.query(func.count(ArchivedAppointment.id)).scalar(),
+        "hot_treatments": db.session.query(func.count(Treatment.id)).scalar(),
+        "archived_treatments": db.session.query(func.count(ArchivedTreatment.id)).scalar(),
+    }
+
+
+def init_archive(app):
+    app.config.setdefault('ARCHIVE_AFTER_DAYS', 180)    # closed appointments older than this move to the archive
+    app.config.setdefault('ARCHIVE_BATCH_SIZE', 500)    # rows moved per transaction
+    app.config.setdefault('ARCHIVE_BATCH_PAUSE', 0.05)  # seconds between batches
+
+    @app.cli.command('archive-closed')
+    @click.option('--days', type=int, default=None, help='Archive closed appointments older than this many days.')
+    @click.option('--batch-size', type=int, default=None)
+    @click.option('--max-batches', type=int, default=None, help='Stop after this many batches.')
+    def archive_closed_command(days, batch_size, max_batches):
+        """Move old Completed/Cancelled/Missed appointments into the archive tables."""
+        moved = archive_closed(days, batch_size, max_batches)
+        click.echo(f"Archived {moved} appointments.")
+        click.echo(archive_stats())
+
+    @app.route('/admin/archive_stats')
+    @login_required
+    def admin_archive_stats():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+        return jsonify(archive_stats())
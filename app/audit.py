@@ -0,0 +1,437 @@
+"""
+Audit log: who changed what, with the values before and after.
+
+Entries are captured from SQLAlchemy events rather than in each handler:
+
+    after_flush     one entry per inserted, updated or deleted row of an
+                    AUDITED model, holding the changed columns
+    do_orm_execute  for a set-based UPDATE/DELETE on an audited table (bulk
+                    tools), one summary entry with the statement, its
+                    parameters and row count, plus one entry per affected
+                    row holding only the summary's uid; the ids are selected
+                    with the statement's WHERE clause just before it runs
+    after_commit    hands the session's entries to the process buffer; a
+                    rollback drops them, so only committed changes are kept
+
+A background thread writes the buffer to the append-only `audit_log` table
+in batches (AUDIT_BATCH_SIZE rows or every AUDIT_FLUSH_INTERVAL seconds),
+one INSERT for many requests instead of an extra write in each of them.
+AUDIT_DURABILITY sets what a crash can lose:
+
+    buffered  entries wait in memory; up to AUDIT_FLUSH_INTERVAL seconds
+    journal   entries are also appended to a segment file in
+              AUDIT_JOURNAL_DIR at commit (fsync'd unless AUDIT_FSYNC is
+              off); segments left by a dead process are replayed
+    sync      entries are inserted in the same transaction as the change
+
+GET /admin/audit_log searches the table for admins.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+from flask import current_app, g, request, jsonify, has_app_context, has_request_context
+from flask_login import login_required, current_user
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .models import db, User, Department, Appointment, Treatment, DoctorAvailability, AuditEntry
+from .tenancy import current_tenant, tenant_context
+
+AUDITED = (User, Department, Appointment, Treatment, DoctorAvailability)
+AUDITED_TABLES = {model.__tablename__ for model in AUDITED}
+IGNORED_FIELDS = {'version'}          # sync bookkeeping, changes on every write
+REDACTED_FIELDS = {'password_hash'}
+DURABILITY = ('buffered', 'journal', 'sync')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+APPEND_ONLY_TRIGGERS = {
+    'audit_log_no_update': """
+        CREATE TRIGGER audit_log_no_update BEFORE UPDATE ON audit_log
+        BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END
+    """,
+    'audit_log_no_delete': """
+        CREATE TRIGGER audit_log_no_delete BEFORE DELETE ON audit_log
+        BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END
+    """,
+}
+
+
+def ensure_audit_log():
+    """(Re)create the triggers that keep audit_log append-only."""
+    for name, ddl in APPEND_ONLY_TRIGGERS.items():
+        db.session.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        db.session.execute(text(ddl))
+    db.session.commit()
+
+
+# ---------------- CAPTURE ---------------- #
+
+def _value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def _changes(state, action):
+    """{column: [before, after]} for one flushed object."""
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        key = attr.key
+        if key in IGNORED_FIELDS:
+            continue
+        if action == 'update':
+            history = state.attrs[key].history
+            if not history.has_changes():
+                continue
+            # `before` is None when the old value was never loaded
+            before = history.deleted[0] if history.deleted else None
+            after = history.added[0] if history.added else None
+        elif action == 'create':
+            before, after = None, state.dict.get(key)
+            if after is None:
+                continue
+        else:
+            before, after = state.dict.get(key), None
+        if key in REDACTED_FIELDS:
+            before, after = before and '***', after and '***'
+        changes[key] = [_value(before), _value(after)]
+    return changes
+
+
+def _actor():
+    """(actor_id, origin, ip) of the code making the change."""
+    if not has_request_context():
+        return None, g.get('audit_origin', 'system'), None
+    # The user Flask-Login already loaded for this request; never load one mid-flush
+    user = g.get('_login_user')
+    actor_id = inspect(user).identity[0] if isinstance(user, User) and inspect(user).identity else None
+    return actor_id, request.endpoint, request.remote_addr
+
+
+def _entry(actor, action, entity, entity_id, changes):
+    actor_id, origin, ip = actor
+    return {
+        'uid': uuid.uuid4().hex,
+        'created_at': datetime.utcnow(),
+        'actor_id': actor_id,
+        'origin': origin,
+        'ip': ip,
+        'action': action,
+        'entity': entity,
+        'entity_id': entity_id,
+        'changes': json.dumps(changes, default=str),
+    }
+
+
+def _record(session, entries):
+    if current_app.config['AUDIT_DURABILITY'] == 'sync':
+        session.connection().execute(sqlite_insert(AuditEntry), entries)
+    else:
+        session.info.setdefault('audit', []).extend(entries)
+
+
+def _enabled():
+    return has_app_context() and 'audit' in current_app.extensions
+
+
+@event.listens_for(Session, 'after_flush')
+def capture_flush(session, flush_context):
+    if not _enabled():
+        return
+    entries = []
+    actor = None
+    for action, objects in (('create', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            if not isinstance(obj, AUDITED):
+                continue
+            state = inspect(obj)
+            changes = _changes(state, action)
+            if not changes:
+                continue
+            actor = actor or _actor()
+            # New rows are not in the identity map yet, but their key is set
+            entity_id = state.mapper.primary_key_from_instance(obj)[0]
+            entries.append(_entry(actor, action, obj.__tablename__, entity_id, changes))
+    if entries:
+        _record(session, entries)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def capture_bulk(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete) or not _enabled():
+        return None
+    statement = orm_execute_state.statement
+    table = getattr(statement, 'table', None)
+    if getattr(table, 'name', None) not in AUDITED_TABLES:
+        return None
+
+    # The rows the statement is about to touch, so each gets an entry searchable by entity_id
+    pk = list(table.primary_key.columns)[0]
+    ids = select(pk)
+    if statement.whereclause is not None:
+        ids = ids.where(statement.whereclause)
+    ids = orm_execute_state.session.execute(ids).scalars().all()
+
+    result = orm_execute_state.invoke_statement()
+    if not ids:
+        return result
+    compiled = statement.compile()
+    changes = {
+        'statement': str(compiled),
+        'params': {k: _value(v) if not isinstance(v, (list, tuple)) else [_value(i) for i in v]
+                   for k, v in compiled.params.items()},
+        'rows': getattr(result, 'rowcount', None),
+    }
+    action = 'bulk_update' if orm_execute_state.is_update else 'bulk_delete'
+    actor = _actor()
+    # The statement is stored once; its IN (...) lists can be as long as the batch
+    summary = _entry(actor, action, table.name, None, changes)
+    row_changes = {'statement': summary['uid']}
+    _record(orm_execute_state.session,
+            [summary] + [_entry(actor, action, table.name, id_, row_changes) for id_ in ids])
+    return result
+
+
+@event.listens_for(Session, 'after_commit')
+def hand_over(session):
+    entries = session.info.pop('audit', None)
+    if entries and _enabled():
+        current_app.extensions['audit'].add(current_tenant(), entries)
+
+
+@event.listens_for(Session, 'after_rollback')
+def drop_uncommitted(session):
+    session.info.pop('audit', None)
+
+
+# ---------------- BUFFER ---------------- #
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AuditBuffer:
+    """Per-process buffer of committed entries, written out by one background thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()          # buffer and journal
+        self._flush_lock = threading.Lock()    # one flush at a time
+        self._wake = threading.Event()
+        self._pid = None
+        self.stats = {'written': 0, 'failed_flushes': 0, 'replayed': 0}
+
+    def add(self, tenant, entries):
+        config = self.app.config
+        with self._lock:
+            # Threads do not survive fork(): start lazily, once per process
+            if self._pid != os.getpid():
+                self._start()
+            if config['AUDIT_DURABILITY'] == 'journal':
+                self._append_journal(tenant, entries)
+            self._pending.setdefault(tenant, []).extend(entries)
+            self._size += len(entries)
+            full = self._size >= config['AUDIT_BATCH_SIZE']
+        if full:
+            self._wake.set()
+
+    def pending(self):
+        return self._size if self._pid == os.getpid() else 0
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._pending = {}        # tenant -> entries not yet in audit_log
+        self._size = 0
+        self._journal = None      # open segment file
+        self._segments = []       # closed segments whose entries are not in audit_log yet
+        self._seq = 0
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="audit-log", daemon=True).start()
+
+    def _run(self):
+        try:
+            self._replay()
+        except Exception as e:
+            self.app.logger.warning("audit log replay: %s", e)
+        while True:
+            self._wake.wait(self.app.config['AUDIT_FLUSH_INTERVAL'])
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered so far. Returns the number of entries written."""
+        if self._pid != os.getpid():
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending, self._size = self._pending, {}, 0
+                if self._journal is not None:
+                    self._journal.close()
+                    self._segments.append(self._journal.name)
+                    self._journal = None
+                segments = list(self._segments)
+
+            failed = {}
+            for tenant, entries in pending.items():
+                try:
+                    self._write(tenant, entries)
+                except Exception as e:
+                    self.app.logger.warning("audit log flush (%s): %s", tenant or 'default', e)
+                    failed[tenant] = entries
+
+            with self._lock:
+                for tenant, entries in failed.items():
+                    self._pending[tenant] = entries + self._pending.get(tenant, [])
+                    self._size += len(entries)
+                if failed:
+                    self.stats['failed_flushes'] += 1
+                else:
+                    # Everything in these segments is in the table now
+                    for path in segments:
+                        os.remove(path)
+                        self._segments.remove(path)
+            written = sum(len(e) for t, e in pending.items() if t not in failed)
+            self.stats['written'] += written
+            return written
+
+    def _write(self, tenant, entries):
+        with tenant_context(self.app, tenant):
+            db.session.execute(
+                sqlite_insert(AuditEntry).on_conflict_do_nothing(index_elements=['uid']), entries
+            )
+            db.session.commit()
+
+    # ---- journal segments ----
+
+    def _append_journal(self, tenant, entries):
+        if self._journal is None:
+            directory = self.app.config['AUDIT_JOURNAL_DIR']
+            os.makedirs(directory, exist_ok=True)
+            self._seq += 1
+            path = os.path.join(directory, f"audit-{self._pid}-{self._seq:06d}.jsonl")
+            self._journal = open(path, 'a', encoding='utf-8')
+        self._journal.write(''.join(
+            json.dumps(dict(e, tenant=tenant, created_at=e['created_at'].isoformat())) + '\n'
+            for e in entries
+        ))
+        self._journal.flush()
+        if self.app.config['AUDIT_FSYNC']:
+            os.fsync(self._journal.fileno())
+
+    def _replay(self):
+        """Write out segments left behind by processes that died before flushing them."""
+        for path in sorted(glob.glob(os.path.join(self.app.config['AUDIT_JOURNAL_DIR'], 'audit-*.jsonl'))):
+            pid = int(os.path.basename(path).split('-')[1])
+            if pid == os.getpid() or _alive(pid):
+                continue
+            by_tenant = {}
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue    # torn last line
+                    entry['created_at'] = datetime.fromisoformat(entry['created_at'])
+                    by_tenant.setdefault(entry.pop('tenant'), []).append(entry)
+            # uid is unique, so a segment replayed twice is written once
+            for tenant, entries in by_tenant.items():
+                self._write(tenant, entries)
+                self.stats['replayed'] += len(entries)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# ---------------- QUERY ---------------- #
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def search(args):
+    """Entries matching the query-string filters, newest first, and the cursor for the next page."""
+    query = AuditEntry.query
+    for field in ('entity', 'action', 'origin', 'uid'):
+        if args.get(field):
+            query = query.filter(getattr(AuditEntry, field) == args[field])
+    for field in ('entity_id', 'actor_id'):
+        value = args.get(field, type=int)
+        if value is not None:
+            query = query.filter(getattr(AuditEntry, field) == value)
+    since, until = _parse_time(args.get('since')), _parse_time(args.get('until'))
+    if since:
+        query = query.filter(AuditEntry.created_at >= since)
+    if until:
+        query = query.filter(AuditEntry.created_at < until)
+    before_id = args.get('before_id', type=int)
+    if before_id:
+        query = query.filter(AuditEntry.id < before_id)
+
+    limit = max(1, min(args.get('limit', DEFAULT_LIMIT, type=int), MAX_LIMIT))
+    rows = query.order_by(AuditEntry.id.desc()).limit(limit).all()
+    return rows, (rows[-1].id if len(rows) == limit else None)
+
+
+def init_audit(app):
+    app.config.setdefault('AUDIT_DURABILITY', 'buffered')   # buffered / journal / sync
+    app.config.setdefault('AUDIT_BATCH_SIZE', 200)          # flush early once this many entries wait
+    app.config.setdefault('AUDIT_FLUSH_INTERVAL', 2.0)      # seconds between flushes
+    app.config.setdefault('AUDIT_JOURNAL_DIR', os.path.join(app.instance_path, 'audit'))
+    app.config.setdefault('AUDIT_FSYNC', True)              # journal: fsync every commit
+    if app.config['AUDIT_DURABILITY'] not in DURABILITY:
+        raise ValueError(f"AUDIT_DURABILITY must be one of {', '.join(DURABILITY)}")
+
+    buffer = AuditBuffer(app)
+    app.extensions['audit'] = buffer
+
+    # Best effort on a normal exit; serve.py workers leave through os._exit()
+    atexit.register(buffer.flush)
+    app.extensions.setdefault('worker_exit', []).append(lambda app_: buffer.flush())
+
+    @app.route('/admin/audit_log')
+    @login_required
+    def admin_audit_log():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+        # Entries still buffered in this process become visible right away
+        buffer.flush()
+        try:
+            rows, next_before_id = search(request.args)
+        except ValueError:
+            return jsonify({'error': 'since and until must be ISO dates'}), 400
+        return jsonify({
+            'data': [
+                {
+                    'id': r.id,
+                    'uid': r.uid,
+                    'at': r.created_at.isoformat(timespec='seconds'),
+                    'actor_id': r.actor_id,
+                    'origin': r.origin,
+                    'ip': r.ip,
+                    'action': r.action,
+                    'entity': r.entity,
+                    'entity_id': r.entity_id,
+                    'changes': json.loads(r.changes) if r.changes else {},
+                }
+                for r in rows
+            ],
+            'next_before_id': next_before_id,
+            'pending': buffer.pending(),
+        })
@@ -0,0 +1,284 @@
+"""
+Set-based bulk operations for admins.
+
+Each operation is a handful of UPDATE ... WHERE statements run in ONE
+transaction, whatever the number of rows (a clinic closure cancelling
+thousands of bookings is a single request). Every operation can be
+previewed first: the preview runs the same WHERE clause as a COUNT and
+lists the affected patients.
+"""
+from datetime import datetime
+
+from flask import render_template, request, redirect, url_for, flash
+from flask_login import login_required, current_user
+from sqlalchemy import func, update, exists
+from sqlalchemy.orm import aliased
+
+from .models import db, User, Appointment, Department, DoctorAvailability
+from .events import publish_where
+from .sync import next_version, tombstone_where
+
+# Status changes an admin may apply in bulk (see README: status lifecycle)
+BULK_TRANSITIONS = {
+    'cancel': ('Cancelled', 'cancelled'),
+    'missed': ('Missed', 'missed'),
+}
+
+PREVIEW_PATIENT_LIMIT = 200
+
+
+def future_clause():
+    now = datetime.now()
+    return (Appointment.date > now.date()) | (
+        (Appointment.date == now.date()) & (Appointment.time >= now.time())
+    )
+
+
+def past_clause():
+    now = datetime.now()
+    return (Appointment.date < now.date()) | (
+        (Appointment.date == now.date()) & (Appointment.time < now.time())
+    )
+
+
+def appointment_criteria(form, operation=None):
+    """
+    WHERE clauses for the Booked appointments selected by a bulk form.
+    Only bookings that have already passed can be marked Missed.
+    Returns (clauses, errors).
+    """
+    clauses = [Appointment.status == 'Booked']
+    errors = []
+
+    doctor_id = form.get('doctor_id', type=int)
+    department_id = form.get('department_id', type=int)
+    date_from = form.get('date_from')
+    date_to = form.get('date_to')
+
+    if doctor_id:
+        clauses.append(Appointment.doctor_id == doctor_id)
+    if department_id:
+        dept_doctors = db.session.query(User.id).filter(User.department_id == department_id)
+        clauses.append(Appointment.doctor_id.in_(dept_doctors.scalar_subquery()))
+
+    try:
+        if date_from:
+            clauses.append(Appointment.date >= datetime.strptime(date_from, "%Y-%m-%d").date())
+        if date_to:
+            clauses.append(Appointment.date <= datetime.strptime(date_to, "%Y-%m-%d").date())
+    except ValueError:
+        errors.append("Dates must be in YYYY-MM-DD format.")
+
+    if operation == 'missed':
+        clauses.append(past_clause())
+    elif form.get('future_only'):
+        clauses.append(future_clause())
+
+    if not (doctor_id or department_id or date_from or date_to):
+        errors.append("Choose a doctor, a department or a date range.")
+
+    return clauses, errors
+
+
+def preview(clauses):
+    """How many appointments match, and which patients they belong to."""
+    total = db.session.query(func.count(Appointment.id)).filter(*clauses).scalar()
+
+    patients = (
+        db.session.query(User.id, User.name, User.email, User.phone, func.count(Appointment.id))
+        .join(Appointment, Appointment.patient_id == User.id)
+        .filter(*clauses)
+        .group_by(User.id)
+        .order_by(User.name)
+        .all()
+    )
+
+    return {
+        "appointments": total,
+        "patients": len(patients),
+        "patient_list": patients[:PREVIEW_PATIENT_LIMIT]
+    }
+
+
+def bulk_transition(clauses, operation):
+    """Move every matching appointment to the operation's status."""
+    status, kind = BULK_TRANSITIONS[operation]
+    publish_where(clauses, kind)
+    result = db.session.execute(
+        update(Appointment).where(*clauses).values(status=status, version=next_version())
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def reassign_clauses(clauses, target_doctor_id):
+    """
+    WHERE clauses for a reassignment: (candidates, movable). Candidates are
+    the selected bookings that have not started yet. Movable ones also fall
+    inside one of the target doctor's availability blocks, do not clash with
+    a Booked appointment of the target and are the first of the selection
+    at their date and time (an overbooked slot moves only one booking).
+    """
+    candidates = clauses + [future_clause()]
+
+    Other = aliased(Appointment)
+    clash = exists().where(
+        Other.doctor_id == target_doctor_id,
+        Other.date == Appointment.date,
+        Other.time == Appointment.time,
+        Other.status == 'Booked'
+    )
+    Same = aliased(Appointment)
+    overbooked = exists().where(
+        Same.doctor_id == Appointment.doctor_id,
+        Same.date == Appointment.date,
+        Same.time == Appointment.time,
+        Same.status == 'Booked',
+        Same.id < Appointment.id
+    )
+    available = exists().where(
+        DoctorAvailability.doctor_id == target_doctor_id,
+        DoctorAvailability.date == Appointment.date,
+        DoctorAvailability.start_time <= Appointment.time,
+        DoctorAvailability.end_time > Appointment.time
+    )
+    return candidates, candidates + [available, ~clash, ~overbooked]
+
+
+def reassign_preview(clauses, target_doctor_id):
+    """preview() of the bookings a reassignment would touch, plus how many of them it would skip."""
+    candidates, movable = reassign_clauses(clauses, target_doctor_id)
+    summary = preview(candidates)
+    summary['skipped'] = summary['appointments'] - \
+        db.session.query(func.count(Appointment.id)).filter(*movable).scalar()
+    return summary
+
+
+def bulk_reassign(clauses, target_doctor_id, cancel_skipped=False):
+    """
+    Move the selected future bookings to another doctor (see
+    reassign_clauses). Bookings that cannot move stay with their doctor, or
+    are cancelled when `cancel_skipped` is set. `clauses` must select a
+    single source doctor. Returns (moved, skipped).
+    """
+    candidates, movable = reassign_clauses(clauses, target_doctor_id)
+
+    publish_where(movable, 'reassigned')
+    publish_where(movable, 'booked', doctor_id=target_doctor_id)
+    # The source doctor's synced devices must drop the rows they no longer own
+    version = next_version()
+    tombstone_where(Appointment, movable, version)
+    moved = db.session.execute(
+        update(Appointment).where(*movable).values(doctor_id=target_doctor_id, version=version)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    # What still matches the source selection is exactly the set that was skipped
+    if cancel_skipped:
+        skipped = bulk_transition(candidates, 'cancel')
+    else:
+        skipped = db.session.query(func.count(Appointment.id)).filter(*candidates).scalar()
+
+    return moved, skipped
+
+
+def cancel_future_bookings(doctor_id):
+    """Cancel a doctor's upcoming bookings; used when the doctor is deactivated."""
+    return bulk_transition(
+        [Appointment.status == 'Booked', Appointment.doctor_id == doctor_id, future_clause()],
+        'cancel'
+    )
+
+
+def bulk_set_active(user_ids, active):
+    """Block or unblock many users at once; admins are never touched."""
+    result = db.session.execute(
+        update(User).where(User.id.in_(user_ids), User.role != 'admin').values(is_active=active)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def init_bulk(app):
+
+    @app.route('/admin/bulk/appointments', methods=['GET', 'POST'])
+    @login_required
+    def bulk_appointments():
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        doctors = User.query.filter_by(role='doctor').order_by(User.name).all()
+        departments = Department.query.all()
+        summary = None
+
+        if request.method == 'POST':
+            operation = request.form.get('operation')
+            target_doctor_id = request.form.get('target_doctor_id', type=int)
+            clauses, errors = appointment_criteria(request.form, operation)
+
+            if operation not in BULK_TRANSITIONS and operation != 'reassign':
+                errors.append("Unknown operation.")
+            if operation == 'reassign':
+                target = User.query.get(target_doctor_id) if target_doctor_id else None
+                if not request.form.get('doctor_id', type=int):
+                    errors.append("Reassigning needs a single source doctor.")
+                if not target or target.role != 'doctor' or not target.is_active:
+                    errors.append("Choose an active doctor to reassign to.")
+                elif target.id == request.form.get('doctor_id', type=int):
+                    errors.append("Source and target doctor are the same.")
+
+            if errors:
+                for e in errors:
+                    flash(e, 'danger')
+            elif not request.form.get('confirm'):
+                if operation == 'reassign':
+                    summary = reassign_preview(clauses, target_doctor_id)
+                else:
+                    summary = preview(clauses)
+            else:
+                try:
+                    if operation == 'reassign':
+                        moved, skipped = bulk_reassign(
+                            clauses, target_doctor_id, bool(request.form.get('cancel_conflicts'))
+                        )
+                        message = f"{moved} appointments reassigned, {skipped} skipped (clash or outside the " \
+                                  "new doctor's availability) " + \
+                                  ("and cancelled." if request.form.get('cancel_conflicts') else "and left in place.")
+                    else:
+                        changed = bulk_transition(clauses, operation)
+                        message = f"{changed} appointments marked {BULK_TRANSITIONS[operation][0]}."
+                    db.session.commit()
+                    flash(message, 'success')
+                except Exception as e:
+                    db.session.rollback()
+                    flash(f"Bulk operation failed, nothing was changed: {e}", 'danger')
+                return redirect(url_for('bulk_appointments'))
+
+        return render_template(
+            'admin_bulk.html',
+            doctors=doctors,
+            departments=departments,
+            form=request.form,
+            summary=summary
+        )
+
+    @app.route('/admin/bulk/users', methods=['POST'])
+    @login_required
+    def bulk_users():
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        user_ids = [int(i) for i in request.form.getlist('user_ids') if i.isdigit()]
+        active = request.form.get('action') == 'unblock'
+
+        if not user_ids:
+            flash('No users selected.', 'warning')
+            return redirect(url_for('manage_users'))
+
+        changed = bulk_set_active(user_ids, active)
+        db.session.commit()
+
+        flash(f"{changed} users {'unblocked' if active else 'blocked'}.", 'info')
+        return redirect(url_for('manage_users'))
@@ -0,0 +1,251 @@
+"""
+Live appointment feed (server-sent events) for the admin and doctor dashboards.
+
+Handlers call publish() before their own commit, so an event row is only
+written when the change itself is committed. Each worker process runs ONE
+background poller thread that reads new rows from `appointment_events` and
+fans them out to the SSE connections held by that worker. Because the rows
+live in the shared database, a booking handled by one worker reaches
+dashboards connected to any other worker. With TENANT_MODE each clinic has
+its own event table: the poller keeps a cursor per tenant, reads only the
+clinics that have open feeds, and a feed only gets its own clinic's events.
+
+Each open feed waits in a blocking queue read. Under the threaded server
+that costs one thread per connection; for many idle dashboards run
+`python serve.py --worker-class gevent`, where it costs one greenlet.
+"""
+import json
+import os
+import queue
+import threading
+import time as _time
+from datetime import datetime, timedelta
+
+from flask import Response, request, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy import insert, select, literal
+from sqlalchemy.orm import aliased
+
+from .models import db, User, Appointment, AppointmentEvent
+from .tenancy import current_tenant, tenant_context
+
+
+def publish(appt, kind):
+    """Queue a change event for `appt` in the current transaction."""
+    if appt.id is None:
+        db.session.flush()
+    db.session.add(AppointmentEvent(
+        appointment_id=appt.id,
+        doctor_id=appt.doctor_id,
+        patient_id=appt.patient_id,
+        kind=kind
+    ))
+
+
+def publish_where(clauses, kind, doctor_id=None):
+    """
+    Write one event per appointment matching `clauses`, in a single
+    INSERT ... SELECT in the current transaction. Used by bulk operations before they run their UPDATE.
+    """
+    db.session.execute(
+        insert(AppointmentEvent).from_select(
+            ['appointment_id', 'doctor_id', 'patient_id', 'kind', 'created_at'],
+            select(
+                Appointment.id,
+                literal(doctor_id) if doctor_id is not None else Appointment.doctor_id,
+                Appointment.patient_id,
+                literal(kind),
+                literal(datetime.utcnow())
+            ).where(*clauses)
+        )
+    )
+
+
+def load_events(after_id, doctor_id=None, limit=500):
+    """Events newer than `after_id`, joined with the names the dashboards show."""
+    Doctor = aliased(User)
+    Patient = aliased(User)
+
+    query = (
+        db.session.query(AppointmentEvent, Appointment, Doctor.name, Patient.name)
+        .outerjoin(Appointment, Appointment.id == AppointmentEvent.appointment_id)
+        .outerjoin(Doctor, Doctor.id == AppointmentEvent.doctor_id)
+        .outerjoin(Patient, Patient.id == AppointmentEvent.patient_id)
+        .filter(AppointmentEvent.id > after_id)
+    )
+    if doctor_id is not None:
+        query = query.filter(AppointmentEvent.doctor_id == doctor_id)
+
+    events = []
+    for ev, appt, doctor_name, patient_name in query.order_by(AppointmentEvent.id).limit(limit):
+        events.append({
+            "id": ev.id,
+            "kind": ev.kind,
+            "appointment_id": ev.appointment_id,
+            "doctor_id": ev.doctor_id,
+            "doctor": doctor_name,
+            "patient": patient_name,
+            "date": appt.date.strftime("%Y-%m-%d") if appt else None,
+            "time": appt.time.strftime("%H:%M") if appt else None,
+            "status": appt.status if appt else None
+        })
+    return events
+
+
+class EventBroker:
+    """Per-process fan-out of appointment events to connected SSE clients, per tenant."""
+
+    def __init__(self, app):
+        self.app = app
+        self._subscribers = {}      # tenant -> set of queues
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last_id = {}          # tenant -> newest event id read
+        self._last_prune = {}       # tenant -> monotonic time of the last prune
+
+    def subscribe(self, tenant=None):
+        """Queue receiving the events of `tenant`. Call inside that tenant's context."""
+        q = queue.Queue(maxsize=self.app.config['EVENT_QUEUE_SIZE'])
+        with self._lock:
+            # Threads do not survive fork(): start the poller lazily, once per process
+            if self._pid != os.getpid():
+                self._start()
+            if not self._subscribers.get(tenant):
+                # Nothing is polled while nobody listens: start from the newest
+                # event instead of replaying everything since the last listener
+                self._last_id[tenant] = db.session.query(db.func.max(AppointmentEvent.id)).scalar() or 0
+            self._subscribers.setdefault(tenant, set()).add(q)
+        return q
+
+    def unsubscribe(self, q, tenant=None):
+        with self._lock:
+            subscribers = self._subscribers.get(tenant)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[tenant]
+
+    def stats(self, tenant=None):
+        return {"pid": os.getpid(), "subscribers": len(self._subscribers.get(tenant, ())),
+                "last_event_id": self._last_id.get(tenant, 0)}
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._subscribers = {}
+        self._last_id = {}
+        thread = threading.Thread(target=self._run, name="appointment-events", daemon=True)
+        thread.start()
+
+    def _run(self):
+        interval = self.app.config['EVENT_POLL_INTERVAL']
+        while True:
+            _time.sleep(interval)
+            with self._lock:
+                tenants = list(self._subscribers)
+            for tenant in tenants:
+                self._poll(tenant)
+
+    def _poll(self, tenant):
+        try:
+            with tenant_context(self.app, tenant):
+                events = load_events(self._last_id.get(tenant, 0))
+                self._prune(tenant)
+        except Exception as e:
+            self.app.logger.warning("event poller (%s): %s", tenant or 'default', e)
+            return
+
+        if not events:
+            return
+        with self._lock:
+            self._last_id[tenant] = max(self._last_id.get(tenant, 0), events[-1]["id"])
+            subscribers = list(self._subscribers.get(tenant, ()))
+        for q in subscribers:
+            for ev in events:
+                try:
+                    q.put_nowait(ev)
+                except queue.Full:
+                    # Client is not reading; drop it, the browser reconnects
+                    # with Last-Event-ID and replays from the table.
+                    self.unsubscribe(q, tenant)
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+                    q.put_nowait(None)   # tells the stream to close
+                    break
+
+    def _prune(self, tenant):
+        now = _time.monotonic()
+        if now - self._last_prune.get(tenant, 0.0) < 300:
+            return
+        self._last_prune[tenant] = now
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['EVENT_RETENTION'])
+        AppointmentEvent.query.filter(AppointmentEvent.created_at < cutoff).delete()
+        db.session.commit()
+
+
+def _format(ev):
+    return f"id: {ev['id']}\nevent: appointment\ndata: {json.dumps(ev)}\n\n"
+
+
+def init_events(app):
+    app.config.setdefault('EVENT_POLL_INTERVAL', 1.0)   # seconds between event table polls
+    app.config.setdefault('EVENT_HEARTBEAT', 15)        # seconds between keep-alive comments
+    app.config.setdefault('EVENT_QUEUE_SIZE', 1000)     # buffered events per connection
+    app.config.setdefault('EVENT_RETENTION', 86400)     # seconds events stay replayable
+
+    broker = EventBroker(app)
+    app.extensions['event_broker'] = broker
+
+    @app.route('/events/appointments')
+    @login_required
+    def appointment_events():
+        if current_user.role not in ('admin', 'doctor'):
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        doctor_id = current_user.id if current_user.role == 'doctor' else None
+
+        # Subscribe before reading the backlog so nothing committed in between is
+        # lost; events in both are sent once (the stream skips ids it has seen)
+        tenant = current_tenant()
+        q = broker.subscribe(tenant)
+
+        # Reconnecting browsers send the last id they saw; replay what they missed
+        last_id = request.headers.get('Last-Event-ID', type=int)
+        try:
+            backlog = load_events(last_id, doctor_id) if last_id is not None else []
+        except Exception:
+            broker.unsubscribe(q, tenant)
+            raise
+        heartbeat = app.config['EVENT_HEARTBEAT']
+
+        def stream():
+            try:
+                yield "retry: 3000\n\n"
+                seen = last_id or 0
+                for ev in backlog:
+                    seen = ev["id"]
+                    yield _format(ev)
+                while True:
+                    try:
+                        ev = q.get(timeout=heartbeat)
+                    except queue.Empty:
+                        yield ": keep-alive\n\n"
+                        continue
+                    if ev is None:
+                        return
+                    if ev["id"] <= seen or (doctor_id is not None and ev["doctor_id"] != doctor_id):
+                        continue
+                    yield _format(ev)
+            finally:
+                broker.unsubscribe(q, tenant)
+
+        return Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @app.route('/admin/events_stats')
+    @login_required
+    def events_stats():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+        return jsonify(broker.stats(current_tenant()))
@@ -0,0 +1,223 @@
+"""
+Doctor finder: server-side, paged doctor search with facet counts.
+
+Facets:
+    q             name prefix; every word must start a word of the name
+    department    department id, with a per-department count of matches
+    available_on  the doctor has an availability block on that date
+    within        the doctor has a free (unbooked, not yet past) slot in
+                  the next N days
+
+The roster of active doctors and the department names are cached per
+process (and tenant) for FINDER_ROSTER_TTL seconds, together with a sorted
+name-word list, so the name and department facets are a bisect and a few
+set operations. Admin edits to doctors drop the cache of the process that
+made them; other processes catch up within the TTL. The date facets are indexed reads on doctor_availability
+and appointments, limited to the doctors still in the running. Only one
+page of doctors goes to the browser.
+"""
+import math
+import re
+import threading
+import time as _time
+from bisect import bisect_left
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from flask import current_app, request, jsonify
+from sqlalchemy import select
+
+from .models import db, User, Department, Appointment, DoctorAvailability
+from .api import ApiError, API_PREFIX
+from .tenancy import current_tenant
+
+WORD_RE = re.compile(r'\w+')
+WITHIN_CHOICES = (1, 3, 7, 14, 30)
+
+# tenant -> (computed_at, roster)
+_roster_cache = {}
+_roster_lock = threading.Lock()
+
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+# ---------------- ROSTER ---------------- #
+
+def roster():
+    """Active doctors sorted by name, department names and the name-word index, cached per tenant."""
+    tenant = current_tenant()
+    with _roster_lock:
+        computed_at, cached = _roster_cache.get(tenant, (None, None))
+        if computed_at is not None and _time.monotonic() - computed_at < current_app.config['FINDER_ROSTER_TTL']:
+            return cached
+
+    doctors = [
+        {'id': id_, 'name': name, 'email': email, 'phone': phone, 'department_id': department_id}
+        for id_, name, email, phone, department_id in db.session.execute(
+            select(User.id, User.name, User.email, User.phone, User.department_id)
+            .where(User.role == 'doctor', User.is_active == True)  # noqa: E712
+            .order_by(User.name, User.id)
+        )
+    ]
+    cached = {
+        'doctors': doctors,
+        'departments': dict(db.session.execute(select(Department.id, Department.name).order_by(Department.name)).all()),
+        # (word, doctor id) for every word of every name, for prefix lookups
+        'words': sorted({(w, d['id']) for d in doctors for w in WORD_RE.findall(d['name'].lower())}),
+    }
+    with _roster_lock:
+        _roster_cache[tenant] = (_time.monotonic(), cached)
+    return cached
+
+
+def invalidate_roster():
+    """Drop this process's cached roster for the current tenant, after doctors change."""
+    with _roster_lock:
+        _roster_cache.pop(current_tenant(), None)
+
+
+def _prefix_matches(words, prefix):
+    ids = set()
+    for word, doctor_id in words[bisect_left(words, (prefix,)):]:
+        if not word.startswith(prefix):
+            break
+        ids.add(doctor_id)
+    return ids
+
+
+# ---------------- DATE FACETS ---------------- #
+
+def _available_on(doctor_ids, day):
+    stmt = select(DoctorAvailability.doctor_id).where(DoctorAvailability.date == day).distinct()
+    if doctor_ids is not None:
+        stmt = stmt.where(DoctorAvailability.doctor_id.in_(doctor_ids))
+    return set(db.session.execute(stmt).scalars())
+
+
+def first_free_slots(doctor_ids, date_to):
+    """doctor_id -> (date, 'HH:MM') of the doctor's first free slot from now until `date_to`."""
+    slot = current_app.config['CALENDAR_SLOT_MINUTES']
+    now = datetime.now()
+    today, now_minute = now.date(), _minutes(now.time())
+
+    stmt = (
+        select(DoctorAvailability.doctor_id, DoctorAvailability.date,
+               DoctorAvailability.start_time, DoctorAvailability.end_time)
+        .where(DoctorAvailability.date >= today, DoctorAvailability.date <= date_to)
+        .order_by(DoctorAvailability.doctor_id, DoctorAvailability.date, DoctorAvailability.start_time)
+    )
+    if doctor_ids is not None:
+        stmt = stmt.where(DoctorAvailability.doctor_id.in_(doctor_ids))
+    blocks = db.session.execute(stmt).all()
+    if not blocks:
+        return {}
+
+    # Booked appointments only of doctors with availability in the window
+    booked = set(db.session.execute(
+        select(Appointment.doctor_id, Appointment.date, Appointment.time)
+        .where(Appointment.doctor_id.in_({b.doctor_id for b in blocks}), Appointment.status == 'Booked',
+               Appointment.date >= today, Appointment.date <= date_to)
+    ))
+    booked = {(d, day, _minutes(t)) for d, day, t in booked}
+
+    free = {}
+    for doctor_id, day, start, end in blocks:
+        if doctor_id in free:
+            continue
+        for minute in range(_minutes(start), _minutes(end), slot):
+            if day == today and minute <= now_minute:
+                continue
+            if (doctor_id, day, minute) not in booked:
+                free[doctor_id] = (day, f"{minute // 60:02d}:{minute % 60:02d}")
+                break
+    return free
+
+
+# ---------------- SEARCH ---------------- #
+
+def parse_search(args):
+    """Search parameters from a query string, or raise ValueError."""
+    params = {
+        'q': ' '.join(WORD_RE.findall((args.get('q') or '').lower())),
+        'department_id': args.get('department_id', type=int),
+        'available_on': None,
+        'within': args.get('within', type=int),
+        'page': max(1, args.get('page', 1, type=int) or 1),
+    }
+    if args.get('available_on'):
+        try:
+            params['available_on'] = datetime.strptime(args['available_on'], "%Y-%m-%d").date()
+        except ValueError:
+            raise ValueError("Dates must be YYYY-MM-DD.")
+    if params['within'] is not None and not 1 <= params['within'] <= current_app.config['FINDER_MAX_DAYS']:
+        raise ValueError(f"'within' must be between 1 and {current_app.config['FINDER_MAX_DAYS']} days.")
+    return params
+
+
+def find_doctors(q='', department_id=None, available_on=None, within=None, page=1, per_page=None):
+    """
+    One page of matching doctors (by name) with their first free slot, plus
+    the number of matches per department under the other facets.
+    """
+    config = current_app.config
+    per_page = per_page or config['FINDER_PAGE_SIZE']
+    cached = roster()
+
+    candidates = None   # None: every active doctor
+    for prefix in q.split():
+        ids = _prefix_matches(cached['words'], prefix)
+        candidates = ids if candidates is None else candidates & ids
+    if available_on is not None and candidates != set():
+        candidates = _available_on(candidates, available_on)
+    if within is not None and candidates != set():
+        candidates = set(first_free_slots(candidates, date.today() + timedelta(days=within - 1)))
+
+    doctors = cached['doctors'] if candidates is None else [d for d in cached['doctors'] if d['id'] in candidates]
+    counts = Counter(d['department_id'] for d in doctors)
+    if department_id:
+        doctors = [d for d in doctors if d['department_id'] == department_id]
+
+    total = len(doctors)
+    pages = max(1, math.ceil(total / per_page))
+    page = min(page, pages)
+    shown = doctors[(page - 1) * per_page:page * per_page]
+
+    horizon = date.today() + timedelta(days=config['FINDER_MAX_DAYS'] - 1)
+    free = first_free_slots({d['id'] for d in shown}, horizon) if shown else {}
+    departments = cached['departments']
+
+    return {
+        'data': [
+            dict(d, department=departments.get(d['department_id']),
+                 next_free={'date': free[d['id']][0].isoformat(), 'time': free[d['id']][1]}
+                 if d['id'] in free else None)
+            for d in shown
+        ],
+        'total': total,
+        'page': page,
+        'pages': pages,
+        'facets': {
+            'department': [
+                {'id': id_, 'name': name, 'count': counts[id_]}
+                for id_, name in departments.items() if counts[id_]
+            ],
+        },
+    }
+
+
+def init_finder(app):
+    app.config.setdefault('FINDER_PAGE_SIZE', 12)
+    app.config.setdefault('FINDER_ROSTER_TTL', 60)      # seconds the doctor roster is cached
+    app.config.setdefault('FINDER_MAX_DAYS', 30)        # largest 'within', and how far ahead next_free looks
+
+    @app.route(API_PREFIX + '/doctors/search')
+    def api_doctor_search():
+        # Authentication is enforced for /api/v1/* in app/api.py
+        try:
+            params = parse_search(request.args)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        per_page = max(1, min(request.args.get('limit', app.config['FINDER_PAGE_SIZE'], type=int), 50))
+        return jsonify(find_doctors(per_page=per_page, **params))
@@ -0,0 +1,426 @@
+"""
+Persistent background jobs.
+
+Handlers call enqueue() instead of doing slow work inline and return at
+once. A job is a row in the `jobs` table written in the caller's
+transaction, so it survives restarts and is never queued for a change that
+was rolled back. Each worker process runs a small pool of threads that
+claim due jobs (one conditional UPDATE, so two processes never run the same
+job), retry failures with exponential backoff and give up after
+max_attempts.
+
+Recurring work is scheduled with APScheduler. A trigger only enqueues the
+job under a dedup key, so when every server worker fires the same schedule
+the job is still queued once.
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time as _time
+from datetime import datetime, timedelta
+
+import click
+from flask import g, render_template, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy import event, select, update, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .models import db, Job
+from .tenancy import tenant_context
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+DEFAULT_SCHEDULE = {
+    # job name: APScheduler trigger arguments
+    'mark_missed_appointments': {'trigger': 'interval', 'minutes': 5},
+    'archive_closed': {'trigger': 'cron', 'hour': 3, 'minute': 15},
+    'jobs_maintenance': {'trigger': 'interval', 'minutes': 10},
+    # database upkeep, see app/maintenance.py
+    'db_backup': {'trigger': 'cron', 'hour': 2, 'minute': 30},
+    'db_optimize': {'trigger': 'interval', 'hours': 6},
+    'db_incremental_vacuum': {'trigger': 'cron', 'hour': 4, 'minute': 0},
+    'db_integrity_check': {'trigger': 'cron', 'day_of_week': 'sun', 'hour': 5},
+    # no-show risk of upcoming bookings, see app/noshow.py
+    'noshow_score': {'trigger': 'cron', 'hour': 1, 'minute': 45},
+}
+
+# name -> {'func': callable, 'max_attempts': int}
+JOBS = {}
+
+
+def job(name, max_attempts=5):
+    """Register a function as the handler for jobs called `name`."""
+    def register(func):
+        JOBS[name] = {'func': func, 'max_attempts': max_attempts}
+        return func
+    return register
+
+
+def enqueue(name, payload=None, dedup_key=None, delay=0, run_at=None, max_attempts=None):
+    """
+    Queue job `name`, called with `payload` as keyword arguments, in the
+    current transaction; the caller commits. Returns False when a queued or
+    running job with the same dedup_key already exists.
+    """
+    if name not in JOBS:
+        raise KeyError(f"unknown job '{name}'")
+    now = datetime.utcnow()
+    stmt = sqlite_insert(Job).values(
+        name=name,
+        payload=json.dumps(payload or {}),
+        dedup_key=dedup_key,
+        status='queued',
+        attempts=0,
+        max_attempts=max_attempts or JOBS[name]['max_attempts'],
+        run_at=run_at or now + timedelta(seconds=delay),
+        created_at=now
+    ).on_conflict_do_nothing()
+    inserted = db.session.execute(stmt).rowcount == 1
+    if inserted:
+        db.session.info['jobs_enqueued'] = True
+    return inserted
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_workers(session):
+    # Committed jobs are visible now: let idle workers pick them up without waiting a poll
+    if session.info.pop('jobs_enqueued', False):
+        JobWorkers.wake_all()
+
+
+def backoff(attempt, base, cap):
+    """Seconds before retry number `attempt` (1-based), with +-20% jitter."""
+    return min(cap, base * 2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+
+
+# ---------------- WORKER SIDE ---------------- #
+
+def claim(worker):
+    """Mark the next due job as running for `worker`. Returns the claimed row or None."""
+    while True:
+        now = datetime.utcnow()
+        # Read first: an idle queue must not take the SQLite write lock
+        job_id = db.session.execute(
+            select(Job.id).where(Job.status == 'queued', Job.run_at <= now)
+            .order_by(Job.run_at, Job.id).limit(1)
+        ).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+
+        row = db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', attempts=Job.attempts + 1, started_at=now, locked_by=worker)
+            .returning(Job.id, Job.name, Job.payload, Job.attempts, Job.max_attempts)
+            .execution_options(synchronize_session=False)
+        ).first()
+        db.session.commit()
+        if row is not None:
+            return row
+        # Another worker won the race for this job; try the next one
+
+
+def run_next(worker, config):
+    """Claim and run one job. Returns False when nothing was due."""
+    claimed = claim(worker)
+    if claimed is None:
+        return False
+
+    values = {}
+    try:
+        spec = JOBS.get(claimed.name)
+        if spec is None:
+            raise LookupError(f"no handler registered for '{claimed.name}'")
+        g.audit_origin = f"job:{claimed.name}"
+        spec['func'](**json.loads(claimed.payload or '{}'))
+        db.session.commit()
+        values.update(status='done', finished_at=datetime.utcnow(), last_error=None)
+    except Exception as e:
+        db.session.rollback()
+        error = f"{type(e).__name__}: {e}"
+        if claimed.attempts < claimed.max_attempts:
+            delay = backoff(claimed.attempts, config['JOB_BACKOFF_BASE'], config['JOB_BACKOFF_MAX'])
+            values.update(status='queued', run_at=datetime.utcnow() + timedelta(seconds=delay),
+                          last_error=error)
+        else:
+            values.update(status='failed', finished_at=datetime.utcnow(), last_error=error)
+
+    db.session.execute(
+        update(Job).where(Job.id == claimed.id).values(locked_by=None, **values)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return True
+
+
+class JobWorkers:
+    """Per-process pool of job threads plus the APScheduler triggers."""
+
+    _instances = []
+
+    def __init__(self, app):
+        self.app = app
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.scheduler = None
+        self.all_tenants = False
+        JobWorkers._instances.append(self)
+
+    @classmethod
+    def wake_all(cls):
+        for workers in cls._instances:
+            workers._wake.set()
+
+    def started(self):
+        return self._pid == os.getpid()
+
+    def start(self, threads=None, schedule=True, all_tenants=False):
+        # Threads do not survive fork(): start once per process
+        with self._lock:
+            if self.started():
+                return
+            self._pid = os.getpid()
+            self.all_tenants = all_tenants
+            self._wake = threading.Event()
+            threads = self.app.config['JOB_WORKERS'] if threads is None else threads
+            for i in range(threads):
+                threading.Thread(target=self._run, name=f"jobs-{i}", daemon=True).start()
+            if schedule and self.app.config['JOB_SCHEDULE']:
+                self._start_scheduler()
+
+    def _run(self):
+        worker = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        config = self.app.config
+        tenancy = self.app.extensions['tenancy']
+        while True:
+            ran = False
+            # One database, or the clinics' databases (app/tenancy.py)
+            for tenant in tenancy.job_tenants(self.all_tenants):
+                try:
+                    with tenant_context(self.app, tenant):
+                        if run_next(worker, config):
+                            ran = True
+                        else:
+                            tenancy.jobs_drained(tenant)
+                except Exception as e:
+                    # Database busy or gone: back off for one poll interval
+                    self.app.logger.warning("job worker (%s): %s", tenant or 'default', e)
+            if not ran:
+                self._wake.wait(config['JOB_POLL_INTERVAL'])
+                self._wake.clear()
+
+    def _start_scheduler(self):
+        from apscheduler.schedulers.background import BackgroundScheduler
+
+        scheduler = BackgroundScheduler(daemon=True)
+        for name, trigger in self.app.config['JOB_SCHEDULE'].items():
+            options = dict(trigger)
+            scheduler.add_job(self._enqueue_scheduled, options.pop('trigger'), args=[name], id=name,
+                              coalesce=True, max_instances=1, **options)
+        scheduler.start()
+        self.scheduler = scheduler
+
+    def _enqueue_scheduled(self, name):
+        tenancy = self.app.extensions['tenancy']
+        already_open = set(tenancy.open_tenants()) if tenancy.mode else set()
+        for tenant in tenancy.schedule_tenants():
+            with tenant_context(self.app, tenant):
+                try:
+                    enqueue(name, dedup_key=f"schedule:{name}")
+                    db.session.commit()
+                    tenancy.jobs_pending(tenant)
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.warning("scheduling %s (%s): %s", name, tenant or 'default', e)
+            # Idle clinics were opened only to enqueue; don't keep all of them open until the sweep
+            if tenant is not None and tenant not in already_open:
+                tenancy.close_idle(tenant)
+
+
+# ---------------- BUILT-IN JOBS ---------------- #
+
+@job('mark_missed_appointments')
+def mark_missed_appointments():
+    from .routes import auto_update_past_appointments
+    auto_update_past_appointments()
+
+
+@job('archive_closed', max_attempts=3)
+def archive_closed_job():
+    from .archive import archive_closed
+    archive_closed()
+
+
+@job('jobs_maintenance')
+def jobs_maintenance():
+    """Requeue jobs whose worker died mid-run and drop old finished jobs."""
+    from flask import current_app
+    config = current_app.config
+    now = datetime.utcnow()
+    stale = [Job.status == 'running', Job.started_at < now - timedelta(seconds=config['JOB_TIMEOUT'])]
+
+    db.session.execute(
+        update(Job).where(*stale, Job.attempts >= Job.max_attempts)
+        .values(status='failed', finished_at=now, locked_by=None, last_error='worker lost')
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(Job).where(*stale)
+        .values(status='queued', run_at=now, locked_by=None, last_error='worker lost')
+        .execution_options(synchronize_session=False)
+    )
+    Job.query.filter(
+        Job.status.in_(('done', 'failed')),
+        Job.finished_at < now - timedelta(days=config['JOB_RETENTION_DAYS'])
+    ).delete(synchronize_session=False)
+
+
+# ---------------- STATS ---------------- #
+
+def _percentiles(values):
+    if not values:
+        return {'count': 0, 'p50': None, 'p95': None, 'max': None}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 3)
+    return {'count': len(values), 'p50': pick(0.5), 'p95': pick(0.95), 'max': round(values[-1], 3)}
+
+
+def queue_stats(window_hours=1):
+    now = datetime.utcnow()
+    depth = {}
+    for name, status, count in (
+        db.session.query(Job.name, Job.status, func.count(Job.id)).group_by(Job.name, Job.status)
+    ):
+        depth.setdefault(name, {})[status] = count
+
+    oldest_due = db.session.query(func.min(Job.run_at)).filter(
+        Job.status == 'queued', Job.run_at <= now
+    ).scalar()
+
+    finished = (
+        db.session.query(Job.run_at, Job.started_at, Job.finished_at)
+        .filter(Job.status == 'done', Job.finished_at >= now - timedelta(hours=window_hours))
+        .order_by(Job.finished_at.desc())
+        .limit(5000)
+        .all()
+    )
+    return {
+        'depth': depth,
+        'due': db.session.query(func.count(Job.id)).filter(Job.status == 'queued', Job.run_at <= now).scalar(),
+        'oldest_due_seconds': round((now - oldest_due).total_seconds(), 1) if oldest_due else 0,
+        # wait: due time -> picked up by a worker; run: time spent in the handler
+        'wait_seconds': _percentiles([(s - r).total_seconds() for r, s, f in finished]),
+        'run_seconds': _percentiles([(f - s).total_seconds() for r, s, f in finished]),
+        'window_hours': window_hours,
+    }
+
+
+def init_jobs(app):
+    app.config.setdefault('JOB_WORKERS', 2)             # job threads per server process
+    app.config.setdefault('JOB_POLL_INTERVAL', 2.0)     # seconds an idle worker waits between polls
+    app.config.setdefault('JOB_BACKOFF_BASE', 15)       # seconds before the first retry
+    app.config.setdefault('JOB_BACKOFF_MAX', 3600)
+    app.config.setdefault('JOB_TIMEOUT', 900)           # running longer than this = worker lost
+    app.config.setdefault('JOB_RETENTION_DAYS', 7)
+    app.config.setdefault('JOB_SCHEDULE', DEFAULT_SCHEDULE)
+    app.config.setdefault('JOBS_AUTOSTART', True)
+
+    workers = JobWorkers(app)
+    app.extensions['job_workers'] = workers
+
+    def start_workers(app_):
+        if app.config['JOBS_AUTOSTART']:
+            workers.start()
+
+    # serve.py starts them in each worker right after fork; the dev server on first request
+    app.extensions.setdefault('post_fork', []).append(start_workers)
+
+    @app.before_request
+    def ensure_job_workers():
+        if not workers.started():
+            start_workers(app)
+
+    @app.cli.command('jobs-work')
+    @click.option('--threads', default=None, type=int, help='Worker threads (default JOB_WORKERS).')
+    @click.option('--no-schedule', is_flag=True, help='Only run queued jobs, do not fire schedules.')
+    def jobs_work_command(threads, no_schedule):
+        """Run job workers in the foreground (e.g. with JOBS_AUTOSTART off in the web tier)."""
+        # No requests arrive here to open clinics, so poll all of them
+        workers.start(threads, schedule=not no_schedule, all_tenants=True)
+        click.echo(f"Job workers running in process {os.getpid()}. Ctrl+C to stop.")
+        try:
+            while True:
+                _time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+    @app.route('/admin/jobs')
+    @login_required
+    def admin_jobs():
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        failed = Job.query.filter_by(status='failed').order_by(Job.finished_at.desc()).limit(50).all()
+        retrying = Job.query.filter(Job.status == 'queued', Job.attempts > 0).order_by(Job.run_at).limit(50).all()
+        return render_template(
+            'admin_jobs.html',
+            stats=queue_stats(),
+            failed=failed,
+            retrying=retrying,
+            schedule=app.config['JOB_SCHEDULE']
+        )
+
+    @app.route('/admin/jobs_stats')
+    @login_required
+    def admin_jobs_stats():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+        return jsonify(queue_stats())
+
+    @app.route('/admin/jobs/run', methods=['POST'])
+    @login_required
+    def admin_run_job():
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        name = request.form.get('name')
+        if name not in app.config['JOB_SCHEDULE']:
+            flash('Unknown job.', 'danger')
+        elif enqueue(name, dedup_key=f"schedule:{name}"):
+            db.session.commit()
+            flash(f"'{name}' queued.", 'success')
+        else:
+            flash(f"'{name}' is already queued or running.", 'info')
+        return redirect(url_for('admin_jobs'))
+
+    @app.route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+    @login_required
+    def admin_retry_job(job_id):
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        failed_job = Job.query.get_or_404(job_id)
+        if failed_job.status != 'failed':
+            flash('Only failed jobs can be retried.', 'warning')
+            return redirect(url_for('admin_jobs'))
+
+        failed_job.status = 'queued'
+        failed_job.attempts = 0
+        failed_job.run_at = datetime.utcnow()
+        failed_job.finished_at = None
+        db.session.info['jobs_enqueued'] = True
+        try:
+            db.session.commit()
+            flash(f"Job #{job_id} queued again.", 'success')
+        except IntegrityError:
+            db.session.rollback()
+            flash('An identical job is already queued or running.', 'info')
+        return redirect(url_for('admin_jobs'))
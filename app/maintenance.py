@@ -0,0 +1,329 @@
+"""
+Online maintenance of the SQLite database, safe to run while serving.
+
+    backup              hot copy through SQLite's online backup API,
+                        BACKUP_STEP_PAGES pages per step with a pause in
+                        between, so writers only wait for one small step.
+                        A write to the database restarts the copy; after
+                        BACKUP_MAX_RESTARTS restarts the attempt is given up
+                        and retried after a back-off, BACKUP_ATTEMPTS times,
+                        before the backup fails (the job retries it later)
+    optimize            PRAGMA optimize with an analysis limit (or a full
+                        ANALYZE on request) to refresh planner statistics
+    incremental vacuum  return free pages to the OS in short steps until a
+                        time budget is spent
+    integrity check     quick_check (or full integrity_check)
+
+Each one is a CLI command and a scheduled background job (app/jobs.py);
+/admin/db_stats reports file, WAL and free-page sizes.
+"""
+import os
+import sqlite3
+import time as _time
+from datetime import datetime
+
+import click
+from flask import current_app, jsonify
+from flask_login import login_required, current_user
+
+from .models import db
+from .jobs import job
+from .tenancy import current_tenant
+
+BACKUP_PREFIX = 'hms-'
+
+
+class _Restarted(Exception):
+    """Raised from the backup progress callback to give up on stepping."""
+
+
+def backup_dir():
+    """BACKUP_DIR, with a subdirectory per tenant so pruning never touches another clinic's backups."""
+    tenant = current_tenant()
+    directory = current_app.config['BACKUP_DIR']
+    return os.path.join(directory, tenant) if tenant else directory
+
+
+def database_path():
+    path = db.engine.url.database
+    if db.engine.url.get_backend_name() != 'sqlite' or not path or path == ':memory:':
+        raise RuntimeError("database maintenance needs a file-based SQLite database")
+    return path
+
+
+def _pragma(conn, name):
+    return conn.exec_driver_sql(f'PRAGMA {name}').scalar()
+
+
+# ---------------- BACKUP ---------------- #
+
+def backup(directory=None, step_pages=None, pause=None, keep=None):
+    """
+    Copy the live database into `directory` and verify the copy.
+    Returns a dict describing the backup file.
+    """
+    config = current_app.config
+    directory = directory or backup_dir()
+    step_pages = step_pages or config['BACKUP_STEP_PAGES']
+    pause = config['BACKUP_STEP_PAUSE'] if pause is None else pause
+    keep = config['BACKUP_KEEP'] if keep is None else keep
+
+    os.makedirs(directory, exist_ok=True)
+    name = f"{BACKUP_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+    final = os.path.join(directory, name)
+    partial = final + '.partial'
+
+    max_restarts = config['BACKUP_MAX_RESTARTS']
+    started = _time.perf_counter()
+    steps = restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal steps, restarts, last_remaining
+        steps += 1
+        # A write by another connection between steps restarts the copy from
+        # the first page: the pages left go up instead of down
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _Restarted()
+        last_remaining = remaining
+        # backup(sleep=) only applies after SQLITE_BUSY; this is the pause writers run in
+        if remaining:
+            _time.sleep(pause)
+
+    try:
+        for attempt in range(config['BACKUP_ATTEMPTS']):
+            if attempt:
+                # Writes keep outrunning the copy: give them room, then start over
+                delay = config['BACKUP_RETRY_DELAY'] * 2 ** (attempt - 1)
+                current_app.logger.warning("backup restarted %d times, retrying in %ss", restarts, delay)
+                _time.sleep(delay)
+                restarts, last_remaining = 0, None
+            source = sqlite3.connect(database_path(), timeout=30)
+            target = sqlite3.connect(partial)
+            try:
+                source.backup(target, pages=step_pages, progress=progress)
+                check = target.execute('PRAGMA quick_check').fetchone()[0]
+                break
+            except _Restarted:
+                continue
+            finally:
+                target.close()
+                source.close()
+        else:
+            raise RuntimeError(f"backup gave up after {config['BACKUP_ATTEMPTS']} attempts: "
+                               f"the database changed more than {max_restarts} times during each")
+
+        if check != 'ok':
+            raise RuntimeError(f"backup copy failed quick_check: {check}")
+        os.replace(partial, final)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    removed = prune_backups(directory, keep)
+    return {
+        'file': final,
+        'bytes': os.path.getsize(final),
+        'steps': steps,
+        'restarts': restarts,
+        'attempts': attempt + 1,
+        'seconds': round(_time.perf_counter() - started, 3),
+        'pruned': removed,
+    }
+
+
+def list_backups(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if f.startswith(BACKUP_PREFIX) and f.endswith('.db')
+    )
+
+
+def prune_backups(directory, keep):
+    """Delete all but the newest `keep` backups. Returns the removed paths."""
+    backups = list_backups(directory)
+    removed = backups[:-keep] if keep and len(backups) > keep else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+# ---------------- STATISTICS / VACUUM / CHECKS ---------------- #
+
+def optimize(full=False):
+    """Refresh query planner statistics. `full` runs a complete ANALYZE."""
+    started = _time.perf_counter()
+    with db.engine.connect() as conn:
+        if full:
+            conn.exec_driver_sql('ANALYZE')
+        else:
+            # Bound the work per index; optimize only analyzes what looks stale
+            conn.exec_driver_sql(f"PRAGMA analysis_limit={int(current_app.config['OPTIMIZE_ANALYSIS_LIMIT'])}")
+            conn.exec_driver_sql('PRAGMA optimize')
+        conn.commit()
+    return {'full': full, 'seconds': round(_time.perf_counter() - started, 3)}
+
+
+def incremental_vacuum(budget=None, step_pages=None, pause=None):
+    """
+    Free pages in steps of `step_pages`, each in its own short transaction,
+    until none are left or `budget` seconds have passed.
+    """
+    config = current_app.config
+    budget = config['VACUUM_BUDGET_SECONDS'] if budget is None else budget
+    step_pages = step_pages or config['VACUUM_STEP_PAGES']
+    pause = config['VACUUM_STEP_PAUSE'] if pause is None else pause
+
+    with db.engine.connect() as conn:
+        if _pragma(conn, 'auto_vacuum') != 2:
+            return {'skipped': "auto_vacuum is not INCREMENTAL; run 'flask db-vacuum --enable' once"}
+
+        before = _pragma(conn, 'freelist_count')
+        deadline = _time.monotonic() + budget
+        steps = 0
+        driver = conn.connection.driver_connection
+        while _pragma(conn, 'freelist_count') and _time.monotonic() < deadline:
+            conn.commit()
+            # execute() steps the pragma once and frees a single page;
+            # executescript() runs it to completion
+            driver.executescript(f'PRAGMA incremental_vacuum({int(step_pages)});')
+            steps += 1
+            if pause:
+                _time.sleep(pause)
+        after = _pragma(conn, 'freelist_count')
+        conn.commit()
+
+    return {'freed_pages': before - after, 'free_pages_left': after, 'steps': steps}
+
+
+def enable_incremental_vacuum():
+    """Switch auto_vacuum to INCREMENTAL. Needs one full VACUUM, which locks the database."""
+    with db.engine.connect() as conn:
+        conn.commit()
+        conn.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.exec_driver_sql('VACUUM')
+        return _pragma(conn, 'auto_vacuum') == 2
+
+
+def integrity_check(full=False):
+    """List of problems reported by SQLite; empty when the database is fine."""
+    with db.engine.connect() as conn:
+        rows = [r[0] for r in conn.exec_driver_sql('PRAGMA integrity_check' if full else 'PRAGMA quick_check')]
+    return [] if rows == ['ok'] else rows
+
+
+def database_stats():
+    path = database_path()
+    with db.engine.connect() as conn:
+        page_size = _pragma(conn, 'page_size')
+        page_count = _pragma(conn, 'page_count')
+        free_pages = _pragma(conn, 'freelist_count')
+        journal_mode = _pragma(conn, 'journal_mode')
+        auto_vacuum = {0: 'none', 1: 'full', 2: 'incremental'}.get(_pragma(conn, 'auto_vacuum'))
+
+    size = lambda p: os.path.getsize(p) if os.path.exists(p) else 0
+    backups = list_backups(backup_dir())
+    last = backups[-1] if backups else None
+    return {
+        'path': path,
+        'file_bytes': size(path),
+        'wal_bytes': size(path + '-wal'),
+        'page_size': page_size,
+        'page_count': page_count,
+        'free_pages': free_pages,
+        'free_bytes': free_pages * page_size,
+        'free_ratio': round(free_pages / page_count, 4) if page_count else 0,
+        'journal_mode': journal_mode,
+        'auto_vacuum': auto_vacuum,
+        'backups': len(backups),
+        'last_backup': {
+            'file': last,
+            'bytes': size(last),
+            'at': datetime.fromtimestamp(os.path.getmtime(last)).isoformat(timespec='seconds'),
+        } if last else None,
+    }
+
+
+# ---------------- SCHEDULED JOBS ---------------- #
+
+@job('db_backup', max_attempts=3)
+def db_backup_job():
+    result = backup()
+    current_app.logger.info("database backup: %s", result)
+
+
+@job('db_optimize')
+def db_optimize_job():
+    optimize()
+
+
+@job('db_incremental_vacuum')
+def db_incremental_vacuum_job():
+    incremental_vacuum()
+
+
+@job('db_integrity_check', max_attempts=1)
+def db_integrity_check_job():
+    problems = integrity_check()
+    if problems:
+        # Fails the job, so it shows up on /admin/jobs
+        raise RuntimeError(f"quick_check found {len(problems)} problems: {problems[:5]}")
+
+
+def init_maintenance(app):
+    app.config.setdefault('BACKUP_DIR', os.path.join(app.instance_path, 'backups'))
+    app.config.setdefault('BACKUP_STEP_PAGES', 256)        # pages copied per backup step
+    app.config.setdefault('BACKUP_STEP_PAUSE', 0.02)       # seconds between steps, writers run here
+    app.config.setdefault('BACKUP_KEEP', 7)                # newest backups kept
+    app.config.setdefault('BACKUP_MAX_RESTARTS', 3)        # restarts before an attempt is given up
+    app.config.setdefault('BACKUP_ATTEMPTS', 3)            # attempts before the backup fails
+    app.config.setdefault('BACKUP_RETRY_DELAY', 5)         # seconds before the 2nd attempt, doubling
+    app.config.setdefault('OPTIMIZE_ANALYSIS_LIMIT', 400)  # rows sampled per index by PRAGMA optimize
+    app.config.setdefault('VACUUM_BUDGET_SECONDS', 5)
+    app.config.setdefault('VACUUM_STEP_PAGES', 200)
+    app.config.setdefault('VACUUM_STEP_PAUSE', 0.02)
+
+    @app.cli.command('db-backup')
+    @click.option('--dir', 'directory', default=None, help='Backup directory (default BACKUP_DIR).')
+    @click.option('--step-pages', type=int, default=None)
+    def db_backup_command(directory, step_pages):
+        """Hot backup of the live database, verified with quick_check."""
+        click.echo(backup(directory, step_pages))
+
+    @app.cli.command('db-optimize')
+    @click.option('--full', is_flag=True, help='Run a complete ANALYZE instead of PRAGMA optimize.')
+    def db_optimize_command(full):
+        """Refresh query planner statistics."""
+        click.echo(optimize(full))
+
+    @app.cli.command('db-vacuum')
+    @click.option('--seconds', type=float, default=None, help='Time budget (default VACUUM_BUDGET_SECONDS).')
+    @click.option('--enable', is_flag=True, help='One-off: switch to incremental auto_vacuum (full VACUUM, locks the database).')
+    def db_vacuum_command(seconds, enable):
+        """Return free pages to the file system in short steps."""
+        if enable:
+            click.echo("Incremental vacuum enabled." if enable_incremental_vacuum() else "Could not enable.")
+        click.echo(incremental_vacuum(seconds))
+
+    @app.cli.command('db-check')
+    @click.option('--full', is_flag=True, help='Full integrity_check instead of quick_check.')
+    def db_check_command(full):
+        """Check the database for corruption."""
+        problems = integrity_check(full)
+        click.echo("ok" if not problems else "\n".join(problems))
+
+    @app.cli.command('db-stats')
+    def db_stats_command():
+        """Database, WAL and free page sizes."""
+        click.echo(database_stats())
+
+    @app.route('/admin/db_stats')
+    @login_required
+    def admin_db_stats():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+        return jsonify(database_stats())
@@ -1,9 +1,23 @@
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from flask import current_app
 from flask_login import UserMixin
 
-db = SQLAlchemy()
+
+class TenantSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose engines follow the current tenant (app/tenancy.py)."""
+
+    @property
+    def engines(self):
+        registry = current_app.extensions.get('tenancy')
+        tenant = registry.current() if registry is not None else None
+        if tenant is not None:
+            return registry.engines(tenant)
+        return super().engines
+
+
+db = TenantSQLAlchemy()
 
 
 class User(UserMixin, db.Model):
@@ -41,6 +55,14 @@ class Department(db.Model):
 # ---------------- APPOINTMENT & TREATMENT ---------------- #
 class Appointment(db.Model):
     __tablename__ = 'appointments'
+    __table_args__ = (
+        # patient timeline: newest first per patient
+        db.Index('ix_appointments_patient_date', 'patient_id', 'date', 'time'),
+        # doctor calendar: one doctor's day/week/month window
+        db.Index('ix_appointments_doctor_date', 'doctor_id', 'date', 'time'),
+        # ids are never reused, so an archived id cannot collide with a new booking
+        {'sqlite_autoincrement': True},
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     doctor_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -48,6 +70,7 @@ class Appointment(db.Model):
     time = db.Column(db.Time, nullable=False)
     status = db.Column(db.String(20), default='Booked')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, index=True)   # change version, stamped by app/sync.py
 
     patient = db.relationship('User', foreign_keys=[patient_id], backref='patient_appointments')
     doctor = db.relationship('User', foreign_keys=[doctor_id], backref='doctor_appointments')
@@ -57,30 +80,288 @@ class Appointment(db.Model):
 
 class Treatment(db.Model):
     __tablename__ = 'treatments'
+    __table_args__ = {'sqlite_autoincrement': True}   # see Appointment
     id = db.Column(db.Integer, primary_key=True)
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.id'), nullable=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.id'), nullable=False, index=True)
     diagnosis = db.Column(db.Text)
     prescription = db.Column(db.Text)
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, index=True)
 
 class DoctorAvailability(db.Model):
     __tablename__ = 'doctor_availability'
+    __table_args__ = (
+        db.Index('ix_doctor_availability_doctor_date', 'doctor_id', 'date', 'start_time'),
+        # doctor finder: who works on a day / in the next N days (app/finder.py)
+        db.Index('ix_doctor_availability_date', 'date', 'doctor_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     doctor_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, index=True)
 
     doctor = db.relationship('User', backref='availabilities')
 
 
+# ---------------- DELTA SYNC ---------------- #
+class SyncState(db.Model):
+    """Single row holding the last change version handed out (see app/sync.py)."""
+    __tablename__ = 'sync_state'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SyncTombstone(db.Model):
+    """Left behind when a synced row is deleted, so clients can drop their copy."""
+    __tablename__ = 'sync_tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)   # appointments / treatments / availability
+    entity_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, index=True)
+    doctor_id = db.Column(db.Integer)
+    patient_id = db.Column(db.Integer)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# ---------------- ARCHIVE (cold storage) ---------------- #
+# Closed appointments older than ARCHIVE_AFTER_DAYS are moved here by
+# app/archive.py. Rows keep their original ids, so links and reports still work.
+class ArchivedAppointment(db.Model):
+    __tablename__ = 'appointments_archive'
+    __table_args__ = (
+        db.Index('ix_appointments_archive_patient_date', 'patient_id', 'date', 'time'),
+        db.Index('ix_appointments_archive_doctor_date', 'doctor_id', 'date', 'time'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.Time, nullable=False)
+    status = db.Column(db.String(20))
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    patient = db.relationship('User', foreign_keys=[patient_id])
+    doctor = db.relationship('User', foreign_keys=[doctor_id])
+    treatment = db.relationship('ArchivedTreatment', backref='appointment', uselist=False)
+
+
+class ArchivedTreatment(db.Model):
+    __tablename__ = 'treatments_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments_archive.id'), nullable=False, index=True)
+    diagnosis = db.Column(db.Text)
+    prescription = db.Column(db.Text)
+    notes = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+
+
+# ---------------- LIVE FEED ---------------- #
+class AppointmentEvent(db.Model):
+    """
+    One row per appointment change pushed to the live dashboards.
+    Rows are short-lived: the event poller prunes them after a retention window.
+    """
+    __tablename__ = 'appointment_events'
+    id = db.Column(db.Integer, primary_key=True)
+    appointment_id = db.Column(db.Integer, nullable=False)
+    doctor_id = db.Column(db.Integer, nullable=False)
+    patient_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)   # booked / cancelled / completed / missed / reassigned
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+# ---------------- BACKGROUND JOBS ---------------- #
+class Job(db.Model):
+    """A unit of deferred work run by the worker pool in app/jobs.py."""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        # At most one queued/running job per dedup key
+        db.Index('uq_jobs_dedup_active', 'dedup_key', unique=True,
+                 sqlite_where=db.text("status IN ('queued', 'running')")),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    payload = db.Column(db.Text)                          # JSON keyword arguments
+    dedup_key = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='queued')   # queued / running / done / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(100))
+    last_error = db.Column(db.Text)
+
+
+# ---------------- REPORT EXPORTS ---------------- #
+class ReportExport(db.Model):
+    """A batch of treatment reports rendered into one archive (app/reports.py)."""
+    __tablename__ = 'report_exports'
+    id = db.Column(db.Integer, primary_key=True)
+    requested_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    filters = db.Column(db.Text)                          # JSON: patient_id, doctor_id, department_id, date_from, date_to
+    status = db.Column(db.String(20), nullable=False, default='queued')   # queued / running / done / failed / expired
+    total = db.Column(db.Integer, nullable=False, default=0)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    path = db.Column(db.String(300))
+    size = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+
+# ---------------- NO-SHOW RISK ---------------- #
+class NoShowScore(db.Model):
+    """
+    Predicted no-show probability of an upcoming booking (app/noshow.py).
+    Kept out of `appointments` so the nightly rescoring neither bumps sync
+    versions nor fills the audit log.
+    """
+    __tablename__ = 'noshow_scores'
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.id'), primary_key=True)
+    probability = db.Column(db.Float, nullable=False)
+    model_version = db.Column(db.String(40))              # trained_at of the model that scored it
+    scored_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# ---------------- WALK-INS ---------------- #
+class WalkIn(db.Model):
+    """
+    A patient waiting at a department desk without a booking (app/walkin.py).
+    Source of truth for the in-memory triage heaps, which are rebuilt from
+    the waiting rows after a restart.
+    """
+    __tablename__ = 'walkins'
+    __table_args__ = (
+        db.Index('ix_walkins_department_status', 'department_id', 'status', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    department_id = db.Column(db.Integer, db.ForeignKey('departments.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    priority = db.Column(db.Integer, nullable=False)       # 1 = emergency ... 4 = non-urgent
+    note = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='waiting')   # waiting / assigned / left
+    arrived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    assigned_at = db.Column(db.DateTime)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.id'))
+
+    patient = db.relationship('User', foreign_keys=[patient_id])
+    appointment = db.relationship('Appointment')
+
+
+# ---------------- AUDIT LOG ---------------- #
+class AuditEntry(db.Model):
+    """
+    One change to a user, department, appointment, treatment or availability
+    slot, written in batches by app/audit.py. Triggers refuse UPDATE and
+    DELETE, so the table only ever grows.
+    """
+    __tablename__ = 'audit_log'
+    __table_args__ = (
+        db.Index('ix_audit_log_entity', 'entity', 'entity_id', 'id'),
+        db.Index('ix_audit_log_actor', 'actor_id', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    uid = db.Column(db.String(32), unique=True, nullable=False)   # makes replays of a journal idempotent
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+    actor_id = db.Column(db.Integer)                   # no FK: entries outlive deleted users
+    origin = db.Column(db.String(80))                  # endpoint, job:<name> or system
+    ip = db.Column(db.String(45))
+    action = db.Column(db.String(20), nullable=False)  # create / update / delete / bulk_update / bulk_delete
+    entity = db.Column(db.String(40), nullable=False)  # table name
+    entity_id = db.Column(db.Integer)
+    changes = db.Column(db.Text)                       # JSON {field: [before, after]}
+
+
+def ensure_columns():
+    """
+    create_all() never alters existing tables. Add nullable columns declared on
+    the models that an older database is missing (SQLite ADD COLUMN).
+    """
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present and column.nullable:
+                    col_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}')
+
+
+def ensure_autoincrement():
+    """
+    Archived rows keep their ids, and without AUTOINCREMENT SQLite hands the
+    id of a deleted (archived) row to the next insert. Rebuild hot tables
+    created before sqlite_autoincrement was set, and start their sequence past
+    every id already used, archived ones included.
+    """
+    from sqlalchemy.schema import CreateTable
+
+    with db.engine.begin() as conn:
+        for model, archived in ((Appointment, ArchivedAppointment), (Treatment, ArchivedTreatment)):
+            table = model.__table__
+            ddl = conn.exec_driver_sql(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+            ).scalar()
+            if ddl is None or 'AUTOINCREMENT' in ddl.upper():
+                continue
+
+            rebuilt = f'{table.name}_rebuild'
+            columns = ', '.join(c.name for c in table.columns)
+            create = str(CreateTable(table).compile(dialect=conn.dialect))
+            # Keep references to the table name in other tables and triggers as written
+            conn.exec_driver_sql('PRAGMA legacy_alter_table = ON')
+            conn.exec_driver_sql(create.replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {rebuilt} ', 1))
+            conn.exec_driver_sql(f'INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table.name}')
+            conn.exec_driver_sql(f'DROP TABLE {table.name}')
+            conn.exec_driver_sql(f'ALTER TABLE {rebuilt} RENAME TO {table.name}')
+            conn.exec_driver_sql('PRAGMA legacy_alter_table = OFF')
+
+            top = max(
+                conn.exec_driver_sql(f'SELECT COALESCE(MAX(id), 0) FROM {table.name}').scalar(),
+                conn.exec_driver_sql(f'SELECT COALESCE(MAX(id), 0) FROM {archived.__table__.name}').scalar(),
+            )
+            conn.exec_driver_sql('DELETE FROM sqlite_sequence WHERE name = ?', (table.name,))
+            conn.exec_driver_sql('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table.name, top))
+
+
+def ensure_indexes():
+    """
+    create_all() skips tables that already exist, including their new indexes.
+    Create any index declared on the models that the database is still missing.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
 def init_db():
     """
     Create all tables and seed a default admin user programmatically
     """
     db.create_all()
+    ensure_columns()
+    ensure_autoincrement()   # before ensure_indexes: the rebuild drops the old indexes
+    ensure_indexes()
+
+    from .sync import ensure_sync_state
+    ensure_sync_state()
+
+    from .search import ensure_search_index
+    ensure_search_index()
+
+    from .audit import ensure_audit_log
+    ensure_audit_log()
 
     admin_email = 'admin@hospital.local'
     existing = User.query.filter_by(email=admin_email).first()
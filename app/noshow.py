@@ -0,0 +1,321 @@
+"""
+No-show risk scoring and controlled overbooking.
+
+`flask noshow-train` fits a logistic regression on past appointments that
+ended Completed or Missed (hot and archive tables), with features:
+
+    lead_days     days between booking and appointment
+    weekday/hour  when the appointment is (one-hot)
+    department    the doctor's department (one-hot)
+    missed_rate   the patient's earlier missed share, smoothed towards the
+                  clinic-wide rate so first-time patients are not 0 or 1
+    visits        how many earlier appointments that rate is based on
+
+The fitted pipeline is saved with joblib to NOSHOW_MODEL_DIR and cached in
+memory per process; a retrained file is picked up by its mtime. The nightly
+`noshow_score` job scores every upcoming Booked appointment in one
+predict_proba call and stores the probabilities in `noshow_scores`.
+
+Booking (routes.patient_appointments) accepts a second patient on an
+occupied slot when NOSHOW_OVERBOOK_LEVEL allows more bookings there and the
+chance that none of the patients already booked turns up is at least
+NOSHOW_OVERBOOK_THRESHOLD. Level 0 (the default) disables overbooking.
+
+scikit-learn, pandas and joblib are imported on first use only.
+"""
+import os
+import threading
+from datetime import date, datetime
+
+import click
+from flask import current_app, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy import select, func, union_all, delete, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .models import db, User, Appointment, ArchivedAppointment, NoShowScore
+from .jobs import job
+from .tenancy import current_tenant
+
+CLOSED = ('Completed', 'Missed')
+NUMERIC = ['lead_days', 'missed_rate', 'visits']
+CATEGORICAL = ['weekday', 'hour', 'department_id']
+PRIOR_WEIGHT = 3        # earlier visits the clinic-wide missed rate counts as
+
+# tenant -> (mtime, bundle)
+_model_cache = {}
+_model_lock = threading.Lock()
+
+
+# ---------------- DATA ---------------- #
+
+def _closed_appointments():
+    """Completed and missed appointments from both tables, with the doctor's department."""
+    def closed(model):
+        return (
+            select(model.patient_id, model.date, model.time, model.created_at, model.status,
+                   User.department_id)
+            .join(User, User.id == model.doctor_id)
+            .where(model.status.in_(CLOSED))
+        )
+    return union_all(closed(Appointment), closed(ArchivedAppointment))
+
+
+def _frame(rows, columns):
+    import pandas as pd
+    return pd.DataFrame(rows, columns=columns)
+
+
+def features(frame, base_rate):
+    """Model input from a frame with date, time, created_at, department_id, prior_missed, prior_visits."""
+    import pandas as pd
+
+    day = pd.to_datetime(frame['date'])
+    created = pd.to_datetime(frame['created_at']).dt.normalize()
+    lead = (day - created).dt.days
+    return pd.DataFrame({
+        'lead_days': lead.fillna(0).clip(0, 365),
+        'missed_rate': (frame['prior_missed'] + PRIOR_WEIGHT * base_rate) / (frame['prior_visits'] + PRIOR_WEIGHT),
+        'visits': frame['prior_visits'].clip(upper=50),
+        'weekday': day.dt.weekday,
+        'hour': frame['time'].map(lambda t: t.hour),
+        'department_id': frame['department_id'].fillna(-1).astype(int),
+    })
+
+
+def _pipeline():
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    return Pipeline([
+        ('features', ColumnTransformer([
+            ('numeric', StandardScaler(), NUMERIC),
+            ('categorical', OneHotEncoder(handle_unknown='ignore'), CATEGORICAL),
+        ])),
+        ('model', LogisticRegression(max_iter=1000)),
+    ])
+
+
+# ---------------- TRAINING ---------------- #
+
+def train(min_rows=None):
+    """Fit and save the model. Returns its metadata; raises ValueError on too little history."""
+    from sklearn.metrics import roc_auc_score, brier_score_loss
+
+    min_rows = min_rows or current_app.config['NOSHOW_MIN_ROWS']
+    frame = _frame(db.session.execute(_closed_appointments()).all(),
+                   ['patient_id', 'date', 'time', 'created_at', 'status', 'department_id'])
+    if len(frame) < min_rows:
+        raise ValueError(f"{len(frame)} closed appointments, need at least {min_rows}")
+    frame['missed'] = (frame['status'] == 'Missed').astype(int)
+    if frame['missed'].nunique() < 2:
+        raise ValueError("history has no missed or no completed appointments")
+
+    # Each appointment only sees the patient's earlier ones
+    frame = frame.sort_values(['patient_id', 'date', 'time'], kind='stable').reset_index(drop=True)
+    by_patient = frame.groupby('patient_id')['missed']
+    frame['prior_missed'] = by_patient.cumsum() - frame['missed']
+    frame['prior_visits'] = by_patient.cumcount()
+
+    base_rate = float(frame['missed'].mean())
+    X, y = features(frame, base_rate), frame['missed'].to_numpy()
+
+    # Hold out the most recent 20% to report how well it ranks future appointments
+    order = frame['date'].argsort(kind='stable').to_numpy()
+    cut = int(len(order) * 0.8)
+    train_idx, test_idx = order[:cut], order[cut:]
+    auc = brier = None
+    if len(set(y[train_idx])) == 2 and len(set(y[test_idx])) == 2:
+        holdout = _pipeline().fit(X.iloc[train_idx], y[train_idx])
+        predicted = holdout.predict_proba(X.iloc[test_idx])[:, 1]
+        auc = round(float(roc_auc_score(y[test_idx], predicted)), 3)
+        brier = round(float(brier_score_loss(y[test_idx], predicted)), 4)
+
+    bundle = {
+        'model': _pipeline().fit(X, y),
+        'base_rate': round(base_rate, 4),
+        'rows': len(frame),
+        'auc': auc,
+        'brier': brier,
+        'trained_at': datetime.utcnow().isoformat(timespec='seconds'),
+    }
+    save_model(bundle)
+    return {k: v for k, v in bundle.items() if k != 'model'}
+
+
+def model_path():
+    """NOSHOW_MODEL_DIR/noshow.joblib, per tenant like the database backups."""
+    tenant = current_tenant()
+    directory = current_app.config['NOSHOW_MODEL_DIR']
+    return os.path.join(directory, tenant, 'noshow.joblib') if tenant else os.path.join(directory, 'noshow.joblib')
+
+
+def save_model(bundle):
+    import joblib
+
+    path = model_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(bundle, tmp)
+    os.replace(tmp, path)
+
+
+def load_model():
+    """The saved model bundle, cached until the file changes. None before the first training."""
+    path = model_path()
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    tenant = current_tenant()
+    with _model_lock:
+        cached_mtime, bundle = _model_cache.get(tenant, (None, None))
+        if cached_mtime == mtime:
+            return bundle
+
+    import joblib
+    bundle = joblib.load(path)
+    with _model_lock:
+        _model_cache[tenant] = (mtime, bundle)
+    return bundle
+
+
+# ---------------- SCORING ---------------- #
+
+def score_upcoming():
+    """Score every upcoming Booked appointment. Returns how many were scored."""
+    bundle = load_model()
+    if bundle is None:
+        current_app.logger.info("noshow: no model yet, run `flask noshow-train`")
+        return 0
+
+    today = date.today()
+    upcoming = _frame(db.session.execute(
+        select(Appointment.id, Appointment.patient_id, Appointment.date, Appointment.time,
+               Appointment.created_at, User.department_id)
+        .join(User, User.id == Appointment.doctor_id)
+        .where(Appointment.status == 'Booked', Appointment.date >= today)
+    ).all(), ['id', 'patient_id', 'date', 'time', 'created_at', 'department_id'])
+
+    if len(upcoming):
+        closed = _closed_appointments().subquery()
+        history = dict(
+            (patient_id, (missed, visits)) for patient_id, missed, visits in db.session.execute(
+                select(closed.c.patient_id,
+                       func.sum(case((closed.c.status == 'Missed', 1), else_=0)),
+                       func.count())
+                .where(closed.c.patient_id.in_(set(upcoming['patient_id'].tolist())))
+                .group_by(closed.c.patient_id)
+            )
+        )
+        upcoming['prior_missed'] = upcoming['patient_id'].map(lambda p: history.get(p, (0, 0))[0])
+        upcoming['prior_visits'] = upcoming['patient_id'].map(lambda p: history.get(p, (0, 0))[1])
+        probabilities = bundle['model'].predict_proba(features(upcoming, bundle['base_rate']))[:, 1]
+
+        now = datetime.utcnow()
+        rows = [
+            {'appointment_id': int(appointment_id), 'probability': round(float(p), 4),
+             'model_version': bundle['trained_at'], 'scored_at': now}
+            for appointment_id, p in zip(upcoming['id'], probabilities)
+        ]
+        stmt = sqlite_insert(NoShowScore)
+        stmt = stmt.on_conflict_do_update(index_elements=['appointment_id'], set_={
+            'probability': stmt.excluded.probability,
+            'model_version': stmt.excluded.model_version,
+            'scored_at': stmt.excluded.scored_at,
+        })
+        for start in range(0, len(rows), 500):
+            db.session.execute(stmt, rows[start:start + 500])
+
+    # Scores of appointments that were cancelled, completed, missed or archived
+    db.session.execute(delete(NoShowScore).where(NoShowScore.appointment_id.not_in(
+        select(Appointment.id).where(Appointment.status == 'Booked', Appointment.date >= today)
+    )))
+    db.session.commit()
+    return len(upcoming)
+
+
+@job('noshow_score', max_attempts=3)
+def noshow_score_job():
+    scored = score_upcoming()
+    current_app.logger.info("noshow: scored %d upcoming appointments", scored)
+
+
+def overbook_allowed(doctor_id, day, at, patient_id):
+    """
+    Whether `patient_id` may book the doctor's occupied slot: fewer than
+    NOSHOW_OVERBOOK_LEVEL extra bookings there so far, every booking in it
+    scored, and the chance that all of them are no-shows at least
+    NOSHOW_OVERBOOK_THRESHOLD.
+    """
+    config = current_app.config
+    if not config['NOSHOW_OVERBOOK_LEVEL']:
+        return False
+
+    booked = db.session.execute(
+        select(Appointment.patient_id, NoShowScore.probability)
+        .outerjoin(NoShowScore, NoShowScore.appointment_id == Appointment.id)
+        .where(Appointment.doctor_id == doctor_id, Appointment.date == day, Appointment.time == at,
+               Appointment.status == 'Booked')
+    ).all()
+    if not booked or len(booked) > config['NOSHOW_OVERBOOK_LEVEL']:
+        return False
+    if any(p == patient_id or probability is None for p, probability in booked):
+        return False
+
+    all_absent = 1.0
+    for _, probability in booked:
+        all_absent *= probability
+    return all_absent >= config['NOSHOW_OVERBOOK_THRESHOLD']
+
+
+def init_noshow(app):
+    app.config.setdefault('NOSHOW_MODEL_DIR', os.path.join(app.instance_path, 'models'))
+    app.config.setdefault('NOSHOW_MIN_ROWS', 200)                # closed appointments needed to train
+    app.config.setdefault('NOSHOW_OVERBOOK_LEVEL', 0)            # extra bookings allowed per slot; 0 = never
+    app.config.setdefault('NOSHOW_OVERBOOK_THRESHOLD', 0.5)      # min. chance that everyone booked stays away
+
+    @app.cli.command('noshow-train')
+    @click.option('--min-rows', type=int, default=None, help='Minimum history (default NOSHOW_MIN_ROWS).')
+    @click.option('--score', is_flag=True, help='Score upcoming appointments with the new model right away.')
+    def noshow_train_command(min_rows, score):
+        """Fit the no-show model on appointment history."""
+        try:
+            info = train(min_rows)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"trained on {info['rows']} appointments, missed rate {info['base_rate']:.1%}, "
+                   f"holdout AUC {info['auc']}, Brier {info['brier']}")
+        if score:
+            click.echo(f"scored {score_upcoming()} upcoming appointments")
+
+    @app.route('/admin/noshow_stats')
+    @login_required
+    def admin_noshow_stats():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        bundle = load_model()
+        threshold = app.config['NOSHOW_OVERBOOK_THRESHOLD']
+        scored, mean, risky = db.session.execute(
+            select(func.count(), func.avg(NoShowScore.probability),
+                   func.sum(case((NoShowScore.probability >= threshold, 1), else_=0)))
+        ).one()
+        overbooked = db.session.execute(
+            select(func.count()).select_from(
+                select(Appointment.doctor_id).where(Appointment.status == 'Booked', Appointment.date >= date.today())
+                .group_by(Appointment.doctor_id, Appointment.date, Appointment.time)
+                .having(func.count() > 1).subquery()
+            )
+        ).scalar()
+        return jsonify({
+            'model': {k: v for k, v in bundle.items() if k != 'model'} if bundle else None,
+            'scored': scored,
+            'mean_probability': round(mean, 4) if mean is not None else None,
+            'high_risk': risky or 0,
+            'overbooked_slots': overbooked,
+            'overbook_level': app.config['NOSHOW_OVERBOOK_LEVEL'],
+            'overbook_threshold': threshold,
+        })
@@ -0,0 +1,296 @@
+"""
+Live sampling profiler for selected endpoints.
+
+An admin turns profiling on at /admin/profiling, picks endpoints and a
+sample rate. The settings live in a small control file in the instance
+folder, which every worker process re-reads at most every
+PROFILE_CHECK_INTERVAL seconds, so changes need no restart.
+
+A sampled request registers its thread with the process's sampler thread,
+which records the thread's full Python stack every PROFILE_INTERVAL_MS
+(view code, ORM and Jinja alike) until the request ends. Stacks are
+aggregated per endpoint and written to instance/profiles/<endpoint>-<pid>.json;
+the download merges all processes into one collapsed-stack file
+("frame;frame;frame count" lines) for flamegraph.pl or speedscope.
+
+Disabled, the only cost per request is one clock read and a flag check.
+
+Sampling needs the thread worker (serve.py's default). Under
+`--worker-class gevent` a request runs in a greenlet: threading.get_ident()
+is the greenlet's id, which sys._current_frames() does not know, and the
+sampler itself would be a greenlet that only runs when requests yield. Such
+processes skip profiling, and the admin page says so.
+"""
+import glob
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time as _time
+from collections import Counter
+
+from flask import Response, render_template, request, redirect, url_for, flash, g, abort
+from flask_login import login_required, current_user
+
+ENDPOINT_RE = re.compile(r'^[\w.]+$')
+MAX_DEPTH = 128
+
+DEFAULT_CONTROL = {'enabled': False, 'rate': 0.05, 'endpoints': [], 'generation': 0}
+
+
+def greenlet_workers():
+    """True when gevent has patched threading, i.e. requests run in greenlets."""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def _frame_name(code):
+    """'sqlalchemy/orm/query.py:all', 'app/routes.py:admin_dashboard', 'threading.py:run'."""
+    path = code.co_filename.replace(os.sep, '/')
+    if 'site-packages/' in path:
+        path = path.rsplit('site-packages/', 1)[1]
+    elif '/app/' in path:
+        path = 'app/' + path.rsplit('/app/', 1)[1]
+    else:
+        path = path.rsplit('/', 1)[-1]
+    return f"{path}:{code.co_name}"
+
+
+def collapse(frame):
+    """Stack of `frame` from the Flask entry point down, as a collapsed-stack key."""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        if frame.f_code.co_name == 'wsgi_app' and 'flask/' in names[-1]:
+            break
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiles:
+    """Per-process stack counts per endpoint, written to PROFILE_DIR for the download."""
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._targets = {}       # thread id -> endpoint
+        self._wake = threading.Event()
+        self._pid = None
+        self._data = {}          # endpoint -> {'requests': int, 'samples': int, 'stacks': Counter}
+        self._written = {}       # endpoint -> monotonic time of the last write
+        self._control = dict(DEFAULT_CONTROL)
+        self._control_mtime = None
+        self._next_check = 0.0
+
+    # ---- control file ----
+
+    def control_path(self):
+        return os.path.join(self.app.instance_path, 'profiling.json')
+
+    def control(self):
+        """Current settings, re-read from disk at most every PROFILE_CHECK_INTERVAL seconds."""
+        now = _time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.app.config['PROFILE_CHECK_INTERVAL']
+            self._reload()
+        return self._control
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.control_path()).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._control_mtime:
+            return
+        try:
+            with open(self.control_path()) as f:
+                control = dict(DEFAULT_CONTROL, **json.load(f))
+        except (FileNotFoundError, ValueError):
+            control = dict(DEFAULT_CONTROL)
+        control['endpoints'] = set(control['endpoints'])
+        if control['generation'] != self._control['generation']:
+            # Reset from any process: drop what this one collected so far
+            with self._lock:
+                self._data = {}
+        self._control, self._control_mtime = control, mtime
+
+    def save_control(self, **changes):
+        control = {k: v for k, v in self.control().items()}
+        control.update(changes)
+        control['endpoints'] = sorted(control['endpoints'])
+        os.makedirs(self.app.instance_path, exist_ok=True)
+        tmp = self.control_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(control, f)
+        os.replace(tmp, self.control_path())
+        self._next_check = 0.0
+
+    # ---- sampling ----
+
+    def start(self, endpoint):
+        with self._lock:
+            # Threads do not survive fork(): start the sampler lazily, once per process
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._data = {}
+                self._wake = threading.Event()
+                threading.Thread(target=self._run, name="profiler", daemon=True).start()
+            self._targets[threading.get_ident()] = endpoint
+        self._wake.set()
+
+    def stop(self, endpoint):
+        with self._lock:
+            self._targets.pop(threading.get_ident(), None)
+            entry = self._data.setdefault(endpoint, {'requests': 0, 'samples': 0, 'stacks': Counter()})
+            entry['requests'] += 1
+        now = _time.monotonic()
+        if now - self._written.get(endpoint, 0) >= self.app.config['PROFILE_WRITE_INTERVAL']:
+            self.write(endpoint)
+
+    def _run(self):
+        while True:
+            if not self._targets:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, endpoint in self._targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    entry = self._data.setdefault(endpoint, {'requests': 0, 'samples': 0, 'stacks': Counter()})
+                    entry['samples'] += 1
+                    entry['stacks'][collapse(frame)] += 1
+            del frames
+            _time.sleep(self.app.config['PROFILE_INTERVAL_MS'] / 1000)
+
+    # ---- storage ----
+
+    def _dir(self):
+        return self.app.config['PROFILE_DIR']
+
+    def write(self, endpoint):
+        with self._lock:
+            entry = self._data.get(endpoint)
+            if entry is None:
+                return
+            payload = {'requests': entry['requests'], 'samples': entry['samples'], 'stacks': dict(entry['stacks'])}
+        self._written[endpoint] = _time.monotonic()
+        os.makedirs(self._dir(), exist_ok=True)
+        path = os.path.join(self._dir(), f"{endpoint}-{os.getpid()}.json")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(payload, f)
+        os.replace(tmp, path)
+
+    def write_all(self):
+        if self._pid == os.getpid():
+            for endpoint in list(self._data):
+                self.write(endpoint)
+
+    def merged(self):
+        """endpoint -> {'requests', 'samples', 'stacks'} summed over every process's file."""
+        merged = {}
+        for path in glob.glob(os.path.join(self._dir(), '*.json')):
+            endpoint = os.path.basename(path).rsplit('-', 1)[0]
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            entry = merged.setdefault(endpoint, {'requests': 0, 'samples': 0, 'stacks': Counter()})
+            entry['requests'] += data['requests']
+            entry['samples'] += data['samples']
+            entry['stacks'].update(data['stacks'])
+        return merged
+
+    def reset(self):
+        for path in glob.glob(os.path.join(self._dir(), '*.json')):
+            os.remove(path)
+        with self._lock:
+            self._data = {}
+        self.save_control(generation=self.control()['generation'] + 1)
+
+
+def init_profiling(app):
+    app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+    app.config.setdefault('PROFILE_INTERVAL_MS', 5)        # stack sampling period of a profiled request
+    app.config.setdefault('PROFILE_CHECK_INTERVAL', 2.0)   # seconds between reads of the control file
+    app.config.setdefault('PROFILE_WRITE_INTERVAL', 5.0)   # seconds between writes of an endpoint's profile
+
+    profiles = Profiles(app)
+    app.extensions['profiles'] = profiles
+
+    @app.before_request
+    def maybe_profile():
+        control = profiles.control()
+        if not control['enabled'] or greenlet_workers():
+            return None
+        endpoint = request.endpoint
+        if endpoint is None or (control['endpoints'] and endpoint not in control['endpoints']):
+            return None
+        if random.random() >= control['rate']:
+            return None
+        g.profiled_endpoint = endpoint
+        profiles.start(endpoint)
+        return None
+
+    @app.teardown_request
+    def finish_profile(exc):
+        endpoint = g.pop('profiled_endpoint', None)
+        if endpoint is not None:
+            profiles.stop(endpoint)
+
+    @app.route('/admin/profiling', methods=['GET', 'POST'])
+    @login_required
+    def admin_profiling():
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        if request.method == 'POST':
+            if request.form.get('action') == 'reset':
+                profiles.reset()
+                flash('Collected profiles discarded.', 'info')
+            else:
+                rate = request.form.get('rate', type=float)
+                if rate is None or not 0 < rate <= 1:
+                    flash('Sample rate must be between 0 and 1.', 'danger')
+                    return redirect(url_for('admin_profiling'))
+                endpoints = [e for e in request.form.getlist('endpoints') if e in app.view_functions]
+                enabled = request.form.get('action') == 'start'
+                profiles.save_control(enabled=enabled, rate=rate, endpoints=endpoints)
+                flash('Profiling started.' if enabled else 'Profiling stopped.', 'success')
+            return redirect(url_for('admin_profiling'))
+
+        profiles.write_all()
+        collected = profiles.merged()
+        return render_template(
+            'admin_profiling.html',
+            control=profiles.control(),
+            endpoints=sorted(e for e in app.view_functions if e != 'static'),
+            collected=sorted(collected.items(), key=lambda kv: -kv[1]['samples']),
+            interval_ms=app.config['PROFILE_INTERVAL_MS'],
+            greenlets=greenlet_workers()
+        )
+
+    @app.route('/admin/profiling/<name>.folded')
+    @login_required
+    def download_profile(name):
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+        if not ENDPOINT_RE.match(name):
+            abort(404)
+
+        profiles.write_all()
+        entry = profiles.merged().get(name)
+        if entry is None:
+            abort(404)
+        body = ''.join(f"{stack} {count}\n" for stack, count in entry['stacks'].most_common())
+        return Response(body, mimetype='text/plain', headers={
+            'Content-Disposition': f'attachment; filename="{name}.folded"'
+        })
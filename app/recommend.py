@@ -0,0 +1,231 @@
+"""
+Slot recommender: spread bookings across a department's doctors.
+
+Given a department and a date range, every open slot of every active
+doctor in the department is scored at once (numpy arrays, one row per
+slot) on three things:
+
+    utilization  how full the doctor's calendar is over the next
+                 RECOMMEND_LOAD_DAYS days (emptier is better)
+    wait         how soon the slot is
+    continuity   whether the patient has been treated by this doctor,
+                 in the hot or the archive tables
+
+Per-doctor load comes from two grouped queries and is cached per process
+for RECOMMEND_LOAD_TTL seconds, so a recommendation costs three indexed
+reads plus array arithmetic. numpy is imported on first use only.
+"""
+import threading
+import time as _time
+from datetime import date, datetime, timedelta
+
+from flask import current_app, request, jsonify
+from flask_login import current_user
+from sqlalchemy import func
+
+from .models import db, User, Appointment, ArchivedAppointment, DoctorAvailability, Department
+from .api import ApiError, API_PREFIX
+from .tenancy import current_tenant
+
+DEFAULT_WEIGHTS = {'utilization': 0.5, 'wait': 0.3, 'continuity': 0.2}
+
+# tenant -> (computed_at, loads)
+_load_cache = {}
+_load_lock = threading.Lock()
+
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def doctor_loads():
+    """doctor_id -> booked share of the doctor's availability over the next RECOMMEND_LOAD_DAYS days."""
+    config = current_app.config
+    tenant = current_tenant()
+    with _load_lock:
+        computed_at, loads = _load_cache.get(tenant, (None, None))
+        if computed_at is not None and _time.monotonic() - computed_at < config['RECOMMEND_LOAD_TTL']:
+            return loads
+
+    today = date.today()
+    horizon = today + timedelta(days=config['RECOMMEND_LOAD_DAYS'])
+    slot = config['CALENDAR_SLOT_MINUTES']
+
+    capacity = {}
+    for doctor_id, start, end in (
+        db.session.query(DoctorAvailability.doctor_id, DoctorAvailability.start_time, DoctorAvailability.end_time)
+        .filter(DoctorAvailability.date >= today, DoctorAvailability.date < horizon)
+    ):
+        capacity[doctor_id] = capacity.get(doctor_id, 0) + max(0, _minutes(end) - _minutes(start)) // slot
+
+    booked = dict(
+        db.session.query(Appointment.doctor_id, func.count(Appointment.id))
+        .filter(Appointment.status == 'Booked', Appointment.date >= today, Appointment.date < horizon)
+        .group_by(Appointment.doctor_id)
+    )
+
+    loads = {
+        doctor_id: min(1.0, booked.get(doctor_id, 0) / slots) if slots else 1.0
+        for doctor_id, slots in capacity.items()
+    }
+    with _load_lock:
+        _load_cache[tenant] = (_time.monotonic(), loads)
+    return loads
+
+
+def recommend(department_id, date_from, date_to, patient_id=None, limit=5, per_doctor=2):
+    """Best open slots in the department, as dicts sorted by score."""
+    import numpy as np
+
+    config = current_app.config
+    weights = config['RECOMMEND_WEIGHTS']
+    slot = config['CALENDAR_SLOT_MINUTES']
+
+    doctors = dict(
+        db.session.query(User.id, User.name)
+        .filter(User.role == 'doctor', User.is_active == True, User.department_id == department_id)  # noqa: E712
+    )
+    if not doctors:
+        return []
+    doctor_ids = np.fromiter(doctors, dtype=np.int64)
+
+    blocks = (
+        db.session.query(DoctorAvailability.doctor_id, DoctorAvailability.date,
+                         DoctorAvailability.start_time, DoctorAvailability.end_time)
+        .filter(DoctorAvailability.doctor_id.in_(doctors),
+                DoctorAvailability.date >= date_from, DoctorAvailability.date <= date_to)
+        .all()
+    )
+    if not blocks:
+        return []
+
+    # ---- expand availability blocks into one row per slot ----
+    block_doctor = np.array([b.doctor_id for b in blocks], dtype=np.int64)
+    block_day = np.array([(b.date - date_from).days for b in blocks], dtype=np.int64)
+    block_start = np.array([_minutes(b.start_time) for b in blocks], dtype=np.int64)
+    block_end = np.array([_minutes(b.end_time) for b in blocks], dtype=np.int64)
+    counts = np.maximum(0, (block_end - block_start + slot - 1) // slot)
+
+    doctor = np.repeat(block_doctor, counts)
+    day = np.repeat(block_day, counts)
+    # position of each slot inside its block: 0, 1, 2, ... per block
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    minute = np.repeat(block_start, counts) + offsets * slot
+
+    # ---- drop slots that are booked, duplicated or already past ----
+    days = (date_to - date_from).days + 1
+    key = (doctor * days + day) * 1440 + minute
+    booked = (
+        db.session.query(Appointment.doctor_id, Appointment.date, Appointment.time)
+        .filter(Appointment.doctor_id.in_(doctors), Appointment.status == 'Booked',
+                Appointment.date >= date_from, Appointment.date <= date_to)
+        .all()
+    )
+    booked_keys = np.array(
+        [(d * days + (dt - date_from).days) * 1440 + _minutes(t) for d, dt, t in booked], dtype=np.int64
+    )
+    keep = ~np.isin(key, booked_keys)
+
+    now = datetime.now()
+    if date_from <= now.date():
+        keep &= ~((day < (now.date() - date_from).days) |
+                  ((day == (now.date() - date_from).days) & (minute <= _minutes(now.time()))))
+
+    _, first = np.unique(key, return_index=True)   # overlapping availability blocks
+    unique = np.zeros(key.shape, dtype=bool)
+    unique[first] = True
+    keep &= unique
+
+    doctor, day, minute = doctor[keep], day[keep], minute[keep]
+    if doctor.size == 0:
+        return []
+
+    # ---- score ----
+    loads = doctor_loads()
+    order = np.argsort(doctor_ids)
+    index = order[np.searchsorted(doctor_ids, doctor, sorter=order)]
+    utilization = np.array([loads.get(int(d), 1.0) for d in doctor_ids])[index]
+
+    wait = day / max(1, days - 1) if days > 1 else np.zeros(day.shape)
+
+    continuity = np.zeros(doctor.shape)
+    if patient_id is not None:
+        seen = {}
+        for model in (Appointment, ArchivedAppointment):
+            for doctor_id, visits in (
+                db.session.query(model.doctor_id, func.count(model.id))
+                .filter(model.patient_id == patient_id, model.status == 'Completed',
+                        model.doctor_id.in_(doctors))
+                .group_by(model.doctor_id)
+            ):
+                seen[doctor_id] = seen.get(doctor_id, 0) + visits
+        visits = np.array([seen.get(int(d), 0) for d in doctor_ids], dtype=float)
+        continuity = np.minimum(visits, 3)[index] / 3
+
+    score = (weights['utilization'] * (1 - utilization)
+             + weights['wait'] * (1 - wait)
+             + weights['continuity'] * continuity)
+
+    # ---- best slots, at most `per_doctor` per doctor ----
+    results = []
+    taken = {}
+    for i in np.lexsort((minute, day, -score)):
+        doctor_id = int(doctor[i])
+        if taken.get(doctor_id, 0) >= per_doctor:
+            continue
+        taken[doctor_id] = taken.get(doctor_id, 0) + 1
+        results.append({
+            'doctor_id': doctor_id,
+            'doctor': doctors[doctor_id],
+            'date': (date_from + timedelta(days=int(day[i]))).isoformat(),
+            'time': f"{int(minute[i]) // 60:02d}:{int(minute[i]) % 60:02d}",
+            'score': round(float(score[i]), 3),
+            'utilization': round(float(utilization[i]), 3),
+            'continuity': bool(continuity[i] > 0),
+        })
+        if len(results) >= limit:
+            break
+    return results
+
+
+def init_recommend(app):
+    app.config.setdefault('RECOMMEND_WEIGHTS', DEFAULT_WEIGHTS)
+    app.config.setdefault('RECOMMEND_LOAD_DAYS', 14)    # window used for per-doctor utilization
+    app.config.setdefault('RECOMMEND_LOAD_TTL', 300)    # seconds the per-doctor load is cached
+    app.config.setdefault('RECOMMEND_MAX_DAYS', 31)
+
+    @app.route(API_PREFIX + '/recommendations')
+    def api_recommendations():
+        # Authentication is enforced for /api/v1/* in app/api.py
+        department_id = request.args.get('department_id', type=int)
+        if not department_id or db.session.get(Department, department_id) is None:
+            raise ApiError(400, "department_id is required")
+
+        today = date.today()
+        try:
+            date_from = datetime.strptime(request.args['date_from'], "%Y-%m-%d").date() \
+                if request.args.get('date_from') else today
+            date_to = datetime.strptime(request.args['date_to'], "%Y-%m-%d").date() \
+                if request.args.get('date_to') else date_from + timedelta(days=6)
+        except ValueError:
+            raise ApiError(400, "dates must be YYYY-MM-DD")
+        date_from = max(date_from, today)
+        if date_to < date_from:
+            raise ApiError(400, "date_to is before date_from")
+        date_to = min(date_to, date_from + timedelta(days=app.config['RECOMMEND_MAX_DAYS'] - 1))
+
+        limit = max(1, min(request.args.get('limit', 5, type=int), 50))
+        # Patients get their own continuity; only admins may ask on behalf of another patient
+        if current_user.role == 'patient':
+            patient_id = current_user.id
+        elif current_user.role == 'admin':
+            patient_id = request.args.get('patient_id', type=int)
+        else:
+            patient_id = None
+
+        return jsonify({
+            'department_id': department_id,
+            'date_from': date_from.isoformat(),
+            'date_to': date_to.isoformat(),
+            'data': recommend(department_id, date_from, date_to, patient_id, limit)
+        })
@@ -0,0 +1,313 @@
+"""
+Batch treatment reports: every report for a patient, a doctor, a
+department or a date range, as one ZIP of printable HTML documents.
+
+An admin submits a filter at /admin/reports; the export runs as a background
+job, so no web request waits for it. The job streams treatments joined
+with their appointment, doctor and patient from the hot and archive tables
+in keyset pages (one query per page), hands them as plain rows to a pool of
+REPORT_PROCESSES worker processes for Jinja rendering, and writes the
+results into the archive as they come back. Progress (done / total) is
+stored on the export row and polled by the page.
+
+Pool workers use a bare Jinja environment (no Flask app, no database), so
+the template only sees the row passed to it.
+"""
+import json
+import os
+import re
+import time as _time
+from datetime import date, datetime, timedelta
+
+from flask import current_app, render_template, request, redirect, url_for, flash, jsonify, send_file, abort
+from flask_login import login_required, current_user
+from sqlalchemy import select, func, union_all, literal, tuple_
+from sqlalchemy.orm import aliased
+
+from .models import (db, User, Department, Appointment, Treatment, ArchivedAppointment, ArchivedTreatment,
+                     ReportExport)
+from .jobs import job, enqueue
+from .tenancy import current_tenant
+
+TEMPLATE = 'treatment_report_print.html'
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+FILTER_FIELDS = ('patient_id', 'doctor_id', 'department_id', 'date_from', 'date_to')
+
+
+# ---------------- QUERY ---------------- #
+
+def _report_select(treatment_model, appointment_model, filters, after):
+    Doctor = aliased(User)
+    Patient = aliased(User)
+    stmt = (
+        select(
+            treatment_model.id.label('treatment_id'),
+            treatment_model.diagnosis, treatment_model.prescription, treatment_model.notes,
+            appointment_model.id.label('appointment_id'),
+            appointment_model.date, appointment_model.time,
+            Patient.id.label('patient_id'), Patient.name.label('patient_name'),
+            Patient.email.label('patient_email'), Patient.phone.label('patient_phone'),
+            Doctor.id.label('doctor_id'), Doctor.name.label('doctor_name'),
+            Department.name.label('department'),
+            literal(appointment_model is ArchivedAppointment).label('archived'),
+        )
+        .join(appointment_model, treatment_model.appointment_id == appointment_model.id)
+        .join(Patient, Patient.id == appointment_model.patient_id)
+        .join(Doctor, Doctor.id == appointment_model.doctor_id)
+        .outerjoin(Department, Department.id == Doctor.department_id)
+    )
+    if filters.get('patient_id'):
+        stmt = stmt.where(appointment_model.patient_id == filters['patient_id'])
+    if filters.get('doctor_id'):
+        stmt = stmt.where(appointment_model.doctor_id == filters['doctor_id'])
+    if filters.get('department_id'):
+        stmt = stmt.where(Doctor.department_id == filters['department_id'])
+    if filters.get('date_from'):
+        stmt = stmt.where(appointment_model.date >= date.fromisoformat(filters['date_from']))
+    if filters.get('date_to'):
+        stmt = stmt.where(appointment_model.date <= date.fromisoformat(filters['date_to']))
+    if after is not None:
+        stmt = stmt.where(tuple_(appointment_model.patient_id, treatment_model.id) > tuple_(*after))
+    return stmt
+
+
+def report_query(filters, after=None):
+    """Hot and archived treatments matching `filters`, ordered by (patient_id, treatment_id)."""
+    rows = union_all(
+        _report_select(Treatment, Appointment, filters, after),
+        _report_select(ArchivedTreatment, ArchivedAppointment, filters, after),
+    ).subquery()
+    return select(rows).order_by(rows.c.patient_id, rows.c.treatment_id)
+
+
+def count_reports(filters):
+    return db.session.execute(select(func.count()).select_from(report_query(filters).subquery())).scalar()
+
+
+def iter_report_pages(filters, page_size):
+    """
+    Matching rows, page by page. Each page is a separate short read continuing
+    after the last (patient_id, treatment_id) seen, so no SQLite read lock is
+    held while the pages are rendered and writers are never starved.
+    """
+    after = None
+    while True:
+        page = db.session.execute(report_query(filters, after).limit(page_size)).mappings().all()
+        db.session.commit()
+        if not page:
+            return
+        yield page
+        after = (page[-1]['patient_id'], page[-1]['treatment_id'])
+
+
+def parse_filters(form):
+    """Filters from a submitted form, or raise ValueError."""
+    filters = {}
+    for field in ('patient_id', 'doctor_id', 'department_id'):
+        value = form.get(field, type=int)
+        if value:
+            filters[field] = value
+    for field in ('date_from', 'date_to'):
+        if form.get(field):
+            try:
+                filters[field] = date.fromisoformat(form[field]).isoformat()
+            except ValueError:
+                raise ValueError("Dates must be YYYY-MM-DD.")
+    if not filters:
+        raise ValueError("Choose at least one filter.")
+    if filters.get('date_from') and filters.get('date_to') and filters['date_from'] > filters['date_to']:
+        raise ValueError("The start date is after the end date.")
+    return filters
+
+
+# ---------------- RENDERING (runs in pool workers) ---------------- #
+
+_env = None
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', (text or '').lower()).strip('-') or 'unknown'
+
+
+def render_chunk(rows, generated_at):
+    """[(archive name, html)] for a list of report rows. Runs in a worker process."""
+    global _env
+    if _env is None:
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+        _env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(['html']))
+    template = _env.get_template(TEMPLATE)
+    return [
+        (
+            f"patient-{r['patient_id']}-{_slug(r['patient_name'])}/{r['date']}-treatment-{r['treatment_id']}.html",
+            template.render(r=r, generated_at=generated_at)
+        )
+        for r in rows
+    ]
+
+
+# ---------------- EXPORT JOB ---------------- #
+
+def export_dir():
+    """REPORT_DIR, per tenant like the database backups."""
+    tenant = current_tenant()
+    directory = current_app.config['REPORT_DIR']
+    return os.path.join(directory, tenant) if tenant else directory
+
+
+def _progress(export, **values):
+    for key, value in values.items():
+        setattr(export, key, value)
+    db.session.commit()
+
+
+def build_export(export):
+    """Render every report of `export` into a ZIP. Returns the archive path."""
+    import zipfile
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    import multiprocessing
+
+    config = current_app.config
+    filters = json.loads(export.filters)
+    _progress(export, status='running', done=0, total=count_reports(filters), error=None)
+
+    os.makedirs(export_dir(), exist_ok=True)
+    path = os.path.join(export_dir(), f"treatment-reports-{export.id}.zip")
+    partial = path + '.partial'
+    generated_at = datetime.now().strftime('%Y-%m-%d %H:%M')
+    chunk_size = config['REPORT_CHUNK_SIZE']
+    processes = config['REPORT_PROCESSES'] or os.cpu_count() or 1
+    index = []
+
+    # spawn: forking a process that runs server and job threads is not safe
+    context = multiprocessing.get_context(config['REPORT_MP_CONTEXT'])
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool, \
+            zipfile.ZipFile(partial, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        in_flight = set()
+
+        def drain(until):
+            nonlocal in_flight
+            while len(in_flight) > until:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    for name, html in future.result():
+                        archive.writestr(name, html)
+                        index.append(name)
+                _progress(export, done=len(index))
+
+        for page in iter_report_pages(filters, chunk_size):
+            chunk = [{**row, 'date': row['date'].isoformat(), 'time': row['time'].strftime('%H:%M')}
+                     for row in page]
+            in_flight.add(pool.submit(render_chunk, chunk, generated_at))
+            # Bounded read-ahead: at most two chunks per process in memory
+            drain(2 * processes)
+        drain(0)
+
+        archive.writestr('index.txt', ''.join(f"{name}\n" for name in sorted(index)))
+
+    os.replace(partial, path)
+    return path
+
+
+def prune_exports():
+    """Delete archives older than REPORT_RETENTION_DAYS."""
+    cutoff = datetime.utcnow() - timedelta(days=current_app.config['REPORT_RETENTION_DAYS'])
+    for export in ReportExport.query.filter(ReportExport.status == 'done', ReportExport.finished_at < cutoff):
+        if export.path and os.path.exists(export.path):
+            os.remove(export.path)
+        export.status = 'expired'
+    db.session.commit()
+
+
+@job('treatment_reports', max_attempts=2)
+def treatment_reports_job(export_id):
+    export = db.session.get(ReportExport, export_id)
+    if export is None:
+        return
+    started = _time.perf_counter()
+    try:
+        path = build_export(export)
+    except Exception as e:
+        db.session.rollback()
+        _progress(export, status='failed', error=f"{type(e).__name__}: {e}", finished_at=datetime.utcnow())
+        raise
+    _progress(export, status='done', path=path, size=os.path.getsize(path), finished_at=datetime.utcnow())
+    current_app.logger.info("report export %s: %s reports in %.1fs", export.id, export.done,
+                            _time.perf_counter() - started)
+    prune_exports()
+
+
+def _export_json(export):
+    return {
+        'id': export.id,
+        'status': export.status,
+        'done': export.done,
+        'total': export.total,
+        'size': export.size,
+        'error': export.error,
+        'download': url_for('download_report_export', export_id=export.id) if export.status == 'done' else None,
+    }
+
+
+def init_reports(app):
+    app.config.setdefault('REPORT_DIR', os.path.join(app.instance_path, 'reports'))
+    app.config.setdefault('REPORT_PROCESSES', None)      # render processes; None = one per CPU
+    app.config.setdefault('REPORT_CHUNK_SIZE', 50)       # reports per task sent to a process
+    app.config.setdefault('REPORT_MP_CONTEXT', 'spawn')
+    app.config.setdefault('REPORT_RETENTION_DAYS', 7)
+
+    @app.route('/admin/reports', methods=['GET', 'POST'])
+    @login_required
+    def admin_reports():
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        if request.method == 'POST':
+            try:
+                filters = parse_filters(request.form)
+            except ValueError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('admin_reports'))
+
+            total = count_reports(filters)
+            if not total:
+                flash('No treatment reports match these filters.', 'warning')
+                return redirect(url_for('admin_reports'))
+
+            export = ReportExport(requested_by=current_user.id, filters=json.dumps(filters), total=total)
+            db.session.add(export)
+            db.session.flush()
+            enqueue('treatment_reports', {'export_id': export.id})
+            db.session.commit()
+            flash(f'Export of {total} reports started.', 'success')
+            return redirect(url_for('admin_reports'))
+
+        exports = ReportExport.query.order_by(ReportExport.id.desc()).limit(20).all()
+        users = {u.id: u.name for u in User.query.filter(User.role != 'admin')}
+        return render_template(
+            'admin_reports.html',
+            exports=[(e, json.loads(e.filters or '{}')) for e in exports],
+            users=users,
+            doctors=User.query.filter_by(role='doctor').order_by(User.name).all(),
+            patients=User.query.filter_by(role='patient').order_by(User.name).all(),
+            departments=Department.query.order_by(Department.name).all()
+        )
+
+    @app.route('/admin/reports/<int:export_id>/status')
+    @login_required
+    def report_export_status(export_id):
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+        return jsonify(_export_json(db.session.get(ReportExport, export_id) or abort(404)))
+
+    @app.route('/admin/reports/<int:export_id>/download')
+    @login_required
+    def download_report_export(export_id):
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+        export = db.session.get(ReportExport, export_id) or abort(404)
+        if export.status != 'done' or not export.path or not os.path.exists(export.path):
+            abort(404)
+        return send_file(export.path, mimetype='application/zip', as_attachment=True,
+                         download_name=f"treatment-reports-{export.id}.zip")
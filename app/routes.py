@@ -1,9 +1,18 @@
 from . import login_manager
-from sqlalchemy import func
-from flask import render_template, request, redirect, url_for, flash, jsonify
+from sqlalchemy.orm import joinedload
+from flask import render_template, request, redirect, url_for, flash, jsonify, abort, session
 from flask_login import login_user, logout_user, login_required, current_user
-from datetime import datetime, date, time
+from datetime import datetime, date, time, timedelta
 from .models import db, User, Appointment, Treatment, DoctorAvailability, Department
+from .events import publish
+from .timeline import patient_timeline, doctor_can_view, cross_doctor_allowed
+from .archive import find_appointment, find_treatment, status_counts
+from .bulk import cancel_future_bookings, past_clause
+from .finder import invalidate_roster
+from .sync import next_version, tombstone_where
+from .tenancy import current_tenant
+from .noshow import overbook_allowed
+from .jobs import enqueue
 
 def init_routes(app):
 
@@ -16,6 +25,8 @@ def init_routes(app):
             user = User.query.filter_by(email=email).first()
             if user and user.check_password(password):
                 login_user(user)
+                # load_user only accepts the session in the clinic that issued it
+                session['tenant'] = current_tenant()
                 flash('Login successful!', 'success')
                 # Redirect based on role
                 if user.role == 'admin':
@@ -68,6 +79,8 @@ def init_routes(app):
             flash('Unauthorized access!', 'danger')
             return redirect(url_for('login'))
 
+        request_missed_sweep()
+
         # --- Summary stats ---
         total_doctors = User.query.filter_by(role='doctor').count()
         total_patients = User.query.filter_by(role='patient').count()
@@ -126,15 +139,11 @@ def init_routes(app):
         if current_user.role != 'admin':
             return jsonify({'error': 'Unauthorized'}), 403
 
-        # appointments per status
-        status_counts = (
-            db.session.query(Appointment.status, func.count(Appointment.id))
-            .group_by(Appointment.status)
-            .all()
-        )
+        # appointments per status (including archived ones)
+        totals = status_counts()
 
-        labels = [row[0] for row in status_counts]
-        counts = [row[1] for row in status_counts]
+        labels = list(totals.keys())
+        counts = list(totals.values())
 
         return jsonify({'labels': labels, 'counts': counts})
 
@@ -204,6 +213,7 @@ def init_routes(app):
             new_doctor.set_password(password)
             db.session.add(new_doctor)
             db.session.commit()
+            invalidate_roster()
             flash('Doctor added successfully!', 'success')
             return redirect(url_for('manage_doctors'))
 
@@ -239,6 +249,7 @@ def init_routes(app):
                 doctor.set_password(new_password)
 
             db.session.commit()
+            invalidate_roster()
             flash('Doctor details updated successfully!', 'success')
             return redirect(url_for('manage_doctors'))
 
@@ -294,11 +305,17 @@ def init_routes(app):
         doctor.is_active = False
 
         # Optional: Delete only *future* availability (not history)
+        tombstone_where(DoctorAvailability, [DoctorAvailability.doctor_id == doctor_id], next_version())
         DoctorAvailability.query.filter_by(doctor_id=doctor_id).delete()
 
+        # Upcoming bookings can no longer happen; cancel them in the same transaction
+        cancelled = cancel_future_bookings(doctor_id)
+
         db.session.commit()
+        invalidate_roster()
 
-        flash('Doctor deactivated. Medical records preserved.', 'info')
+        flash(f'Doctor deactivated. {cancelled} upcoming appointments cancelled. '
+              'Medical records preserved.', 'info')
         return redirect(url_for('manage_doctors'))
 
     @app.route('/admin/users')
@@ -326,6 +343,7 @@ def init_routes(app):
             user.phone = request.form.get('phone')
             user.role = request.form.get('role')
             db.session.commit()
+            invalidate_roster()
             flash('User details updated successfully!', 'success')
             return redirect(url_for('manage_users'))
 
@@ -342,6 +360,7 @@ def init_routes(app):
         user = User.query.get_or_404(user_id)
         db.session.delete(user)
         db.session.commit()
+        invalidate_roster()
         flash('User deleted successfully!', 'info')
         return redirect(url_for('manage_users'))
 
@@ -356,6 +375,7 @@ def init_routes(app):
         user = User.query.get_or_404(user_id)
         user.is_active = not user.is_active
         db.session.commit()
+        invalidate_roster()
 
         status = "unblocked" if user.is_active else "blocked"
         flash(f'User {status} successfully!', 'info')
@@ -387,22 +407,13 @@ def init_routes(app):
         doctor_id = request.args.get('doctor_id')
         patient_id = request.args.get('patient_id')
 
-        query = Appointment.query
-
-        if doctor_id and doctor_id != "0":
-            query = query.filter_by(doctor_id=int(doctor_id))
-
-        if patient_id and patient_id != "0":
-            query = query.filter_by(patient_id=int(patient_id))
-
-        data = (
-            query.with_entities(Appointment.status, func.count(Appointment.id))
-            .group_by(Appointment.status)
-            .all()
+        totals = status_counts(
+            doctor_id=int(doctor_id) if doctor_id and doctor_id != "0" else None,
+            patient_id=int(patient_id) if patient_id and patient_id != "0" else None
         )
 
-        labels = [row[0] for row in data]
-        counts = [row[1] for row in data]
+        labels = list(totals.keys())
+        counts = list(totals.values())
 
         return jsonify({"labels": labels, "counts": counts})
 
@@ -416,6 +427,7 @@ def init_routes(app):
 
         appt = Appointment.query.get_or_404(appointment_id)
         appt.status = 'Cancelled'
+        publish(appt, 'cancelled')
         db.session.commit()
         
         flash("Appointment cancelled by admin.", "warning")
@@ -431,6 +443,8 @@ def init_routes(app):
             flash('Unauthorized access!', 'danger')
             return redirect(url_for('login'))
 
+        request_missed_sweep(Appointment.patient_id == current_user.id)
+
         # Counts
         total_appointments = Appointment.query.filter_by(patient_id=current_user.id).count()
         upcoming_appointments = Appointment.query.filter_by(patient_id=current_user.id, status='Booked').count()
@@ -529,7 +543,8 @@ def init_routes(app):
                 status="Booked"
             ).first()
 
-            if conflict:
+            # A slot with likely no-shows may take an extra booking (app/noshow.py)
+            if conflict and not overbook_allowed(doctor_id, date_obj, time_obj, current_user.id):
                 flash("That doctor already has an appointment at this time!", "danger")
                 return redirect(url_for('patient_appointments'))
 
@@ -542,6 +557,7 @@ def init_routes(app):
                 status='Booked'
             )
             db.session.add(new_appointment)
+            publish(new_appointment, 'booked')
             db.session.commit()
 
             flash("Appointment booked successfully!", "success")
@@ -580,6 +596,7 @@ def init_routes(app):
         return render_template(
         'patient_appointments.html',
         doctors=doctors,
+        departments=Department.query.all(),
         appointments=appointments,
         availabilities=availabilities,
         booked_slots=booked_slots,
@@ -591,9 +608,8 @@ def init_routes(app):
     @login_required
     def patient_view_report(treatment_id):
 
-        from .models import Treatment
-
-        treatment = Treatment.query.get_or_404(treatment_id)
+        # Old reports may have been moved to the archive tables
+        treatment = find_treatment(treatment_id) or abort(404)
 
         # Security: Only the owner patient should view it
         if treatment.appointment.patient_id != current_user.id:
@@ -609,53 +625,20 @@ def init_routes(app):
             flash('Unauthorized access!', 'danger')
             return redirect(url_for('login'))
 
-        from .models import Department, DoctorAvailability
-
-        # Only active doctors
-        doctors = User.query.filter_by(role='doctor', is_active=True).all()
-
-        departments = {d.id: d.name for d in Department.query.all()}
-
-        # --- Serialize doctor availabilities ---
-        availabilities = [
-            {
-                "doctor_id": a.doctor_id,
-                "date": a.date.strftime("%Y-%m-%d"),
-                "start_time": a.start_time.strftime("%H:%M"),
-                "end_time": a.end_time.strftime("%H:%M")
-            }
-            for a in DoctorAvailability.query.all()
-        ]
-
-        # --- Serialize booked slots ---
-        booked_slots = [
-            {
-                "doctor_id": appt.doctor_id,
-                "date": appt.date.strftime("%Y-%m-%d"),
-                "time": appt.time.strftime("%H:%M")
-            }
-            for appt in Appointment.query.filter_by(status="Booked").all()
-        ]
-
-        # Compute next availability per doctor
-        next_availability_map = {}
-
-        for av in DoctorAvailability.query.order_by(DoctorAvailability.date, DoctorAvailability.start_time).all():
-            if av.doctor_id not in next_availability_map:
-                next_availability_map[av.doctor_id] = {
-                    "date": av.date.strftime("%Y-%m-%d"),
-                    "start_time": av.start_time.strftime("%H:%M"),
-                    "end_time": av.end_time.strftime("%H:%M")
-                }
+        from .finder import parse_search, find_doctors, WITHIN_CHOICES
 
+        # Filtering, facet counts and paging happen here; the page gets one page of doctors
+        try:
+            params = parse_search(request.args)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('patient_view_doctors'))
 
         return render_template(
             'patient_view_doctors.html',
-            doctors=doctors,
-            departments=departments,
-            availabilities=availabilities,
-            booked_slots=booked_slots,
-            next_availability=next_availability_map
+            params=params,
+            results=find_doctors(**params),
+            within_choices=WITHIN_CHOICES
         )
 
     @app.route('/patient/departments')
@@ -692,17 +675,23 @@ def init_routes(app):
             flash('Unauthorized access!', 'danger')
             return redirect(url_for('login'))
 
-        from .models import Treatment, Appointment
+        department_id = request.args.get('department_id', type=int)
 
-        treatments = (
-            Treatment.query
-            .join(Appointment, Treatment.appointment_id == Appointment.id)
-            .filter(Appointment.patient_id == current_user.id)
-            .order_by(Appointment.date.desc())
-            .all()
+        # Completed visits only, with doctor and treatment loaded in one query
+        appointments, next_cursor = patient_timeline(
+            current_user.id,
+            department_id=department_id,
+            treated_only=True,
+            cursor=request.args.get('cursor')
         )
 
-        return render_template('patient_treatments.html', treatments=treatments)
+        return render_template(
+            'patient_treatments.html',
+            appointments=appointments,
+            next_cursor=next_cursor,
+            departments=Department.query.all(),
+            department_id=department_id
+        )
 
     @app.route('/patient/cancel/<int:appointment_id>')
     @login_required
@@ -722,6 +711,7 @@ def init_routes(app):
             return redirect(url_for('patient_appointments'))
 
         appt.status = "Cancelled"
+        publish(appt, 'cancelled')
         db.session.commit()
         flash("Appointment cancelled successfully.", "success")
         return redirect(url_for('patient_appointments'))
@@ -763,6 +753,8 @@ def init_routes(app):
             flash('Unauthorized access!', 'danger')
             return redirect(url_for('login'))
 
+        request_missed_sweep(Appointment.doctor_id == current_user.id)
+
         # Fetch appointment stats for this doctor
         total_appointments = Appointment.query.filter_by(doctor_id=current_user.id).count()
         upcoming_appointments = Appointment.query.filter_by(
@@ -798,9 +790,12 @@ def init_routes(app):
             flash('Unauthorized access!', 'danger')
             return redirect(url_for('login'))
 
+        # Upcoming plus the recent past only; older history is in the calendar
+        since = date.today() - timedelta(days=app.config['CALENDAR_RECENT_DAYS'])
         appointments = (
             Appointment.query
-            .filter_by(doctor_id=current_user.id)
+            .options(joinedload(Appointment.patient))
+            .filter(Appointment.doctor_id == current_user.id, Appointment.date >= since)
             .order_by(Appointment.date, Appointment.time)
             .all()
         )
@@ -814,7 +809,8 @@ def init_routes(app):
         'doctor_appointments.html',
         appointments=appointments,
         current_date=datetime.now().date(),
-        current_time=datetime.now().strftime("%Y-%m-%d %H:%M")
+        current_time=datetime.now().strftime("%Y-%m-%d %H:%M"),
+        recent_days=app.config['CALENDAR_RECENT_DAYS']
     )
 
 
@@ -825,9 +821,12 @@ def init_routes(app):
             flash("Unauthorized access!", "danger")
             return redirect(url_for("login"))
 
-        appointment = Appointment.query.get_or_404(appointment_id)
+        appointment = find_appointment(appointment_id) or abort(404)
 
-        if appointment.doctor_id != current_user.id:
+        allowed = appointment.doctor_id == current_user.id or (
+            cross_doctor_allowed() and doctor_can_view(current_user.id, appointment.patient_id)
+        )
+        if not allowed:
             flash("You are not allowed to view this report.", "danger")
             return redirect(url_for("doctor_dashboard"))
 
@@ -860,6 +859,7 @@ def init_routes(app):
             )
             appt.status = 'Completed'
             db.session.add(treatment)
+            publish(appt, 'completed')
             db.session.commit()
             flash('Appointment marked as completed!', 'success')
             return redirect(url_for('doctor_appointments'))
@@ -879,6 +879,7 @@ def init_routes(app):
             return redirect(url_for('doctor_appointments'))
 
         appt.status = 'Cancelled'
+        publish(appt, 'cancelled')
         db.session.commit()
         flash('Appointment cancelled successfully!', 'info')
         return redirect(url_for('doctor_appointments'))
@@ -921,9 +922,37 @@ def init_routes(app):
             return redirect(url_for('login'))
 
         patient = User.query.get_or_404(patient_id)
-        appointments = Appointment.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).all()
 
-        return render_template('patient_history.html', patient=patient, appointments=appointments)
+        if not doctor_can_view(current_user.id, patient_id):
+            flash('This patient has no appointments with you.', 'danger')
+            return redirect(url_for('doctor_patients'))
+
+        # Other doctors' visits are shown only when cross-doctor history is enabled
+        show_all = cross_doctor_allowed() and request.args.get('scope') == 'all'
+        doctor_id = request.args.get('doctor_id', type=int) if show_all else current_user.id
+        department_id = request.args.get('department_id', type=int) if show_all else None
+        # Cursor pages have no offset of their own; the page number is carried for row numbering
+        page = max(1, request.args.get('page', 1, type=int))
+
+        appointments, next_cursor = patient_timeline(
+            patient_id,
+            doctor_id=doctor_id,
+            department_id=department_id,
+            cursor=request.args.get('cursor')
+        )
+
+        return render_template(
+            'patient_history.html',
+            patient=patient,
+            appointments=appointments,
+            next_cursor=next_cursor,
+            show_all=show_all,
+            cross_allowed=cross_doctor_allowed(),
+            departments=Department.query.all() if show_all else [],
+            department_id=department_id,
+            page=page,
+            per_page=app.config['TIMELINE_PAGE_SIZE']
+        )
 
 
     @app.route('/doctor/availability', methods=['GET', 'POST'])
@@ -986,20 +1015,29 @@ def init_routes(app):
         flash("Availability slot deleted successfully.", "info")
         return redirect(url_for('doctor_availability'))
 
-def auto_update_past_appointments():
-    now = datetime.now()
-    today = now.date()
-    current_time = now.time()
+def request_missed_sweep(*clauses):
+    """
+    Queue the Missed sweep when one of the bookings selected by `clauses` has
+    passed, so the page shows fresh statuses on its next load. Commits.
+    """
+    overdue = db.session.query(Appointment.id).filter(
+        Appointment.status == 'Booked', past_clause(), *clauses
+    ).first()
+    if overdue is not None:
+        enqueue('mark_missed_appointments', dedup_key='schedule:mark_missed_appointments')
+        db.session.commit()
+
 
+def auto_update_past_appointments():
     # FIND all "Booked" appointments whose date/time have already passed
     past_appointments = Appointment.query.filter(
         Appointment.status == "Booked",
-        ((Appointment.date < today) |
-        ((Appointment.date == today) & (Appointment.time < current_time)))
+        past_clause()
     ).all()
 
     for appt in past_appointments:
         appt.status = "Missed"
+        publish(appt, 'missed')
 
     if past_appointments:
         db.session.commit()
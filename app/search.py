@@ -0,0 +1,199 @@
+"""
+Full-text search over treatment records (diagnosis, prescription, notes).
+
+Backed by an SQLite FTS5 table, `treatments_fts`, whose rowid is the
+treatment id. Triggers on `treatments` keep it in sync inside the same
+transaction that writes the treatment, so complete_appointment needs no extra
+code. The patient id is stored as an UNINDEXED column so, when
+DOCTOR_CROSS_HISTORY is on, a doctor's search is scoped to the patients they
+have seen without joining the treatment and appointment tables for every
+hit. Otherwise doctors only search the treatments of their own appointments.
+"""
+import re
+
+from flask import request, jsonify
+from flask_login import login_required, current_user
+from markupsafe import escape
+from sqlalchemy import text
+from sqlalchemy.orm import aliased
+
+from .models import db, User, Appointment, Treatment, ArchivedAppointment, ArchivedTreatment
+from .timeline import cross_doctor_allowed
+
+# Sentinels wrapped around matches by snippet(); swapped for <mark> after escaping
+_HL_START, _HL_END = '\x02', '\x03'
+
+FTS_TABLE = """
+CREATE VIRTUAL TABLE treatments_fts USING fts5(
+    diagnosis, prescription, notes,
+    patient_id UNINDEXED,
+    tokenize = 'porter unicode61'
+)
+"""
+
+FTS_TRIGGERS = {
+    'treatments_fts_ai': """
+        CREATE TRIGGER treatments_fts_ai AFTER INSERT ON treatments BEGIN
+            INSERT INTO treatments_fts (rowid, diagnosis, prescription, notes, patient_id)
+            SELECT new.id, new.diagnosis, new.prescription, new.notes, a.patient_id
+            FROM appointments a WHERE a.id = new.appointment_id;
+        END
+    """,
+    'treatments_fts_au': """
+        CREATE TRIGGER treatments_fts_au AFTER UPDATE OF diagnosis, prescription, notes ON treatments BEGIN
+            UPDATE treatments_fts
+            SET diagnosis = new.diagnosis, prescription = new.prescription, notes = new.notes
+            WHERE rowid = old.id;
+        END
+    """,
+    'treatments_fts_ad': """
+        CREATE TRIGGER treatments_fts_ad AFTER DELETE ON treatments BEGIN
+            -- rows being moved to treatments_archive stay searchable
+            DELETE FROM treatments_fts
+            WHERE rowid = old.id
+              AND NOT EXISTS (SELECT 1 FROM treatments_archive WHERE id = old.id);
+        END
+    """,
+}
+
+BACKFILL = """
+INSERT INTO treatments_fts (rowid, diagnosis, prescription, notes, patient_id)
+SELECT t.id, t.diagnosis, t.prescription, t.notes, a.patient_id
+FROM treatments t JOIN appointments a ON a.id = t.appointment_id
+UNION ALL
+SELECT t.id, t.diagnosis, t.prescription, t.notes, a.patient_id
+FROM treatments_archive t JOIN appointments_archive a ON a.id = t.appointment_id
+"""
+
+
+def ensure_search_index():
+    """Create the FTS table (backfilling existing treatments) and (re)create its triggers."""
+    ddl = db.session.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'treatments_fts'"
+    )).scalar()
+
+    if ddl is None:
+        db.session.execute(text(FTS_TABLE))
+        db.session.execute(text(BACKFILL))
+
+    # Dropped and recreated on every start so trigger changes reach old databases
+    for name, ddl in FTS_TRIGGERS.items():
+        db.session.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        db.session.execute(text(ddl))
+
+    db.session.commit()
+
+
+def build_match(q):
+    """
+    Turn free text into a safe FTS5 query: every word must match, as a prefix.
+    'metf migraine' -> '"metf"* "migraine"*'
+    """
+    words = re.findall(r'\w+', q)
+    return ' '.join(f'"{w}"*' for w in words)
+
+
+def _highlight(snippet):
+    if not snippet:
+        return ''
+    html = str(escape(snippet))
+    return html.replace(_HL_START, '<mark>').replace(_HL_END, '</mark>')
+
+
+def search_treatments(q, doctor_id=None, cross_doctor=False, limit=20):
+    """
+    Ranked matches with highlighted snippets.
+    With `doctor_id`, only that doctor's own treatments are searched, or with
+    `cross_doctor` every treatment of the patients they have seen.
+    """
+    match = build_match(q)
+    if not match:
+        return []
+
+    scope = ''
+    params = {'match': match, 'limit': limit}
+    if doctor_id is not None and cross_doctor:
+        scope = '''AND f.patient_id IN (
+            SELECT patient_id FROM appointments WHERE doctor_id = :doctor_id
+            UNION SELECT patient_id FROM appointments_archive WHERE doctor_id = :doctor_id
+        )'''
+        params['doctor_id'] = doctor_id
+    elif doctor_id is not None:
+        scope = '''AND f.rowid IN (
+            SELECT t.id FROM treatments t JOIN appointments a ON a.id = t.appointment_id
+            WHERE a.doctor_id = :doctor_id
+            UNION SELECT t.id FROM treatments_archive t JOIN appointments_archive a ON a.id = t.appointment_id
+            WHERE a.doctor_id = :doctor_id
+        )'''
+        params['doctor_id'] = doctor_id
+
+    rows = db.session.execute(text(f"""
+        SELECT f.rowid AS id,
+               snippet(treatments_fts, 0, '{_HL_START}', '{_HL_END}', '…', 12) AS diagnosis,
+               snippet(treatments_fts, 1, '{_HL_START}', '{_HL_END}', '…', 12) AS prescription,
+               snippet(treatments_fts, 2, '{_HL_START}', '{_HL_END}', '…', 12) AS notes,
+               bm25(treatments_fts, 5.0, 3.0, 1.0) AS score
+        FROM treatments_fts f
+        WHERE treatments_fts MATCH :match {scope}
+        ORDER BY score
+        LIMIT :limit
+    """), params).all()
+
+    if not rows:
+        return []
+
+    # Display fields for this page of hits, from the hot or the archive tables
+    Doctor = aliased(User)
+    Patient = aliased(User)
+    ids = [r.id for r in rows]
+    details = {}
+    for treatment_model, appointment_model in ((Treatment, Appointment),
+                                               (ArchivedTreatment, ArchivedAppointment)):
+        details.update({
+            treatment_id: (appt, patient_name, doctor_name)
+            for treatment_id, appt, patient_name, doctor_name in (
+                db.session.query(treatment_model.id, appointment_model, Patient.name, Doctor.name)
+                .join(appointment_model, appointment_model.id == treatment_model.appointment_id)
+                .join(Patient, Patient.id == appointment_model.patient_id)
+                .join(Doctor, Doctor.id == appointment_model.doctor_id)
+                .filter(treatment_model.id.in_(ids))
+            )
+        })
+
+    results = []
+    for r in rows:
+        if r.id not in details:
+            continue
+        appt, patient_name, doctor_name = details[r.id]
+        results.append({
+            "treatment_id": r.id,
+            "appointment_id": appt.id,
+            "patient_id": appt.patient_id,
+            "patient": patient_name,
+            "doctor": doctor_name,
+            "date": appt.date.strftime("%Y-%m-%d"),
+            "diagnosis": _highlight(r.diagnosis),
+            "prescription": _highlight(r.prescription),
+            "notes": _highlight(r.notes),
+            "score": round(-r.score, 3)
+        })
+    return results
+
+
+def init_search(app):
+
+    @app.route('/search/treatments')
+    @login_required
+    def search_treatment_records():
+        if current_user.role not in ('admin', 'doctor'):
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        q = request.args.get('q', '').strip()
+        limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+
+        # Doctors search their own treatments (or their patients' whole history
+        # when DOCTOR_CROSS_HISTORY allows it); admins search hospital-wide
+        doctor_id = current_user.id if current_user.role == 'doctor' else None
+
+        return jsonify(search_treatments(q, doctor_id=doctor_id, cross_doctor=cross_doctor_allowed(),
+                                         limit=limit))
@@ -0,0 +1,184 @@
+"""
+Delta sync for offline-capable clients (doctor tablets, patient apps).
+
+Every write to an Appointment, Treatment or DoctorAvailability is stamped
+with a change version taken from a single counter row (`sync_state`). ORM
+writes are stamped automatically by a before_flush hook, one version per
+flush; set-based UPDATEs call next_version() themselves. Deleting a synced
+row leaves a tombstone carrying the version of the delete; so does moving
+an appointment to another doctor, for the doctor who loses it.
+
+GET /api/v1/sync?since=<cursor> returns what changed after the cursor,
+scoped to the caller's role, plus the cursor to send next time. A poll with
+nothing new reads only the counter row.
+"""
+from flask import request, jsonify
+from flask_login import current_user
+from sqlalchemy import event, insert, select, update, literal
+from sqlalchemy.orm import Session
+
+from .models import db, Appointment, Treatment, DoctorAvailability, SyncState, SyncTombstone
+
+SYNCED = {
+    Appointment: 'appointments',
+    Treatment: 'treatments',
+    DoctorAvailability: 'availability',
+}
+
+SYNC_FIELDS = {
+    'appointments': ('id', 'patient_id', 'doctor_id', 'date', 'time', 'status', 'version'),
+    'treatments': ('id', 'appointment_id', 'diagnosis', 'prescription', 'notes', 'version'),
+    'availability': ('id', 'doctor_id', 'date', 'start_time', 'end_time', 'version'),
+}
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 2000
+
+
+def next_version(connection=None):
+    """Reserve and return the next change version in the current transaction."""
+    conn = connection or db.session.connection()
+    conn.execute(update(SyncState).where(SyncState.id == 1).values(version=SyncState.version + 1))
+    return conn.execute(select(SyncState.version).where(SyncState.id == 1)).scalar()
+
+
+def current_version():
+    return db.session.query(SyncState.version).filter(SyncState.id == 1).scalar() or 0
+
+
+def _tombstone_owner(obj):
+    if isinstance(obj, Appointment):
+        return obj.doctor_id, obj.patient_id
+    if isinstance(obj, Treatment):
+        appt = obj.appointment
+        return (appt.doctor_id, appt.patient_id) if appt else (None, None)
+    return obj.doctor_id, None
+
+
+@event.listens_for(Session, 'before_flush')
+def stamp_versions(session, flush_context, instances):
+    changed = [o for o in session.new if type(o) in SYNCED]
+    changed += [o for o in session.dirty if type(o) in SYNCED and session.is_modified(o)]
+    deleted = [o for o in session.deleted if type(o) in SYNCED]
+    if not changed and not deleted:
+        return
+
+    version = next_version(session.connection())
+    for obj in changed:
+        obj.version = version
+    for obj in deleted:
+        doctor_id, patient_id = _tombstone_owner(obj)
+        session.add(SyncTombstone(entity=SYNCED[type(obj)], entity_id=obj.id, version=version,
+                                  doctor_id=doctor_id, patient_id=patient_id))
+
+
+def tombstone_where(model, clauses, version):
+    """Set-based counterpart of the flush hook, for bulk Query.delete() calls."""
+    if model is Treatment:
+        # Owners come from the appointment, as in _tombstone_owner()
+        rows = select(literal(SYNCED[model]), model.id, literal(version),
+                      Appointment.doctor_id, Appointment.patient_id) \
+            .outerjoin(Appointment, Appointment.id == Treatment.appointment_id)
+    else:
+        patient_id = model.patient_id if model is Appointment else literal(None)
+        rows = select(literal(SYNCED[model]), model.id, literal(version), model.doctor_id, patient_id)
+    db.session.execute(
+        insert(SyncTombstone).from_select(
+            ['entity', 'entity_id', 'version', 'doctor_id', 'patient_id'],
+            rows.where(*clauses)
+        )
+    )
+
+
+def ensure_sync_state():
+    """Create the counter row and give pre-existing rows a version so they sync."""
+    if not db.session.get(SyncState, 1):
+        db.session.add(SyncState(id=1, version=1))
+        db.session.flush()
+    for model in SYNCED:
+        db.session.execute(
+            update(model).where(model.version.is_(None)).values(version=1)
+            .execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+
+
+# ---------------- ROLE SCOPES ---------------- #
+
+def _scoped(model, query):
+    role, me = current_user.role, current_user.id
+    if role == 'admin':
+        return query
+    if model is Appointment:
+        return query.filter(Appointment.doctor_id == me if role == 'doctor' else Appointment.patient_id == me)
+    if model is Treatment:
+        own = db.session.query(Appointment.id).filter(
+            Appointment.doctor_id == me if role == 'doctor' else Appointment.patient_id == me
+        )
+        return query.filter(Treatment.appointment_id.in_(own))
+    # Availability: doctors sync their own calendar, patients need everyone's to book
+    if role == 'doctor':
+        return query.filter(DoctorAvailability.doctor_id == me)
+    return query
+
+
+def _scoped_tombstones(query):
+    role, me = current_user.role, current_user.id
+    if role == 'admin':
+        return query
+    if role == 'doctor':
+        return query.filter(SyncTombstone.doctor_id == me)
+    return query.filter((SyncTombstone.patient_id == me) | (SyncTombstone.entity == 'availability'))
+
+
+def changes_since(since, limit):
+    """
+    Changes with since < version <= upto. `upto` is lowered when a table has
+    more than `limit` changes; a version is never split across pages.
+    """
+    latest = current_version()
+    if since >= latest:
+        return {'cursor': latest, 'changes': {}, 'deleted': [], 'has_more': False}
+
+    queries = {model: _scoped(model, model.query.filter(model.version > since)) for model in SYNCED}
+    tombstones = _scoped_tombstones(SyncTombstone.query.filter(SyncTombstone.version > since))
+
+    upto = latest
+    for q, column in [(q, m.version) for m, q in queries.items()] + [(tombstones, SyncTombstone.version)]:
+        boundary = q.with_entities(column).order_by(column).offset(limit - 1).limit(1).scalar()
+        if boundary is not None:
+            upto = min(upto, boundary)
+
+    changes = {}
+    for model, q in queries.items():
+        rows = q.filter(model.version <= upto).order_by(model.version).all()
+        if rows:
+            name = SYNCED[model]
+            changes[name] = [
+                {f: _value(getattr(r, f)) for f in SYNC_FIELDS[name]} for r in rows
+            ]
+    # A reassigned appointment is tombstoned for its old doctor only; whoever
+    # still sees the row gets it as a change, not as a delete
+    present = {(name, r['id']): r['version'] for name, rows in changes.items() for r in rows}
+    deleted = [
+        {'entity': t.entity, 'id': t.entity_id, 'version': t.version}
+        for t in tombstones.filter(SyncTombstone.version <= upto).order_by(SyncTombstone.version)
+        if present.get((t.entity, t.entity_id), 0) < t.version
+    ]
+
+    return {'cursor': upto, 'changes': changes, 'deleted': deleted, 'has_more': upto < latest}
+
+
+def _value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def init_sync(app):
+
+    @app.route('/api/v1/sync')
+    def api_sync():
+        # Authentication is enforced for /api/v1/* in app/api.py
+        since = request.args.get('since', 0, type=int)
+        limit = max(1, min(request.args.get('limit', DEFAULT_LIMIT, type=int), MAX_LIMIT))
+        return jsonify(changes_since(since, limit))
+
@@ -0,0 +1,361 @@
+"""
+Several clinics in one server process, each with its own SQLite file.
+
+With TENANT_MODE set, every request is routed to a tenant before Flask sees
+it, either by hostname or by a path prefix:
+
+    host    stmary.hms.example.org/login    -> instance/tenants/stmary.db
+            (first label of the host, or an entry in TENANT_HOSTS)
+    path    /clinic/stmary/login            -> instance/tenants/stmary.db
+            (the prefix moves into SCRIPT_NAME, so url_for() keeps it)
+
+Requests for a clinic without a database file get a 404; clinics are added
+with `flask tenant-create NAME`.
+
+db.engines (app/models.py) asks the registry for the current tenant's
+engine. Engines are opened on first use, migrated and seeded with init_db()
+once per process, and disposed again after TENANT_IDLE_SECONDS without
+requests or when more than TENANT_MAX_ENGINES are open, so memory follows
+the number of busy clinics rather than the number of clinics.
+
+Without TENANT_MODE nothing changes: one database, SQLALCHEMY_DATABASE_URI.
+CLI commands act on that database too, or on one clinic with
+FLASK_TENANT=NAME in the environment.
+"""
+import os
+import re
+import threading
+import time as _time
+from contextlib import contextmanager
+
+import click
+import sqlalchemy as sa
+from flask import current_app, g, request, has_request_context
+from werkzeug.exceptions import NotFound
+from werkzeug.wsgi import ClosingIterator
+
+from .models import db, init_db
+
+MODES = ('host', 'path')
+NAME_RE = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+ENVIRON_KEY = 'hms.tenant'
+SWEEP_INTERVAL = 30     # seconds between idle engine sweeps
+
+
+class _Tenant:
+    def __init__(self):
+        self.engines = None      # {None: Engine} while open
+        self.in_use = 0          # requests and jobs running against it
+        self.last_used = 0.0     # monotonic time of the last request
+        self.migrated = False    # init_db() has run in this process
+        self.migrating = None    # thread running init_db()
+        self.lock = threading.Lock()
+
+
+class TenantRegistry:
+    """Per-process map of tenant name -> lazily opened engine."""
+
+    def __init__(self, app):
+        self.app = app
+        self.mode = app.config['TENANT_MODE']
+        self._tenants = {}
+        self._pending_jobs = set()
+        self._lock = threading.Lock()
+        self._last_sweep = _time.monotonic()
+
+    # ---- naming ----
+
+    def path(self, name):
+        return os.path.join(self.app.config['TENANT_DIR'], f"{name}.db")
+
+    def exists(self, name):
+        if not name or not NAME_RE.match(name):
+            return False
+        tenant = self._tenants.get(name)
+        return (tenant is not None and tenant.engines is not None) or os.path.exists(self.path(name))
+
+    def known(self):
+        directory = self.app.config['TENANT_DIR']
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            f[:-3] for f in os.listdir(directory)
+            if f.endswith('.db') and NAME_RE.match(f[:-3])
+        )
+
+    def resolve(self, environ):
+        """Tenant named by a request, or None. In path mode the prefix is moved into SCRIPT_NAME."""
+        if self.mode == 'host':
+            host = (environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')).split(':')[0].lower()
+            name = self.app.config['TENANT_HOSTS'].get(host, host.split('.')[0])
+            return name if self.exists(name) else None
+
+        prefix = self.app.config['TENANT_PATH_PREFIX'].rstrip('/') + '/'
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(prefix):
+            return None
+        name, _, rest = path[len(prefix):].partition('/')
+        if not self.exists(name):
+            return None
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix + name
+        environ['PATH_INFO'] = '/' + rest
+        return name
+
+    def current(self):
+        """Tenant of the running code: tenant_context(), then the request, then FLASK_TENANT."""
+        if 'tenant' in g:
+            return g.tenant
+        if has_request_context() and ENVIRON_KEY in request.environ:
+            return request.environ[ENVIRON_KEY]
+        return self.app.config['TENANT']
+
+    # ---- engines ----
+
+    def engines(self, name):
+        tenant = self._tenants.get(name)
+        if tenant is not None and tenant.migrated and tenant.engines is not None:
+            return tenant.engines
+
+        with self._lock:
+            tenant = self._tenants.setdefault(name, _Tenant())
+            if tenant.engines is None:
+                if not self.exists(name):
+                    raise LookupError(f"unknown tenant '{name}'")
+                tenant.engines = {None: self._make_engine(name)}
+                evicted = self._make_room(keep=name)
+            else:
+                evicted = []
+            engines = tenant.engines
+        self._dispose(evicted)
+
+        if not tenant.migrated and tenant.migrating != threading.get_ident():
+            self._migrate(name, tenant)
+        return engines
+
+    def _make_engine(self, name):
+        options = dict(self.app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        options.update(self.app.config['TENANT_ENGINE_OPTIONS'])
+        return sa.create_engine(f"sqlite:///{os.path.abspath(self.path(name))}", **options)
+
+    def _migrate(self, name, tenant):
+        # Other threads wait here; init_db() itself runs on this thread and
+        # reaches engines() again, which lets it through
+        with tenant.lock:
+            if tenant.migrated:
+                return
+            tenant.migrating = threading.get_ident()
+            try:
+                with tenant_context(self.app, name):
+                    init_db()
+                tenant.migrated = True
+            finally:
+                tenant.migrating = None
+
+    def _make_room(self, keep):
+        """Close least recently used idle engines beyond TENANT_MAX_ENGINES. Caller holds the lock."""
+        open_ = [(t.last_used, n) for n, t in self._tenants.items()
+                 if t.engines is not None and n != keep]
+        excess = len(open_) + 1 - self.app.config['TENANT_MAX_ENGINES']
+        evicted = []
+        for _, name in sorted(open_):
+            if excess <= 0:
+                break
+            if self._idle(self._tenants[name]):
+                evicted.append(self._close(name))
+                excess -= 1
+        if excess > 0:
+            self.app.logger.warning("tenancy: %d engines open, all busy", len(open_) + 1)
+        return evicted
+
+    def _idle(self, tenant):
+        return tenant.in_use == 0 and tenant.migrating is None
+
+    def _close(self, name):
+        tenant = self._tenants[name]
+        engines, tenant.engines = tenant.engines, None
+        return engines[None]
+
+    def _dispose(self, engines):
+        for engine in engines:
+            engine.dispose()
+
+    def sweep(self):
+        """Close engines of tenants without requests for TENANT_IDLE_SECONDS."""
+        cutoff = _time.monotonic() - self.app.config['TENANT_IDLE_SECONDS']
+        with self._lock:
+            self._last_sweep = _time.monotonic()
+            evicted = [
+                self._close(name) for name, t in self._tenants.items()
+                if t.engines is not None and self._idle(t) and t.last_used < cutoff
+            ]
+        self._dispose(evicted)
+        return len(evicted)
+
+    def acquire(self, name, touch=True):
+        now = _time.monotonic()
+        with self._lock:
+            tenant = self._tenants.setdefault(name, _Tenant())
+            tenant.in_use += 1
+            if touch:
+                tenant.last_used = now
+            sweep = now - self._last_sweep > SWEEP_INTERVAL
+        if sweep:
+            self.sweep()
+
+    def release(self, name, touch=True):
+        with self._lock:
+            tenant = self._tenants[name]
+            tenant.in_use -= 1
+            if touch:
+                tenant.last_used = _time.monotonic()
+
+    def after_fork(self):
+        # Pooled connections belong to the parent; drop them without closing
+        with self._lock:
+            for tenant in self._tenants.values():
+                if tenant.engines is not None:
+                    tenant.engines[None].dispose(close=False)
+                tenant.in_use = 0
+
+    def open_tenants(self):
+        return sorted(n for n, t in self._tenants.items() if t.engines is not None)
+
+    def close_idle(self, name):
+        """Dispose a tenant's engine now instead of at the next idle sweep, unless it is in use."""
+        with self._lock:
+            tenant = self._tenants.get(name)
+            if tenant is None or tenant.engines is None or not self._idle(tenant):
+                return False
+            engine = self._close(name)
+        self._dispose([engine])
+        return True
+
+    # ---- background jobs (app/jobs.py) ----
+
+    def job_tenants(self, every=False):
+        """
+        Databases the job workers poll: every open tenant plus those with
+        freshly scheduled jobs, or all tenants for a dedicated job process.
+        """
+        if not self.mode:
+            return [None]
+        if every:
+            return self.known()
+        return sorted(set(self.open_tenants()) | self._pending_jobs)
+
+    def schedule_tenants(self):
+        """Every tenant, open or not: scheduled jobs are enqueued in each database."""
+        return self.known() if self.mode else [None]
+
+    def jobs_pending(self, name):
+        if name is not None:
+            self._pending_jobs.add(name)
+
+    def jobs_drained(self, name):
+        self._pending_jobs.discard(name)
+
+    # ---- administration ----
+
+    def create(self, name):
+        if not NAME_RE.match(name or ''):
+            raise ValueError("tenant names are lowercase letters, digits, '-' and '_'")
+        if os.path.exists(self.path(name)):
+            raise ValueError(f"tenant '{name}' already exists")
+        os.makedirs(self.app.config['TENANT_DIR'], exist_ok=True)
+        # SQLite treats an empty file as an empty database
+        open(self.path(name), 'a').close()
+        self.migrate(name)
+
+    def migrate(self, name):
+        self.engines(name)
+
+
+def current_tenant():
+    registry = current_app.extensions.get('tenancy')
+    return registry.current() if registry is not None else None
+
+
+@contextmanager
+def tenant_context(app, name):
+    """
+    App context bound to tenant `name` (None: the default database), for
+    work outside a request. Its engine stays open while the block runs.
+    """
+    registry = app.extensions.get('tenancy')
+    with app.app_context():
+        g.tenant = name
+        if name is not None:
+            registry.acquire(name, touch=False)
+        try:
+            yield
+        finally:
+            db.session.remove()
+            if name is not None:
+                registry.release(name, touch=False)
+
+
+class TenantMiddleware:
+    """WSGI wrapper: picks the tenant and keeps its engine open until the response is sent."""
+
+    def __init__(self, wsgi_app, registry):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        name = self.registry.resolve(environ)
+        if name is None:
+            return NotFound("Unknown clinic.")(environ, start_response)
+        environ[ENVIRON_KEY] = name
+
+        self.registry.acquire(name)
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.registry.release(name)
+            raise
+        return ClosingIterator(response, lambda: self.registry.release(name))
+
+
+def init_tenancy(app):
+    app.config.setdefault('TENANT_MODE', None)                 # None, 'host' or 'path'
+    app.config.setdefault('TENANT_DIR', os.path.join(app.instance_path, 'tenants'))
+    app.config.setdefault('TENANT_HOSTS', {})                  # hostname -> tenant, overrides the first label
+    app.config.setdefault('TENANT_PATH_PREFIX', '/clinic')
+    app.config.setdefault('TENANT_MAX_ENGINES', 32)            # open tenant databases per process
+    app.config.setdefault('TENANT_IDLE_SECONDS', 600)          # close a tenant's engine after this long unused
+    app.config.setdefault('TENANT_ENGINE_OPTIONS', {'pool_size': 2, 'max_overflow': 8})
+    app.config.setdefault('TENANT', None)                      # fixed tenant outside requests, e.g. FLASK_TENANT
+    if app.config['TENANT_MODE'] not in (None,) + MODES:
+        raise ValueError(f"TENANT_MODE must be one of {', '.join(MODES)}")
+
+    registry = TenantRegistry(app)
+    app.extensions['tenancy'] = registry
+    if registry.mode:
+        app.wsgi_app = TenantMiddleware(app.wsgi_app, registry)
+    app.extensions.setdefault('post_fork', []).append(lambda app_: registry.after_fork())
+
+    @app.cli.command('tenant-create')
+    @click.argument('name')
+    def tenant_create_command(name):
+        """Create, migrate and seed the database of a new tenant."""
+        try:
+            registry.create(name)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"Tenant '{name}' created at {registry.path(name)}")
+
+    @app.cli.command('tenant-migrate')
+    @click.argument('names', nargs=-1)
+    def tenant_migrate_command(names):
+        """Run init_db() against the given tenants, or all of them."""
+        for name in names or registry.known():
+            if not registry.exists(name):
+                raise click.ClickException(f"unknown tenant '{name}'")
+            registry.migrate(name)
+            click.echo(f"{name}: up to date")
+
+    @app.cli.command('tenant-list')
+    def tenant_list_command():
+        """Tenants and the size of their databases."""
+        for name in registry.known():
+            click.echo(f"{name}\t{os.path.getsize(registry.path(name))} bytes")
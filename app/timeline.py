@@ -0,0 +1,108 @@
+"""
+Patient medical timeline.
+
+Returns a patient's appointments newest first with the doctor, the doctor's
+department and the treatment loaded in the same query, so history pages cost
+one round trip per page however long the patient's record is. Pages are
+addressed by a (date, time, id) cursor instead of an offset. Archived
+appointments are merged in, so the timeline always shows the full record.
+"""
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
+
+from .models import db, User, Appointment, ArchivedAppointment
+
+
+def encode_cursor(appt):
+    return f"{appt.date.isoformat()}_{appt.time.strftime('%H:%M:%S')}_{appt.id}"
+
+
+def decode_cursor(cursor):
+    """Parse a cursor from the query string; a malformed one means 'first page'."""
+    if not cursor:
+        return None
+    try:
+        date_str, time_str, appt_id = cursor.split('_')
+        return (datetime.strptime(date_str, "%Y-%m-%d").date(),
+                datetime.strptime(time_str, "%H:%M:%S").time(),
+                int(appt_id))
+    except ValueError:
+        return None
+
+
+def older_than(model, cursor):
+    """Rows strictly after `cursor` in (date, time, id) descending order."""
+    d, t, appt_id = cursor
+    return or_(
+        model.date < d,
+        and_(model.date == d, model.time < t),
+        and_(model.date == d, model.time == t, model.id < appt_id)
+    )
+
+
+def _page_query(model, patient_id, doctor_id, department_id, treated_only, position):
+    query = (
+        model.query
+        .options(
+            joinedload(model.doctor).joinedload(User.department),
+            joinedload(model.treatment)
+        )
+        .filter(model.patient_id == patient_id)
+    )
+
+    if doctor_id:
+        query = query.filter(model.doctor_id == doctor_id)
+    if department_id:
+        dept_doctors = db.session.query(User.id).filter(User.department_id == department_id)
+        query = query.filter(model.doctor_id.in_(dept_doctors.scalar_subquery()))
+    if treated_only:
+        query = query.filter(model.treatment.has())
+    if position:
+        query = query.filter(older_than(model, position))
+
+    return query.order_by(model.date.desc(), model.time.desc(), model.id.desc())
+
+
+def patient_timeline(patient_id, doctor_id=None, department_id=None,
+                     treated_only=False, cursor=None, limit=None):
+    """
+    One page of a patient's history, hot and archived appointments merged.
+    Returns (appointments, next_cursor); next_cursor is None on the last page.
+    """
+    limit = limit or current_app.config['TIMELINE_PAGE_SIZE']
+    position = decode_cursor(cursor)
+
+    rows = []
+    for model in (Appointment, ArchivedAppointment):
+        rows += _page_query(model, patient_id, doctor_id, department_id,
+                            treated_only, position).limit(limit + 1).all()
+
+    # Both halves are already sorted; ids are unique across hot and archive
+    rows.sort(key=lambda a: (a.date, a.time, a.id), reverse=True)
+    rows = rows[:limit + 1]
+
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def doctor_can_view(doctor_id, patient_id):
+    """A doctor may open a patient's history once they have an appointment together."""
+    return any(
+        db.session.query(
+            model.query.filter_by(doctor_id=doctor_id, patient_id=patient_id).exists()
+        ).scalar()
+        for model in (Appointment, ArchivedAppointment)
+    )
+
+
+def cross_doctor_allowed():
+    return current_app.config['DOCTOR_CROSS_HISTORY']
+
+
+def init_timeline(app):
+    app.config.setdefault('TIMELINE_PAGE_SIZE', 20)
+    # Let doctors see a shared patient's appointments with other doctors too
+    app.config.setdefault('DOCTOR_CROSS_HISTORY', True)
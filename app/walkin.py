@@ -0,0 +1,276 @@
+"""
+Walk-in triage queue per department.
+
+The desk enqueues a walk-in patient with a triage priority (1 = emergency
+... 4 = non-urgent). "Call next" takes the waiting patient with the lowest
+priority number, earliest arrival first, and books them as an ordinary
+appointment into the next free slot of whichever active doctor in the
+department frees up first today, judged from the doctor's
+DoctorAvailability and Booked appointments.
+
+Every walk-in is a row in `walkins`, written before it is queued, so a
+crash loses nothing. Each process keeps a heap per department of
+(priority, id) for the waiting rows: built from the table on first use,
+then topped up with rows added since (ids only grow), so push and pop are
+O(log n). Rows taken or sent away by another process stay in the heap until
+they reach the top; the conditional UPDATE that claims a walk-in fails for
+them and they are dropped then. The claim also takes the database write
+lock, so the chosen slot is checked again after it: a booking another
+process committed in between moves the walk-in to the next free slot.
+"""
+import heapq
+import threading
+import time as _time
+from datetime import date, datetime
+
+from flask import current_app, render_template, request, redirect, url_for, flash
+from flask_login import login_required, current_user
+from sqlalchemy import select, update
+
+from .models import db, User, Department, Appointment, DoctorAvailability, WalkIn
+from .events import publish
+from .finder import roster
+from .tenancy import current_tenant
+
+PRIORITIES = {1: 'Emergency', 2: 'Urgent', 3: 'Standard', 4: 'Non-urgent'}
+
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+class DepartmentQueue:
+    """Heap of (priority, walk-in id) for one department's waiting patients, in this process."""
+
+    def __init__(self, department_id):
+        self.department_id = department_id
+        self.heap = []
+        self.last_id = 0        # highest walk-in id loaded from the table
+        self.lock = threading.Lock()
+
+    def sync(self):
+        """Load walk-ins added since the last call. Caller holds the lock."""
+        rows = db.session.execute(
+            select(WalkIn.priority, WalkIn.id)
+            .where(WalkIn.department_id == self.department_id, WalkIn.status == 'waiting',
+                   WalkIn.id > self.last_id)
+            .order_by(WalkIn.id)
+        ).all()
+        if not rows:
+            return
+        if not self.heap:
+            self.heap = [tuple(r) for r in rows]
+            heapq.heapify(self.heap)
+        else:
+            for row in rows:
+                heapq.heappush(self.heap, tuple(row))
+        self.last_id = rows[-1][1]
+
+
+# (tenant, department id) -> DepartmentQueue
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def department_queue(department_id):
+    key = (current_tenant(), department_id)
+    with _queues_lock:
+        queue = _queues.get(key)
+        if queue is None:
+            queue = _queues[key] = DepartmentQueue(department_id)
+    return queue
+
+
+# ---------------- DOCTORS ---------------- #
+
+def next_free_doctor(department_id, now=None):
+    """(doctor_id, time) of the department's doctor whose next free slot today comes first, or None."""
+    now = now or datetime.now()
+    today, now_minute = now.date(), _minutes(now.time())
+    slot = current_app.config['CALENDAR_SLOT_MINUTES']
+    doctor_ids = [d['id'] for d in roster()['doctors'] if d['department_id'] == department_id]
+    if not doctor_ids:
+        return None
+
+    # The roster may be up to FINDER_ROSTER_TTL old; recheck that the doctor is still active
+    blocks = db.session.execute(
+        select(DoctorAvailability.doctor_id, DoctorAvailability.start_time, DoctorAvailability.end_time)
+        .join(User, User.id == DoctorAvailability.doctor_id)
+        .where(DoctorAvailability.doctor_id.in_(doctor_ids), DoctorAvailability.date == today,
+               User.is_active == True)  # noqa: E712
+    ).all()
+    if not blocks:
+        return None
+    booked = {
+        (doctor_id, _minutes(t)) for doctor_id, t in db.session.execute(
+            select(Appointment.doctor_id, Appointment.time)
+            .where(Appointment.doctor_id.in_({b.doctor_id for b in blocks}), Appointment.date == today,
+                   Appointment.status == 'Booked')
+        )
+    }
+
+    best = None
+    for doctor_id, start, end in blocks:
+        first = _minutes(start)
+        # first slot of the block that has not started yet
+        skip = max(0, -(-(now_minute - first) // slot))
+        for minute in range(first + skip * slot, _minutes(end), slot):
+            if best is not None and (minute, doctor_id) >= best:
+                break
+            if (doctor_id, minute) not in booked:
+                best = (minute, doctor_id)
+                break
+    if best is None:
+        return None
+    minute, doctor_id = best
+    return doctor_id, datetime.strptime(f"{minute // 60:02d}:{minute % 60:02d}", "%H:%M").time()
+
+
+def _slot_taken(doctor_id, day, at):
+    return db.session.execute(
+        select(Appointment.id).where(Appointment.doctor_id == doctor_id, Appointment.date == day,
+                                     Appointment.time == at, Appointment.status == 'Booked').limit(1)
+    ).first() is not None
+
+
+# ---------------- QUEUE OPERATIONS ---------------- #
+
+def enqueue_walkin(department_id, patient_id, priority, note=None):
+    """Record a walk-in and queue it. Commits."""
+    walkin = WalkIn(department_id=department_id, patient_id=patient_id, priority=priority, note=note)
+    db.session.add(walkin)
+    db.session.commit()
+    queue = department_queue(department_id)
+    with queue.lock:
+        queue.sync()
+    return walkin
+
+
+def dispatch_next(department_id):
+    """
+    Book the next waiting walk-in with the first free doctor. Commits.
+    Returns (walk-in, None), or (None, reason) when nobody can be seen.
+    """
+    queue = department_queue(department_id)
+    with queue.lock:
+        queue.sync()
+        if not queue.heap:
+            return None, "Nobody is waiting."
+        free = next_free_doctor(department_id)
+        if free is None:
+            return None, "No doctor in this department has a free slot left today."
+        doctor_id, at = free
+
+        while queue.heap:
+            entry = heapq.heappop(queue.heap)
+            walkin_id = entry[1]
+            # Claim it; fails when another process already called or removed this patient
+            claimed = db.session.execute(
+                update(WalkIn).where(WalkIn.id == walkin_id, WalkIn.status == 'waiting')
+                .values(status='assigned', assigned_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not claimed:
+                continue
+            try:
+                # The claim holds the write lock until commit, so no other process
+                # can book the slot between this check and our INSERT
+                while _slot_taken(doctor_id, date.today(), at):
+                    free = next_free_doctor(department_id)
+                    if free is None:
+                        db.session.rollback()
+                        heapq.heappush(queue.heap, entry)
+                        return None, "No doctor in this department has a free slot left today."
+                    doctor_id, at = free
+                walkin = db.session.get(WalkIn, walkin_id)
+                appointment = Appointment(patient_id=walkin.patient_id, doctor_id=doctor_id,
+                                          date=date.today(), time=at, status='Booked')
+                db.session.add(appointment)
+                publish(appointment, 'booked')
+                walkin.appointment_id = appointment.id
+                db.session.commit()
+            except Exception:
+                # The claim is rolled back too: the patient is waiting again
+                db.session.rollback()
+                heapq.heappush(queue.heap, entry)
+                raise
+            return walkin, None
+    return None, "Nobody is waiting."
+
+
+def remove_walkin(walkin_id):
+    """Mark a waiting walk-in as gone. Its heap entry is dropped when it reaches the top. Commits."""
+    removed = db.session.execute(
+        update(WalkIn).where(WalkIn.id == walkin_id, WalkIn.status == 'waiting')
+        .values(status='left')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return bool(removed)
+
+
+def init_walkin(app):
+
+    def _back(department_id=None):
+        return redirect(url_for('admin_walkins', department_id=department_id))
+
+    @app.route('/admin/walkins', methods=['GET', 'POST'])
+    @login_required
+    def admin_walkins():
+        if current_user.role != 'admin':
+            flash('Unauthorized access!', 'danger')
+            return redirect(url_for('login'))
+
+        department_id = request.values.get('department_id', type=int)
+        department = db.session.get(Department, department_id) if department_id else None
+
+        if request.method == 'POST':
+            if department is None:
+                flash('Choose a department.', 'danger')
+                return _back()
+            action = request.form.get('action')
+            if action == 'enqueue':
+                patient = db.session.get(User, request.form.get('patient_id', type=int) or 0)
+                priority = request.form.get('priority', type=int)
+                if patient is None or patient.role != 'patient' or priority not in PRIORITIES:
+                    flash('Choose a patient and a priority.', 'danger')
+                    return _back(department_id)
+                enqueue_walkin(department_id, patient.id, priority, (request.form.get('note') or '').strip() or None)
+                flash(f'{patient.name} added to the {department.name} queue ({PRIORITIES[priority]}).', 'success')
+            elif action == 'dispatch':
+                started = _time.perf_counter()
+                walkin, reason = dispatch_next(department_id)
+                if walkin is None:
+                    flash(reason, 'warning')
+                else:
+                    current_app.logger.info("walk-in %s dispatched in %.2f ms", walkin.id,
+                                            (_time.perf_counter() - started) * 1000)
+                    appointment = walkin.appointment
+                    flash(f'{walkin.patient.name}: see {appointment.doctor.name} at '
+                          f'{appointment.time.strftime("%H:%M")}.', 'success')
+            elif action == 'remove':
+                if remove_walkin(request.form.get('walkin_id', type=int)):
+                    flash('Removed from the queue.', 'info')
+            return _back(department_id)
+
+        waiting, assigned = [], []
+        if department is not None:
+            waiting = (
+                WalkIn.query.filter_by(department_id=department_id, status='waiting')
+                .order_by(WalkIn.priority, WalkIn.id).all()
+            )
+            assigned = (
+                WalkIn.query.filter(WalkIn.department_id == department_id, WalkIn.status == 'assigned',
+                                    WalkIn.assigned_at >= datetime.combine(date.today(), datetime.min.time()))
+                .order_by(WalkIn.assigned_at.desc()).limit(20).all()
+            )
+        return render_template(
+            'admin_walkins.html',
+            department=department,
+            departments=Department.query.order_by(Department.name).all(),
+            patients=User.query.filter_by(role='patient', is_active=True).order_by(User.name).all(),
+            priorities=PRIORITIES,
+            waiting=waiting,
+            assigned=assigned,
+            now=datetime.utcnow()
+        )
@@ -0,0 +1,519 @@
+"""
+Load tester: many concurrent simulated admins, doctors and patients
+clicking through the app over HTTP.
+
+1. Create a dataset (use a separate database file, not your real one):
+
+    export FLASK_SQLALCHEMY_DATABASE_URI=sqlite:///loadtest.db
+    python loadtest.py seed --doctors 40 --patients 2000 --days 30 --history 200
+
+2. Start the server against the same database, then drive it:
+
+    python serve.py --workers 4 &
+    python loadtest.py run --url http://127.0.0.1:8000 --mix admin=1,doctor=4,patient=15 \\
+        --stages 2,4,8,16 --duration 30 --json before.json
+
+Sessions arrive at random (Poisson) at each stage's rate in sessions per
+second; each one logs in, follows its role's click path with think time
+and logs out. A stage reports throughput, p50/p95/p99 latency per endpoint
+and error, rate-limit and database-lock rates; the table of stages is the
+saturation curve. Compare two saved runs with:
+
+    python loadtest.py compare before.json after.json
+
+Admission control (app/admission.py) rate-limits logins per client IP and
+all simulated users share one IP, so for capacity runs start the server
+with FLASK_ADMISSION_ENABLED=false, or keep it on to test the shedding.
+"""
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+EMAIL = "lt-{role}-{i}@load.test"
+DEFAULT_MIX = "admin=1,doctor=4,patient=15"
+
+ERROR_KINDS = ('server_error', 'lock_timeout', 'shed', 'rate_limited', 'auth', 'connection')
+
+
+# ---------------- DATASET ---------------- #
+
+def seed(args):
+    from app import create_app, setup_database
+    from app.models import db, User, Department, DoctorAvailability, Appointment, Treatment
+    from sqlalchemy import insert
+
+    app = create_app()
+    setup_database(app)
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        # One PBKDF2 hash shared by every generated account
+        template = User(email='x', name='x', role='patient')
+        template.set_password(args.password)
+        password_hash = template.password_hash
+
+        departments = [d.id for d in Department.query.all()]
+        existing = {e for (e,) in db.session.query(User.email).filter(User.email.like('%@load.test'))}
+
+        users = []
+        for role, count in (('doctor', args.doctors), ('patient', args.patients)):
+            for i in range(count):
+                email = EMAIL.format(role=role, i=i)
+                if email not in existing:
+                    users.append({
+                        'email': email, 'name': f"Load {role.title()} {i}", 'phone': f"9{i:09d}",
+                        'role': role, 'password_hash': password_hash, 'is_active': True,
+                        'department_id': rng.choice(departments) if role == 'doctor' and departments else None,
+                    })
+        if users:
+            db.session.execute(insert(User), users)
+            db.session.commit()
+
+        doctors = [u for (u,) in db.session.query(User.id).filter(User.email.like('lt-doctor-%'))]
+        patients = [u for (u,) in db.session.query(User.id).filter(User.email.like('lt-patient-%'))]
+
+        today = date.today()
+        slots = [
+            {'doctor_id': d, 'date': today + timedelta(days=n), 'start_time': datetime.strptime('09:00', '%H:%M').time(),
+             'end_time': datetime.strptime('17:00', '%H:%M').time()}
+            for d in doctors for n in range(args.days)
+        ]
+        db.session.execute(insert(DoctorAvailability), slots)
+
+        # Closed history, so per-doctor pages are not trivially small
+        history = []
+        for d in doctors:
+            for _ in range(args.history):
+                history.append({
+                    'doctor_id': d, 'patient_id': rng.choice(patients),
+                    'date': today - timedelta(days=rng.randint(1, 3 * 365)),
+                    'time': datetime.strptime(f"{rng.randint(9, 16)}:{rng.choice(('00', '30'))}", '%H:%M').time(),
+                    'status': rng.choice(('Completed', 'Completed', 'Completed', 'Cancelled', 'Missed')),
+                })
+        if history:
+            db.session.execute(insert(Appointment), history)
+            completed = db.session.query(Appointment.id).filter(
+                Appointment.doctor_id.in_(doctors), Appointment.status == 'Completed',
+                ~Appointment.treatment.has()
+            )
+            treatments = [
+                {'appointment_id': a, 'diagnosis': rng.choice(('Fever', 'Migraine', 'Fracture', 'Hypertension')),
+                 'prescription': 'Rest and fluids', 'notes': 'Generated by loadtest.py'}
+                for (a,) in completed
+            ]
+            if treatments:
+                db.session.execute(insert(Treatment), treatments)
+        db.session.commit()
+
+    print(f"Seeded {len(doctors)} doctors, {len(patients)} patients, {len(slots)} availability days, "
+          f"{len(history)} past appointments. Password: {args.password}")
+
+
+# ---------------- HTTP CLIENT ---------------- #
+
+class Response:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b'null')
+
+
+class Client:
+    """One simulated browser: a keep-alive connection and a cookie jar."""
+
+    def __init__(self, base_url, recorder, timeout):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.recorder = recorder
+        self.timeout = timeout
+        self.cookies = {}
+        self.conn = None
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def request(self, method, path, label=None, form=None, params=None):
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        headers = {'Connection': 'keep-alive'}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f"{k}={v}" for k, v in self.cookies.items())
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        label = f"{method} {label or path.split('?')[0]}"
+        started = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.conn.request(method, path, body=body, headers=headers)
+            raw = self.conn.getresponse()
+            response = Response(raw.status, raw.headers, raw.read())
+        except (OSError, http.client.HTTPException):
+            self.close()
+            self.recorder.record(label, time.perf_counter() - started, 'connection')
+            return None
+        elapsed = time.perf_counter() - started
+
+        for header in response.headers.get_all('Set-Cookie') or ():
+            for key, morsel in SimpleCookie(header).items():
+                self.cookies[key] = morsel.value
+        if response.headers.get('Connection', '').lower() == 'close':
+            self.close()
+
+        self.recorder.record(label, elapsed, classify(response, path))
+        return response
+
+
+def classify(response, path):
+    """None for success, else one of ERROR_KINDS."""
+    if response.status == 429:
+        return 'rate_limited'
+    if response.status == 503:
+        return 'lock_timeout' if b'database is busy' in response.body else 'shed'
+    if response.status >= 500:
+        return 'server_error'
+    # Logging out is the one page that is supposed to send us back to /login
+    if response.status == 401 or (response.status in (301, 302) and path != '/logout'
+                                  and urlsplit(response.headers.get('Location', '')).path == '/login'):
+        return 'auth'
+    return None
+
+
+# ---------------- CLICK PATHS ---------------- #
+
+class Paths:
+    """Role click paths. Each returns early when a step fails, like a user giving up."""
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+
+    def think(self):
+        if self.args.think:
+            time.sleep(self.rng.expovariate(1 / self.args.think))
+
+    def login(self, c, email, password):
+        c.request('GET', '/login')
+        r = c.request('POST', '/login', form={'email': email, 'password': password})
+        return r is not None and r.status == 302 and urlsplit(r.headers.get('Location', '')).path != '/login'
+
+    def patient(self, c):
+        email = EMAIL.format(role='patient', i=self.rng.randrange(self.args.patients))
+        if not self.login(c, email, self.args.password):
+            return
+        today = date.today()
+        c.request('GET', '/patient/dashboard')
+        self.think()
+        c.request('GET', '/patient/doctors')
+        self.think()
+
+        r = c.request('GET', '/api/v1/availability', params={
+            'date_from': (today + timedelta(days=1)).isoformat(),
+            'date_to': (today + timedelta(days=self.args.days)).isoformat(),
+            'limit': 200,
+        })
+        slots = r.json()['data'] if r is not None and r.status == 200 else []
+        c.request('GET', '/patient/appointments')
+        self.think()
+
+        if slots:
+            slot = self.rng.choice(slots)
+            start = datetime.strptime(slot['start_time'], '%H:%M:%S')
+            end = datetime.strptime(slot['end_time'], '%H:%M:%S')
+            steps = max(1, int((end - start).total_seconds() // 1800))
+            when = start + timedelta(minutes=30 * self.rng.randrange(steps))
+            c.request('POST', '/patient/appointments', form={
+                'doctor_id': slot['doctor_id'], 'date': slot['date'], 'time': when.strftime('%H:%M')
+            })
+            self.think()
+
+        if self.rng.random() < self.args.cancel_rate:
+            r = c.request('GET', '/api/v1/appointments', params={
+                'status': 'Booked', 'date_from': (today + timedelta(days=1)).isoformat()
+            })
+            booked = r.json()['data'] if r is not None and r.status == 200 else []
+            if booked:
+                c.request('GET', f"/patient/cancel/{self.rng.choice(booked)['id']}", label='/patient/cancel/<id>')
+                self.think()
+
+        c.request('GET', '/patient/treatments')
+        c.request('GET', '/logout')
+
+    def doctor(self, c):
+        email = EMAIL.format(role='doctor', i=self.rng.randrange(self.args.doctors))
+        if not self.login(c, email, self.args.password):
+            return
+        today = date.today()
+        c.request('GET', '/doctor/dashboard')
+        self.think()
+        c.request('GET', '/doctor/calendar', params={'view': 'week'})
+        self.think()
+        c.request('GET', '/doctor/appointments')
+        self.think()
+
+        if self.rng.random() < self.args.complete_rate:
+            r = c.request('GET', '/api/v1/appointments', params={'status': 'Booked', 'limit': 50})
+            booked = r.json()['data'] if r is not None and r.status == 200 else []
+            if booked:
+                appt_id = self.rng.choice(booked)['id']
+                c.request('GET', f"/doctor/complete/{appt_id}", label='/doctor/complete/<id>')
+                self.think()
+                c.request('POST', f"/doctor/complete/{appt_id}", label='/doctor/complete/<id>', form={
+                    'diagnosis': 'Load test', 'prescription': 'None', 'notes': 'Generated by loadtest.py'
+                })
+                self.think()
+
+        if self.rng.random() < self.args.availability_rate:
+            day = (today + timedelta(days=self.rng.randint(1, self.args.days))).isoformat()
+            c.request('POST', '/doctor/availability', form={'date': day, 'start_time': '18:00', 'end_time': '19:00'})
+            r = c.request('GET', '/api/v1/availability', params={'date_from': day, 'date_to': day})
+            extra = [s for s in (r.json()['data'] if r is not None and r.status == 200 else [])
+                     if s['start_time'] == '18:00:00']
+            if extra:
+                c.request('POST', f"/doctor/availability/delete/{extra[0]['id']}",
+                          label='/doctor/availability/delete/<id>')
+            self.think()
+
+        c.request('GET', '/doctor/patients')
+        c.request('GET', '/logout')
+
+    def admin(self, c):
+        if not self.login(c, self.args.admin_email, self.args.admin_password):
+            return
+        c.request('GET', '/admin/dashboard')
+        c.request('GET', '/admin/stats_data')
+        self.think()
+        c.request('GET', '/admin/users')
+        self.think()
+        c.request('GET', '/admin/search', params={'q': self.rng.choice('aeiou')})
+        c.request('GET', '/admin/search_appointments', params={'q': self.rng.choice(('load', 'booked', '2'))})
+        self.think()
+        c.request('GET', '/admin/analytics_data')
+        c.request('GET', '/logout')
+
+
+# ---------------- MEASUREMENT ---------------- #
+
+class Recorder:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.samples = {}     # label -> [latency, ...] of successful requests
+            self.errors = {}      # label -> {kind: count}
+            self.sessions = 0
+            self.dropped = 0
+
+    def record(self, label, elapsed, error):
+        with self._lock:
+            if error is None:
+                self.samples.setdefault(label, []).append(elapsed)
+            else:
+                kinds = self.errors.setdefault(label, {})
+                kinds[error] = kinds.get(error, 0) + 1
+
+    def summary(self, duration):
+        with self._lock:
+            labels = sorted(set(self.samples) | set(self.errors))
+            endpoints = {}
+            total_ok = total_err = 0
+            all_latencies = []
+            error_totals = {kind: 0 for kind in ERROR_KINDS}
+            for label in labels:
+                latencies = sorted(self.samples.get(label, []))
+                errors = self.errors.get(label, {})
+                all_latencies += latencies
+                total_ok += len(latencies)
+                total_err += sum(errors.values())
+                for kind, count in errors.items():
+                    error_totals[kind] += count
+                endpoints[label] = dict(percentiles(latencies), errors=errors)
+            requests = total_ok + total_err
+            return {
+                'duration': round(duration, 2),
+                'sessions': self.sessions,
+                'dropped_sessions': self.dropped,
+                'requests': requests,
+                'throughput': round(requests / duration, 2) if duration else 0,
+                'error_rate': round(total_err / requests, 4) if requests else 0,
+                'errors': error_totals,
+                'latency': percentiles(sorted(all_latencies)),
+                'endpoints': endpoints,
+            }
+
+
+def percentiles(sorted_values):
+    if not sorted_values:
+        return {'count': 0, 'p50': None, 'p95': None, 'p99': None}
+    pick = lambda q: round(1000 * sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))], 1)
+    return {'count': len(sorted_values), 'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        role, _, weight = part.partition('=')
+        if role not in ('admin', 'doctor', 'patient'):
+            raise argparse.ArgumentTypeError(f"unknown role '{role}'")
+        mix[role] = float(weight or 1)
+    return mix
+
+
+def run_stage(args, rate, recorder):
+    """Open-loop arrivals at `rate` sessions/second for args.duration seconds."""
+    recorder.reset()
+    roles, weights = zip(*parse_mix(args.mix).items())
+    slots = threading.BoundedSemaphore(args.max_sessions)
+    threads = []
+    rng = random.Random()
+
+    def session(seed):
+        local = random.Random(seed)
+        paths = Paths(args, local)
+        client = Client(args.url, recorder, args.timeout)
+        try:
+            getattr(paths, local.choices(roles, weights)[0])(client)
+        finally:
+            client.close()
+            slots.release()
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    next_arrival = started
+    while True:
+        next_arrival += rng.expovariate(rate)
+        if next_arrival >= deadline:
+            break
+        time.sleep(max(0.0, next_arrival - time.perf_counter()))
+        # Every simulated user is busy: the client itself is saturated
+        if not slots.acquire(blocking=False):
+            recorder.dropped += 1
+            continue
+        recorder.sessions += 1
+        t = threading.Thread(target=session, args=(rng.random(),), daemon=True)
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join(args.timeout * 4)
+    return recorder.summary(time.perf_counter() - started)
+
+
+def print_stage(rate, result, verbose):
+    print(f"\n== {rate:g} sessions/s: {result['sessions']} sessions, {result['requests']} requests in "
+          f"{result['duration']}s -> {result['throughput']} req/s, errors {100 * result['error_rate']:.2f}%")
+    if verbose:
+        print(f"   {'endpoint':48} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8}  errors")
+        for label, ep in result['endpoints'].items():
+            fmt = lambda v: f"{v:.1f}" if v is not None else '-'
+            errors = ', '.join(f"{k}={v}" for k, v in ep['errors'].items())
+            print(f"   {label[:48]:48} {ep['count']:>6} {fmt(ep['p50']):>8} {fmt(ep['p95']):>8} {fmt(ep['p99']):>8}  {errors}")
+
+
+def print_curve(stages):
+    print("\nSaturation curve (latency in ms)")
+    print(f"{'offered/s':>10} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>8} {'locked':>7} "
+          f"{'429':>6} {'503':>6} {'dropped':>8}")
+    for s in stages:
+        r, lat = s['result'], s['result']['latency']
+        fmt = lambda v: f"{v:.1f}" if v is not None else '-'
+        print(f"{s['rate']:>10g} {r['throughput']:>8} {fmt(lat['p50']):>8} {fmt(lat['p95']):>8} {fmt(lat['p99']):>8} "
+              f"{100 * r['error_rate']:>7.2f}% {r['errors']['lock_timeout']:>7} {r['errors']['rate_limited']:>6} "
+              f"{r['errors']['shed']:>6} {r['dropped_sessions']:>8}")
+
+
+def run(args):
+    recorder = Recorder()
+    stages = []
+    for rate in args.stages:
+        result = run_stage(args, rate, recorder)
+        print_stage(rate, result, not args.quiet)
+        stages.append({'rate': rate, 'result': result})
+    print_curve(stages)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'label': args.label, 'url': args.url, 'mix': args.mix, 'stages': stages}, f, indent=2)
+        print(f"\nSaved {args.json}")
+
+
+def compare(args):
+    runs = []
+    for path in (args.before, args.after):
+        with open(path) as f:
+            runs.append(json.load(f))
+    before, after = ({s['rate']: s['result'] for s in run_['stages']} for run_ in runs)
+
+    print(f"{'offered/s':>10} {'req/s before':>13} {'after':>8} {'p95 before':>11} {'after':>8} {'change':>8}")
+    for rate in sorted(set(before) & set(after)):
+        b, a = before[rate], after[rate]
+        bp, ap = b['latency']['p95'], a['latency']['p95']
+        change = f"{100 * (ap - bp) / bp:+.0f}%" if bp and ap is not None else '-'
+        print(f"{rate:>10g} {b['throughput']:>13} {a['throughput']:>8} {bp or '-':>11} {ap or '-':>8} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test HMS with simulated users.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('seed', help='generate doctors, patients, availability and history')
+    p.add_argument('--doctors', type=int, default=40)
+    p.add_argument('--patients', type=int, default=2000)
+    p.add_argument('--days', type=int, default=30, help='days of future availability per doctor')
+    p.add_argument('--history', type=int, default=0, help='past appointments per doctor')
+    p.add_argument('--password', default='loadtest')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=seed)
+
+    p = sub.add_parser('run', help='drive a running server')
+    p.add_argument('--url', default='http://127.0.0.1:8000')
+    p.add_argument('--mix', default=DEFAULT_MIX, help='role weights, e.g. admin=1,doctor=4,patient=15')
+    p.add_argument('--stages', default='2,4,8,16',
+                   type=lambda v: [float(x) for x in v.split(',')], help='session arrival rates per second')
+    p.add_argument('--duration', type=float, default=30, help='seconds per stage')
+    p.add_argument('--max-sessions', type=int, default=200, help='concurrent simulated users')
+    p.add_argument('--think', type=float, default=0.5, help='mean think time between clicks (s)')
+    p.add_argument('--timeout', type=float, default=30)
+    p.add_argument('--doctors', type=int, default=40, help='as given to seed')
+    p.add_argument('--patients', type=int, default=2000, help='as given to seed')
+    p.add_argument('--days', type=int, default=30, help='as given to seed')
+    p.add_argument('--password', default='loadtest')
+    p.add_argument('--admin-email', default='admin@hospital.local')
+    p.add_argument('--admin-password', default='Admin@123')
+    p.add_argument('--cancel-rate', type=float, default=0.3)
+    p.add_argument('--complete-rate', type=float, default=0.5)
+    p.add_argument('--availability-rate', type=float, default=0.3)
+    p.add_argument('--label', default='')
+    p.add_argument('--json', help='save results to this file')
+    p.add_argument('--quiet', action='store_true', help='only print the saturation curve')
+    p.set_defaults(func=run)
+
+    p = sub.add_parser('compare', help='compare two saved runs')
+    p.add_argument('before')
+    p.add_argument('after')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Production entry point: a small pre-fork server for POSIX systems.
+
+    python serve.py --bind 0.0.0.0:8000 --workers 4
+    python serve.py --worker-class gevent     # for many open live feeds
+
+The master process imports the app, runs the schema/seed checks
+(setup_database) and warms templates ONCE, opens the listening socket and
+then forks the workers, which share the preloaded code copy-on-write. Each
+worker serves requests on a threaded Werkzeug server bound to the shared
+socket, or with `--worker-class gevent` on a gevent WSGI server where every
+connection is a greenlet, so thousands of idle server-sent event streams
+(app/events.py) cost no thread each. gevent patches the standard library
+before anything else is imported; the live profiler (app/profiling.py)
+samples OS threads and records nothing in that mode.
+
+Signals sent to the master:
+    SIGHUP           rolling restart: start a new worker, wait until it is
+                     ready, then gracefully stop one old worker, and repeat
+    SIGTERM, SIGINT  graceful shutdown of all workers
+
+Heavy optional libraries (pandas, numpy, scikit-learn, matplotlib) must only
+be imported inside the functions that need them; startup reports any that
+leaked into the import path.
+"""
+import time
+
+STARTED = time.perf_counter()
+
+import os
+import sys
+
+# Decided before any other import: gevent has to patch the standard library first
+WORKER_CLASS = os.environ.get('HMS_WORKER_CLASS', 'thread')
+for i, arg in enumerate(sys.argv):
+    if arg.startswith('--worker-class='):
+        WORKER_CLASS = arg.split('=', 1)[1]
+    elif arg == '--worker-class' and i + 1 < len(sys.argv):
+        WORKER_CLASS = sys.argv[i + 1]
+if WORKER_CLASS == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import argparse
+import select
+import signal
+import socket
+import threading
+
+from werkzeug.serving import make_server
+
+from app import create_app, setup_database, warm_up
+
+IMPORTED = time.perf_counter()
+
+HEAVY_MODULES = ('pandas', 'numpy', 'sklearn', 'scipy', 'matplotlib', 'seaborn')
+
+
+def log(message):
+    print(f"[serve {os.getpid()}] {message}", flush=True)
+
+
+def run_worker(app, sock, ready_fd, threads, worker_class='thread', graceful_timeout=30.0):
+    """Body of a forked worker process. Never returns."""
+    if worker_class == 'gevent':
+        import gevent
+        from gevent.pywsgi import WSGIServer
+
+        server = WSGIServer(sock, app)
+
+        def stop(signum, frame):
+            # Event streams never end by themselves: close them after half the grace period
+            gevent.spawn(server.stop, graceful_timeout / 2)
+    else:
+        server = make_server(sock.getsockname()[0], sock.getsockname()[1], app,
+                             threaded=threads, fd=sock.fileno())
+        # Let in-flight requests finish on shutdown
+        server.daemon_threads = False
+
+        def stop(signum, frame):
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    for hook in app.extensions.get('post_fork', []):
+        hook(app)
+
+    os.write(ready_fd, b'1')
+    os.close(ready_fd)
+
+    server.serve_forever()
+    if worker_class != 'gevent':
+        server.server_close()
+    for hook in app.extensions.get('worker_exit', []):
+        hook(app)
+    os._exit(0)
+
+
+class Master:
+
+    def __init__(self, app, sock, workers, threads, graceful_timeout, worker_class='thread'):
+        self.app = app
+        self.sock = sock
+        self.size = workers
+        self.threads = threads
+        self.worker_class = worker_class
+        self.graceful_timeout = graceful_timeout
+        self.workers = set()
+        self.stopping = False
+        self.reload_requested = False
+
+    def spawn(self):
+        """Fork one worker and wait until it is serving. Returns its pid or None."""
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            try:
+                run_worker(self.app, self.sock, ready_w, self.threads, self.worker_class, self.graceful_timeout)
+            finally:
+                os._exit(1)
+
+        os.close(ready_w)
+        readable, _, _ = select.select([ready_r], [], [], 30)
+        ok = bool(readable) and os.read(ready_r, 1) == b'1'
+        os.close(ready_r)
+        self.workers.add(pid)
+        if not ok:
+            log(f"worker {pid} did not become ready")
+        return pid
+
+    def stop_worker(self, pid):
+        """SIGTERM, then SIGKILL if it has not exited within the grace period."""
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            self.workers.discard(pid)
+            return
+        deadline = time.monotonic() + self.graceful_timeout
+        while time.monotonic() < deadline:
+            done, _ = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            time.sleep(0.1)
+        else:
+            log(f"worker {pid} did not stop in {self.graceful_timeout}s, killing it")
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.workers.discard(pid)
+
+    def rolling_restart(self):
+        log("rolling restart")
+        for old in list(self.workers):
+            self.spawn()
+            self.stop_worker(old)
+        log(f"rolling restart done, workers: {sorted(self.workers)}")
+
+    def reap(self):
+        """Collect dead workers and replace ones that died unexpectedly."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping:
+                    log(f"worker {pid} exited ({status}), starting a replacement")
+                    self.spawn()
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *a: setattr(self, 'reload_requested', True))
+        signal.signal(signal.SIGTERM, lambda *a: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda *a: setattr(self, 'stopping', True))
+
+        for _ in range(self.size):
+            self.spawn()
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.rolling_restart()
+            self.reap()
+            time.sleep(0.5)
+
+        log("shutting down")
+        for pid in list(self.workers):
+            self.stop_worker(pid)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run HMS with pre-forked workers.")
+    parser.add_argument('--bind', default=os.environ.get('HMS_BIND', '127.0.0.1:8000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('HMS_WORKERS', os.cpu_count() or 2)))
+    parser.add_argument('--no-threads', action='store_true', help='serve one request at a time per worker')
+    parser.add_argument('--worker-class', choices=('thread', 'gevent'), default=WORKER_CLASS,
+                        help='thread: threaded Werkzeug server; gevent: one greenlet per connection')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    host, port = args.bind.rsplit(':', 1)
+
+    app = create_app()
+    built = time.perf_counter()
+
+    # Schema and seed checks run once here, never in the workers
+    setup_database(app)
+    migrated = time.perf_counter()
+
+    warm_up(app)
+    warmed = time.perf_counter()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    log(
+        f"startup {warmed - STARTED:.3f}s "
+        f"(imports {IMPORTED - STARTED:.3f}s, create_app {built - IMPORTED:.3f}s, "
+        f"database {migrated - built:.3f}s, warm-up {warmed - migrated:.3f}s)"
+    )
+    heavy = [m for m in HEAVY_MODULES if m in sys.modules]
+    if heavy:
+        log(f"warning: heavy modules imported at startup: {', '.join(heavy)}")
+
+    log(f"listening on http://{host}:{port} with {args.workers} {args.worker_class} workers")
+    Master(app, sock, args.workers, not args.no_threads, args.graceful_timeout, args.worker_class).run()
+
+
+if __name__ == '__main__':
+    main()